@@ -0,0 +1,565 @@
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+import numpy as np
+from cherche import retrieve
+from rapidfuzz import fuzz
+
+from .docstore import DocumentStore
+from .encoding import DEFAULT_WINDOW, encode_texts, model_token_counter
+from .fuzzy import FuzzyIndex
+from .main import METHODS, build_retriever
+from .models import registry
+from .sharded import ShardedRetriever
+from .utils import percentile
+
+DEFAULT_MODEL = "sentence-transformers/all-mpnet-base-v2"
+DPR_MODELS = ("facebook-dpr-ctx_encoder-single-nq-base", "facebook-dpr-question_encoder-single-nq-base")
+
+# Metrics compared against the baseline, and whether a larger value is a regression
+LOWER_IS_BETTER = ("import_ms", "build_seconds", "peak_rss_mb", "disk_mb", "latency_p50_ms", "latency_p95_ms", "latency_p99_ms", "rss_mb_per_million", "lookup_us")
+HIGHER_IS_BETTER = ("batch_qps",)
+
+_SYLLABLES = ["ka", "to", "ri", "mu", "sel", "van", "dor", "pi", "lo", "ne", "ar", "quo", "tis", "gen", "ul", "ba"]
+
+
+class HashingEncoder:
+    def __init__(self, name=None, device="cpu", dim=384):
+        """
+        Stand-in for a SentenceTransformer that needs no weights or network: each word adds a
+        pseudo-random vector picked by its hash. Like a transformer, every text of a batch is
+        processed up to the length of the longest one (padding positions add zeros), so the
+        cost of batching texts of mixed lengths remains visible; the vectors carry no meaning.
+        """
+        self.name = name
+        self.dim = dim
+        self.max_seq_length = 256
+        self._vectors = {}
+
+    def get_sentence_embedding_dimension(self):
+        return self.dim
+
+    def encode(self, texts, batch_size=32, **kwargs):
+        single = isinstance(texts, str)
+        texts = [texts] if single else list(texts)
+        embeddings = np.zeros((len(texts), self.dim), dtype=np.float32)
+        padding = np.zeros(self.dim, dtype=np.float32)
+        for start in range(0, len(texts), batch_size):
+            batch = [text.lower().split()[:self.max_seq_length] for text in texts[start:start + batch_size]]
+            longest = max(map(len, batch), default=0)
+            for row, words in enumerate(batch, start=start):
+                for position in range(longest):
+                    embeddings[row] += self._vector(words[position]) if position < len(words) else padding
+        return embeddings[0] if single else embeddings
+
+    def _vector(self, word):
+        vector = self._vectors.get(word)
+        if vector is None:
+            seed = int.from_bytes(hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest(), "little")
+            vector = self._vectors[word] = np.random.default_rng(seed).standard_normal(self.dim, dtype=np.float32)
+        return vector
+
+
+def install_stub(model_name=DEFAULT_MODEL):
+    """
+    Registers a HashingEncoder under model_name and the DPR models in this process; loaded
+    models are shared through the registry, so every retriever built afterwards uses the stub.
+    """
+    for name in (model_name,) + DPR_MODELS:
+        registry.acquire(name, "cpu", loader=HashingEncoder)
+
+
+def synthetic_vocabulary(size, seed=0):
+    """Pronounceable pseudo-words of two to four syllables, so character n-gram methods behave as on text."""
+    rng = np.random.default_rng(seed)
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(_SYLLABLES, size=rng.integers(2, 5))))
+    return sorted(words)
+
+
+def synthetic_corpus(size, seed=0, vocabulary_size=20000, words_per_paragraph=(20, 120)):
+    """
+    Yields size paragraphs with ids from 1, like process.py, and a Zipf word distribution.
+
+    Each document has "text" (golden methods) and "title"/"article" (encoder and dpr).
+    """
+    vocabulary = np.array(synthetic_vocabulary(vocabulary_size, seed))
+    rng = np.random.default_rng(seed + 1)
+    for doc_id in range(1, size + 1):
+        ranks = np.minimum(rng.zipf(1.2, size=rng.integers(*words_per_paragraph)), vocabulary_size) - 1
+        text = " ".join(vocabulary[ranks])
+        yield {"id": doc_id, "text": text, "title": " ".join(vocabulary[ranks[:3]]), "article": text}
+
+
+def synthetic_queries(count, seed=0, vocabulary_size=20000, words_per_query=(2, 6)):
+    vocabulary = np.array(synthetic_vocabulary(vocabulary_size, seed))
+    rng = np.random.default_rng(seed + 2)
+    return [
+        " ".join(vocabulary[np.minimum(rng.zipf(1.2, size=rng.integers(*words_per_query)), vocabulary_size) - 1])
+        for _ in range(count)
+    ]
+
+
+def _rss_mb():
+    # ru_maxrss is the peak resident set size, in KiB on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _current_rss_mb():
+    # Resident set size now rather than at its peak; Linux only, None elsewhere
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / (1024 * 1024)
+    except OSError:
+        return None
+
+
+def _directory_mb(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+    return total / (1024 * 1024)
+
+
+def _disk_mb(retriever, path):
+    if hasattr(retriever, "save"):
+        retriever.save(path)
+    elif hasattr(retriever, "sparse"):
+        # Hybrid: both halves
+        retriever.sparse.save(os.path.join(path, "sparse"))
+        retriever.dense.save(os.path.join(path, "dense"))
+    else:
+        return None
+    return _directory_mb(path)
+
+
+def run_method(method, size, queries=200, seed=0, model_name=DEFAULT_MODEL, stub=True, batch_size=64, k=10):
+    """
+    Builds one method over a synthetic corpus and measures it; meant to run in its own process
+    so that peak_rss_mb covers this method only.
+
+    :return: Dict with build_seconds, peak_rss_mb, corpus_rss_mb, disk_mb, latency percentiles
+             of single-query retrieve calls and batch_qps of retrieve_batch.
+    """
+    if stub:
+        install_stub(model_name)
+    documents = list(synthetic_corpus(size, seed))
+    query_list = synthetic_queries(queries, seed)
+    corpus_rss = _rss_mb()
+
+    start = time.perf_counter()
+    # The on-disk and query caches would turn the timings into cache benchmarks
+    retriever = build_retriever(documents, method, model_name=model_name, cache_dir=None, query_cache_size=0)
+    build_seconds = time.perf_counter() - start
+    peak_rss = _rss_mb()
+
+    latencies = []
+    for query in query_list:
+        start = time.perf_counter()
+        retriever.retrieve(query, k=k)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    retriever.retrieve_batch(query_list, k=k, batch_size=batch_size)
+    batch_seconds = time.perf_counter() - start
+
+    path = tempfile.mkdtemp(prefix=f"bench-{method}-")
+    try:
+        disk_mb = _disk_mb(retriever, path)
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+    return {
+        "method": method,
+        "size": size,
+        "queries": len(query_list),
+        "build_seconds": build_seconds,
+        "peak_rss_mb": peak_rss,
+        "corpus_rss_mb": corpus_rss,
+        "disk_mb": disk_mb,
+        "latency_p50_ms": percentile(latencies, 50),
+        "latency_p95_ms": percentile(latencies, 95),
+        "latency_p99_ms": percentile(latencies, 99),
+        "batch_qps": len(query_list) / batch_seconds if batch_seconds else None,
+    }
+
+
+def run_encoding(size, seed=0, model_name=DEFAULT_MODEL, stub=True, batch_size=32, window=DEFAULT_WINDOW):
+    """
+    Encode throughput of the corpus in document order, batch_size texts per call, against
+    length-sorted batches (encoding.encode_texts).
+
+    :return: Dict with the docs/sec of both and the speedup.
+    """
+    if stub:
+        model = registry.acquire(model_name, "cpu", loader=HashingEncoder)
+    else:
+        model = registry.acquire(model_name, "cpu")
+    texts = [document["text"] for document in synthetic_corpus(size, seed)]
+    count_tokens = model_token_counter(model)
+    # Warm up, so one-time costs (the stub's word vectors, lazy model setup) count for neither
+    encode_texts(texts, model.encode, batch_size=batch_size, window=window, count_tokens=count_tokens)
+
+    start = time.perf_counter()
+    for offset in range(0, len(texts), batch_size):
+        model.encode(texts[offset:offset + batch_size], batch_size=batch_size)
+    unsorted_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    encode_texts(texts, model.encode, batch_size=batch_size, window=window, count_tokens=count_tokens)
+    sorted_seconds = time.perf_counter() - start
+    return {
+        "method": "encoding",
+        "size": size,
+        "batch_size": batch_size,
+        "unsorted_docs_per_sec": len(texts) / unsorted_seconds,
+        "sorted_docs_per_sec": len(texts) / sorted_seconds,
+        "speedup": unsorted_seconds / sorted_seconds,
+    }
+
+
+def run_fuzzy(size, queries=50, seed=0, k=10, fuzzer="partial_ratio", candidates=1000):
+    """
+    Query latency of cherche's Fuzz (one scorer call per document) against FuzzyIndex, with
+    candidate pruning and scoring every document in one cdist call.
+
+    :param fuzzer: Name of the rapidfuzz.fuzz scorer.
+    :return: Dict with latency percentiles of each and the recall of the pruned index: the share
+             of its top k reaching the k-th best score of the exhaustive search (ties make ids
+             an unreliable comparison).
+    """
+    scorer = getattr(fuzz, fuzzer)
+    documents = list(synthetic_corpus(size, seed))
+    query_list = synthetic_queries(queries, seed)
+    baseline = retrieve.Fuzz(key="id", on=["text"], fuzzer=scorer).add(documents)
+    pruned = FuzzyIndex(key="id", on=["text"], fuzzer=scorer, candidates=candidates).add(documents)
+    exhaustive = FuzzyIndex(key="id", on=["text"], fuzzer=scorer, candidates=None).add(documents)
+    # Build the inverted indexes outside the timings
+    pruned(query_list[0], k=k)
+    exhaustive(query_list[0], k=k)
+
+    result = {"method": f"fuzz-{fuzzer}", "size": size, "queries": len(query_list), "candidates": candidates}
+    hits = {}
+    for name, retriever in (("cherche", baseline), ("pruned", pruned), ("exhaustive", exhaustive)):
+        latencies = []
+        hits[name] = []
+        for query in query_list:
+            start = time.perf_counter()
+            hits[name].append(retriever(query, k=k, tqdm_bar=False))
+            latencies.append((time.perf_counter() - start) * 1000)
+        result[f"{name}_p50_ms"] = percentile(latencies, 50)
+        result[f"{name}_p95_ms"] = percentile(latencies, 95)
+    recalls = []
+    for exact, found in zip(hits["exhaustive"], hits["pruned"]):
+        if exact:
+            threshold = exact[-1]["similarity"]
+            recalls.append(sum(hit["similarity"] >= threshold for hit in found) / len(exact))
+    result["pruned_recall"] = float(np.mean(recalls)) if recalls else None
+    result["speedup"] = result["cherche_p50_ms"] / result["pruned_p50_ms"]
+    return result
+
+
+DOCSTORE_LAYOUTS = ("list", "store", "mmap")
+
+
+def run_docstore(size, layout, seed=0, lookups=1000):
+    """
+    Memory held by size paragraphs shaped like process.py's output, as a list of dicts, a
+    DocumentStore in memory or a DocumentStore memory-mapped from disk, and the time to
+    materialize lookups random hits. Run each layout in a fresh process: freed memory is
+    not always returned to the system.
+
+    :return: Dict with the resident set size growth, also per million paragraphs.
+    """
+    def passages():
+        for document in synthetic_corpus(size, seed):
+            yield {"id": document["id"], "text": document["text"], "source": f"file_{document['id'] // 50}.pdf", "page": document["id"] % 50 + 1}
+
+    directory = tempfile.mkdtemp()
+    try:
+        if layout == "mmap":
+            # Written straight from the generator: the corpus is never held in memory
+            DocumentStore.build(passages(), path=directory)
+        before = _current_rss_mb()
+        if layout == "list":
+            documents = list(passages())
+            lookup = {document["id"]: document for document in documents}.get
+        elif layout == "store":
+            documents = DocumentStore.build(passages())
+            lookup = documents.get
+        else:
+            documents = DocumentStore.load(directory)
+            lookup = documents.get
+        ids = np.random.default_rng(seed).integers(1, size + 1, size=lookups).tolist()
+        start = time.perf_counter()
+        for doc_id in ids:
+            lookup(doc_id)
+        seconds = time.perf_counter() - start
+        rss_mb = _current_rss_mb() - before
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return {
+        "method": f"docstore-{layout}", "size": size, "rss_mb": rss_mb,
+        "rss_mb_per_million": rss_mb * 1e6 / size, "lookup_us": seconds * 1e6 / lookups,
+    }
+
+
+def run_sharded(method, size, shards, queries=200, seed=0, k=10, batch_size=64, model_name=DEFAULT_MODEL, stub=True):
+    """
+    Throughput of a ShardedRetriever with the given number of shard processes, one query at a
+    time (scatter-gather latency) and in retrieve_batch calls. Compare shard counts on a
+    machine with at least as many cores as shards. With stub, every shard process installs
+    the HashingEncoder (see install_stub) before building its retriever.
+
+    :return: Dict with build time, latency percentiles and queries per second.
+    """
+    documents = list(synthetic_corpus(size, seed))
+    # Separate queries for the batch run, which the per-query run would otherwise have cached
+    query_list = synthetic_queries(2 * queries, seed)
+    query_list, batch_queries = query_list[:queries], query_list[queries:]
+    start = time.perf_counter()
+    # The on-disk embedding cache would serve vectors of another model under the same name
+    retriever = ShardedRetriever(
+        documents, method, shards=shards, initializer=install_stub if stub else None, initargs=(model_name,),
+        model_name=model_name, cache_dir=None,
+    )
+    build_seconds = time.perf_counter() - start
+    try:
+        latencies = []
+        for query in query_list:
+            start = time.perf_counter()
+            retriever.retrieve(query, k=k)
+            latencies.append((time.perf_counter() - start) * 1000)
+        start = time.perf_counter()
+        retriever.retrieve_batch(batch_queries, k=k, batch_size=batch_size)
+        batch_seconds = time.perf_counter() - start
+    finally:
+        retriever.close()
+    return {
+        "method": f"{method}-x{shards}", "size": size, "shards": shards, "cpus": os.cpu_count(),
+        "build_seconds": build_seconds, "latency_p50_ms": percentile(latencies, 50),
+        "latency_p95_ms": percentile(latencies, 95), "loop_qps": len(query_list) / (sum(latencies) / 1000),
+        "batch_qps": len(batch_queries) / batch_seconds,
+    }
+
+
+def run_filtered(method, size, queries=200, seed=0, k=10, selectivity=0.1, model_name=DEFAULT_MODEL, stub=True):
+    """
+    Query latency of a method with and without a metadata filter keeping selectivity of the
+    documents, which carry a "group" field from 0 to 99. The on-disk and query caches are
+    disabled so both runs encode and search every query.
+
+    :return: Dict with latency percentiles of both runs and their ratio.
+    """
+    if stub:
+        install_stub(model_name)
+    documents = [dict(document, group=document["id"] % 100) for document in synthetic_corpus(size, seed)]
+    query_list = synthetic_queries(queries, seed)
+    retriever = build_retriever(documents, method, model_name=model_name, cache_dir=None, query_cache_size=0, metadata_fields=["group"])
+    where = {"group": {"$lt": max(1, round(selectivity * 100))}}
+    # Filter compilation and lazy metadata are paid once, outside the timings
+    retriever.retrieve(query_list[0], k=k, where=where)
+
+    result = {"method": method, "size": size, "queries": len(query_list), "selectivity": selectivity}
+    for name, filters in (("unfiltered", {}), ("filtered", {"where": where})):
+        latencies = []
+        for query in query_list:
+            start = time.perf_counter()
+            retriever.retrieve(query, k=k, **filters)
+            latencies.append((time.perf_counter() - start) * 1000)
+        result[f"{name}_p50_ms"] = percentile(latencies, 50)
+        result[f"{name}_p95_ms"] = percentile(latencies, 95)
+    result["filtered_ratio"] = result["filtered_p50_ms"] / result["unfiltered_p50_ms"]
+    if hasattr(retriever, "close"):
+        retriever.close()
+    return result
+
+
+def _import_times(code):
+    # Self time in microseconds of each module python -X importtime reports importing while running code
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(path for path in sys.path if path))
+    stderr = subprocess.run([sys.executable, "-X", "importtime", "-c", code], env=env, capture_output=True, text=True, check=True).stderr
+    # Lines look like "import time:  self [us] | cumulative | module"; the header has no number
+    rows = [line.split(":", 1)[1].split("|") for line in stderr.splitlines() if line.startswith("import time:")]
+    return {fields[2].strip(): int(fields[0]) for fields in rows if fields[0].strip().isdigit()}
+
+
+def _method_import_code(method, then=""):
+    # The hybrid method builds a bm25 and an embedding retriever
+    parts = ["bm25", "embedding", method] if method == "hybrid" else [method]
+    package = __package__ or "retrievers"
+    return f"import sys\nstartup = set(sys.modules)\nfrom {package}.main import retriever_class\nfor part in {parts!r}:\n    retriever_class(part)\n{then}"
+
+
+def measure_import_time(method):
+    """
+    Milliseconds a fresh interpreter spends importing what build_retriever(method) imports,
+    summed from the self times of python -X importtime (interpreter startup excluded).
+    """
+    startup = _import_times("pass")
+    return sum(us for module, us in _import_times(_method_import_code(method)).items() if module not in startup) / 1000
+
+
+def imported_packages(method):
+    """Top-level packages a fresh interpreter imports to look up the class of method (interpreter startup excluded)."""
+    code = _method_import_code(method, then="print(' '.join(sorted({name.split('.')[0] for name in set(sys.modules) - startup})))")
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(path for path in sys.path if path))
+    stdout = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True, check=True).stdout
+    return stdout.split()
+
+
+def run_import_times(methods=METHODS):
+    """Import time of each method, see measure_import_time; compared against a baseline like the other metrics."""
+    return [{"method": method, "size": 0, "import_ms": measure_import_time(method)} for method in methods]
+
+
+def _child(connection, kwargs, function=run_method, method=None):
+    try:
+        connection.send(function(**kwargs))
+    except Exception as e:
+        connection.send({"method": method, "size": kwargs.get("size", 0), "error": f"{e}\n{traceback.format_exc()}"})
+    finally:
+        connection.close()
+
+
+def _run_isolated(function, kwargs, method):
+    # Runs function(**kwargs) in a fresh process so that memory and caches do not leak between runs;
+    # method labels the error row of a failed run, as function may not take a method argument
+    context = multiprocessing.get_context("spawn")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_child, args=(sender, kwargs, function, method))
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = {"method": method, "size": kwargs.get("size", 0), "error": "benchmark process died"}
+    process.join()
+    return result
+
+
+def run_benchmarks(methods=METHODS, sizes=(10000,), **kwargs):
+    """Runs run_method for every method and corpus size, each in a fresh process, and returns the results."""
+    return [
+        _run_isolated(run_method, dict(kwargs, method=method, size=size), method)
+        for size in sizes for method in methods
+    ]
+
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    Lists the metrics that got worse than the baseline by more than tolerance (a fraction).
+
+    :return: List of (method, size, metric, baseline value, new value).
+    """
+    previous = {(row["method"], row["size"]): row for row in baseline if "error" not in row}
+    regressions = []
+    for row in results:
+        old = previous.get((row["method"], row["size"]))
+        if old is None or "error" in row:
+            continue
+        for metric in LOWER_IS_BETTER + HIGHER_IS_BETTER:
+            if old.get(metric) is None or row.get(metric) is None:
+                continue
+            if metric in LOWER_IS_BETTER:
+                worse = row[metric] > old[metric] * (1 + tolerance)
+            else:
+                worse = row[metric] < old[metric] * (1 - tolerance)
+            if worse:
+                regressions.append((row["method"], row["size"], metric, old[metric], row[metric]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark every retrieval method on synthetic corpora.")
+    parser.add_argument('--methods', nargs='+', default=METHODS, choices=METHODS, help="Methods to benchmark")
+    parser.add_argument('--sizes', nargs='+', type=int, default=[10000], help="Corpus sizes in paragraphs")
+    parser.add_argument('--queries', type=int, default=200, help="Number of queries")
+    parser.add_argument('--k', type=int, default=10, help="Results per query")
+    parser.add_argument('--batch-size', type=int, default=64, help="Queries per retrieve_batch call")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the corpus and query generators")
+    parser.add_argument('--model-name', type=str, default=DEFAULT_MODEL, help="Sentence-transformers model of the dense methods")
+    parser.add_argument('--real-models', action='store_true', help="Load real models instead of the offline hashing stub")
+    parser.add_argument('--output', type=str, help="Write the results to this JSON file")
+    parser.add_argument('--baseline', type=str, help="JSON results of an earlier run to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Relative change counted as a regression")
+    parser.add_argument('--encode', action='store_true', help="Only compare corpus encoding in document order and in length-sorted batches")
+    parser.add_argument('--encode-batch-size', type=int, default=32, help="Texts per model call of --encode")
+    parser.add_argument('--import-time', action='store_true', help="Only measure the import time of each method")
+    parser.add_argument('--fuzzy', action='store_true', help="Only compare cherche's Fuzz with the pruned FuzzyIndex")
+    parser.add_argument('--fuzzer', type=str, default="partial_ratio", help="rapidfuzz.fuzz scorer of --fuzzy")
+    parser.add_argument('--fuzz-candidates', type=int, default=1000, help="Documents scored per query by --fuzzy")
+    parser.add_argument('--shards', nargs='+', type=int, help="Only benchmark a ShardedRetriever of each method with these shard counts")
+    parser.add_argument('--filtered', action='store_true', help="Only compare query latency with and without a metadata filter")
+    parser.add_argument('--selectivity', type=float, default=0.1, help="Share of the documents kept by the filter of --filtered")
+    parser.add_argument('--docstore', action='store_true', help="Only compare the memory of a list of dicts and of a DocumentStore")
+    args = parser.parse_args()
+
+    if args.fuzzy:
+        for size in args.sizes:
+            print(json.dumps(run_fuzzy(size, args.queries, args.seed, args.k, args.fuzzer, args.fuzz_candidates)))
+        return
+
+    if args.encode:
+        for size in args.sizes:
+            print(json.dumps(run_encoding(size, args.seed, args.model_name, not args.real_models, args.encode_batch_size)))
+        return
+
+    if args.import_time:
+        results = run_import_times(args.methods)
+    elif args.filtered:
+        results = [
+            _run_isolated(run_filtered, {
+                "method": method, "size": size, "queries": args.queries, "seed": args.seed, "k": args.k,
+                "selectivity": args.selectivity, "model_name": args.model_name, "stub": not args.real_models,
+            }, method)
+            for size in args.sizes for method in args.methods
+        ]
+    elif args.shards:
+        results = [
+            _run_isolated(run_sharded, {
+                "method": method, "size": size, "shards": shards, "queries": args.queries, "seed": args.seed,
+                "k": args.k, "batch_size": args.batch_size, "model_name": args.model_name, "stub": not args.real_models,
+            }, f"{method}-x{shards}")
+            for size in args.sizes for method in args.methods for shards in args.shards
+        ]
+    elif args.docstore:
+        results = [
+            _run_isolated(run_docstore, {"size": size, "layout": layout, "seed": args.seed}, f"docstore-{layout}")
+            for size in args.sizes for layout in DOCSTORE_LAYOUTS
+        ]
+    else:
+        results = run_benchmarks(
+            methods=args.methods, sizes=args.sizes, queries=args.queries, seed=args.seed, model_name=args.model_name,
+            stub=not args.real_models, batch_size=args.batch_size, k=args.k,
+        )
+    for row in results:
+        print(json.dumps(row))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    failed = any("error" in row for row in results)
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for method, size, metric, old, new in regressions:
+            print(f"REGRESSION {method} @ {size}: {metric} {old:.4g} -> {new:.4g}")
+        failed = failed or bool(regressions)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
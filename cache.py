@@ -0,0 +1,281 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+
+from .metrics import instrument_encoder
+
+# Parent directory of the retrievers package, which holds upload.py, process.py and the all_files folder they write
+DATA_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Default location of the on-disk embedding store, next to the uploaded files whatever the working directory
+DEFAULT_CACHE_DIR = os.environ.get("RETRIEVERS_CACHE_DIR", os.path.join(DATA_ROOT, "all_files", "sys", "embedding_cache"))
+
+_KEY_SIZE = 20  # sha1 digest length
+_caches = {}
+_MISSING = object()
+
+
+def normalize_text(text):
+    """Normalize text before hashing so that trivially different copies share an embedding."""
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def content_key(model_name, text):
+    """Content address of a text for a given model: sha1 of model name + normalized text."""
+    payload = model_name.encode("utf-8") + b"\0" + normalize_text(text).encode("utf-8")
+    return hashlib.sha1(payload).digest()
+
+
+class EmbeddingCache:
+    def __init__(self, path, model_name):
+        """
+        Content-addressed, append-only store of float32 embeddings for one model.
+
+        Vectors live in a raw float32 file that is memory-mapped for reads, and a sidecar file
+        holds the 20-byte content key of every row in the same order. The store is meant to be
+        written by one process at a time.
+
+        :param path: Root directory of the cache; each model gets its own subdirectory.
+        :param model_name: Name of the model producing the embeddings.
+        """
+        self.model_name = model_name
+        self.path = os.path.join(path, re.sub(r"[^A-Za-z0-9_.-]+", "_", model_name))
+        self.vectors_path = os.path.join(self.path, "vectors.f32")
+        self.keys_path = os.path.join(self.path, "keys.bin")
+        self.meta_path = os.path.join(self.path, "meta.json")
+        self.hits = 0
+        self.misses = 0
+        self.dim = None
+        self.rows = {}
+        self._size = 0
+        self._mmap = None
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.meta_path):
+            return
+        with open(self.meta_path, "r") as f:
+            self.dim = json.load(f)["dim"]
+        with open(self.keys_path, "rb") as f:
+            keys = f.read()
+        # A crash between or during the two appends can leave one file longer than the other, or a
+        # partial row; both are cut back to the complete rows so the next append lines up again
+        size = min(len(keys) // _KEY_SIZE, os.path.getsize(self.vectors_path) // (4 * self.dim))
+        if len(keys) > size * _KEY_SIZE:
+            os.truncate(self.keys_path, size * _KEY_SIZE)
+        if os.path.getsize(self.vectors_path) > size * 4 * self.dim:
+            os.truncate(self.vectors_path, size * 4 * self.dim)
+        self.rows = {keys[i * _KEY_SIZE:(i + 1) * _KEY_SIZE]: i for i in range(size)}
+        self._size = size
+
+    def _vectors(self):
+        if self._mmap is None and self._size:
+            self._mmap = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(self._size, self.dim))
+        return self._mmap
+
+    def _append(self, keys, embeddings):
+        if self.dim is None:
+            self.dim = embeddings.shape[1]
+            os.makedirs(self.path, exist_ok=True)
+            with open(self.meta_path, "w") as f:
+                json.dump({"model_name": self.model_name, "dim": self.dim}, f)
+        with open(self.vectors_path, "ab") as f:
+            f.write(np.ascontiguousarray(embeddings, dtype=np.float32).tobytes())
+        with open(self.keys_path, "ab") as f:
+            f.write(b"".join(keys))
+        for i, key in enumerate(keys):
+            self.rows[key] = self._size + i
+        self._size += len(keys)
+        self._mmap = None
+
+    def encode(self, texts, encoder):
+        """
+        Return embeddings for texts, calling the encoder only for texts not already stored.
+
+        :param texts: List of strings to embed.
+        :param encoder: Callable mapping a list of strings to a 2-d array of embeddings.
+        :return: float32 array of shape (len(texts), dim) in the order of texts.
+        """
+        keys = [content_key(self.model_name, text) for text in texts]
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in self.rows and key not in missing:
+                missing[key] = text
+        self.misses += len(missing)
+        self.hits += len(texts) - len(missing)
+
+        if missing:
+            embeddings = np.asarray(encoder(list(missing.values())), dtype=np.float32)
+            self._append(list(missing.keys()), embeddings)
+
+        if not texts:
+            return np.zeros((0, self.dim or 0), dtype=np.float32)
+        vectors = self._vectors()
+        return np.array(vectors[[self.rows[key] for key in keys]], dtype=np.float32)
+
+    def wrap(self, encoder):
+        """Wrap an encode function (e.g. SentenceTransformer.encode) so that it goes through the cache."""
+        def cached_encoder(texts, *args, **kwargs):
+            if isinstance(texts, str):
+                return self.encode([texts], lambda batch: encoder(batch, *args, **kwargs))[0]
+            return self.encode(list(texts), lambda batch: encoder(batch, *args, **kwargs))
+        return cached_encoder
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "model_name": self.model_name,
+            "size": self._size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+def get_cache(path, model_name):
+    """Return the process-wide EmbeddingCache for a directory and model, or None if path is None."""
+    if path is None:
+        return None
+    key = (os.path.abspath(path), model_name)
+    if key not in _caches:
+        _caches[key] = EmbeddingCache(path, model_name)
+    return _caches[key]
+
+
+class LRUCache:
+    def __init__(self, max_size=1024, ttl=None):
+        """
+        Thread-safe mapping holding at most max_size entries, evicting the least recently used.
+
+        :param max_size: Maximum number of entries; 0 disables the cache.
+        :param ttl: Seconds after which an entry expires, or None to keep entries until evicted.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (expiry time, value)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[0] is None or entry[0] > time.monotonic()):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (None if self.ttl is None else time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+class QueryCache:
+    def __init__(self, max_size=1024, ttl=300, embedding_size=4096):
+        """
+        Caches of query results and query embeddings for one retriever.
+
+        Result keys are (namespace, normalized query, k, index version). Retrievers bump their
+        version on every add/delete, so results computed before a change are never served
+        again and simply age out of the LRU. Query embeddings depend only on the model and
+        the query, so they survive index changes and have no TTL.
+
+        :param max_size: Maximum number of cached results; 0 disables result caching.
+        :param ttl: Seconds a result stays valid, or None.
+        :param embedding_size: Maximum number of cached query embeddings; 0 disables them.
+        """
+        self.results = LRUCache(max_size, ttl)
+        self.embeddings = LRUCache(embedding_size)
+
+    def cached(self, key, compute):
+        """Returns the result stored under key, computing and storing it on a miss."""
+        value = self.results.get(key, _MISSING)
+        if value is _MISSING:
+            value = compute()
+            self.results.put(key, value)
+        return value
+
+    def retrieve_batch(self, namespace, version, queries, k, search):
+        """
+        One list of hits per query, calling search(queries) only for distinct queries not cached.
+
+        :param namespace: Distinguishes the retrieval methods sharing the cache, e.g. the method name.
+        :param version: Index version the results are valid for.
+        :param search: Callable mapping a list of queries to one list of hits per query.
+        """
+        keys = [(namespace, normalize_text(query), k, version) for query in queries]
+        results = [self.results.get(key, _MISSING) for key in keys]
+        missing = {}
+        for key, query, result in zip(keys, queries, results):
+            if result is _MISSING and key not in missing:
+                missing[key] = query
+        if missing:
+            found = dict(zip(missing, search(list(missing.values()))))
+            for key, hits in found.items():
+                self.results.put(key, hits)
+            results = [found[key] if result is _MISSING else result for key, result in zip(keys, results)]
+        return results
+
+    def encode(self, queries, encoder):
+        """
+        Query embeddings, calling encoder only for distinct queries not cached.
+
+        :param queries: A string or a list of strings.
+        :param encoder: Callable mapping a list of strings to a 2-d array of embeddings.
+        :return: 1-d array for a string, otherwise a 2-d float32 array in the order of queries.
+        """
+        if isinstance(queries, str):
+            return self.encode([queries], encoder)[0]
+        keys = [normalize_text(query) for query in queries]
+        vectors = [self.embeddings.get(key) for key in keys]
+        missing = {}
+        for key, query, vector in zip(keys, queries, vectors):
+            if vector is None and key not in missing:
+                missing[key] = query
+        if missing:
+            encoder = instrument_encoder(encoder, stage="encode_query")
+            found = dict(zip(missing, np.asarray(encoder(list(missing.values())), dtype=np.float32)))
+            for key, vector in found.items():
+                self.embeddings.put(key, vector)
+            vectors = [found[key] if vector is None else vector for key, vector in zip(keys, vectors)]
+        return np.stack(vectors) if vectors else np.zeros((0, 0), dtype=np.float32)
+
+    def stats(self):
+        return {"results": self.results.stats(), "query_embeddings": self.embeddings.stats()}
@@ -0,0 +1,144 @@
+import re
+
+# Passage size in tokens: under the sequence limits of all-mpnet-base-v2 (384) and DPR (512)
+DEFAULT_MAX_TOKENS = 256
+DEFAULT_OVERLAP = 32
+# Passages shorter than this are merged with their neighbours instead of ending at a heading
+DEFAULT_MIN_TOKENS = 32
+
+_SENTENCE_END = re.compile(r"(?<=[.!?;:])\s+")
+# Word pieces, numbers and single punctuation marks; a lower bound of most subword tokenizers' counts
+_TOKEN = re.compile(r"\w+|[^\w\s]")
+
+
+def regex_token_count(texts):
+    """Counts words and punctuation marks, as a tokenizer-free estimate of the number of tokens."""
+    return [len(_TOKEN.findall(text)) for text in texts]
+
+
+def token_counter(model_name=None):
+    """
+    Returns a function mapping a list of texts to their number of tokens.
+
+    With a model name, the model's own tokenizer is loaded from transformers (tokenizer
+    files only, no weights); without one, or if it cannot be loaded, regex_token_count is
+    used, which undercounts subword tokenizers, so leave some margin in max_tokens.
+    """
+    if model_name is None:
+        return regex_token_count
+    try:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(model_name)
+    except Exception:
+        return regex_token_count
+
+    def count(texts):
+        if not texts:
+            return []
+        return [len(ids) for ids in tokenizer(list(texts), add_special_tokens=False)["input_ids"]]
+    return count
+
+
+def clean_text(text):
+    """Joins hard-wrapped lines (and words hyphenated across them) and collapses whitespace."""
+    text = re.sub(r"(\w)-\n(\w)", r"\1\2", text)
+    return " ".join(text.split())
+
+
+def split_sentences(text):
+    return [sentence for sentence in _SENTENCE_END.split(text) if sentence]
+
+
+class Chunker:
+    def __init__(self, max_tokens=DEFAULT_MAX_TOKENS, overlap=DEFAULT_OVERLAP, min_tokens=DEFAULT_MIN_TOKENS, count_tokens=None):
+        """
+        Packs the paragraphs extracted from a file into passages of at most max_tokens tokens.
+
+        Paragraphs are split into sentences and sentences are packed greedily, so small
+        fragments (short paragraphs, list items) are merged and long pages are cut at
+        sentence boundaries; a sentence longer than max_tokens is cut at word boundaries.
+        A heading starts a new passage once the current one holds min_tokens, so it stays
+        with the text it introduces. Each passage after the first repeats the trailing
+        sentences of the previous one, up to overlap tokens.
+
+        :param max_tokens: Token budget of a passage, below the encoder's sequence limit.
+        :param overlap: Tokens of context repeated from the previous passage, 0 for none.
+        :param min_tokens: Passages are not ended at a heading before reaching this size.
+        :param count_tokens: Function mapping a list of texts to token counts, see token_counter.
+        """
+        if overlap >= max_tokens:
+            raise ValueError(f"overlap ({overlap}) must be smaller than max_tokens ({max_tokens})")
+        self.max_tokens = max_tokens
+        self.overlap = overlap
+        self.min_tokens = min_tokens
+        self.count_tokens = count_tokens or regex_token_count
+
+    def _units(self, blocks):
+        # (text, tokens, page, heading) per sentence, in document order
+        pieces = []
+        for block in blocks:
+            text = clean_text(block["text"])
+            if not text:
+                continue
+            sentences = [text] if block.get("heading") else split_sentences(text)
+            for sentence in sentences:
+                pieces.append((sentence, block.get("page"), bool(block.get("heading"))))
+        counts = self.count_tokens([text for text, _, _ in pieces])
+        for (text, page, heading), tokens in zip(pieces, counts):
+            if tokens <= self.max_tokens:
+                yield text, tokens, page, heading
+            else:
+                yield from self._split_long(text, tokens, page, heading)
+
+    def _split_long(self, text, tokens, page, heading):
+        # Cut at word boundaries, with a word budget scaled by the tokens per word of this text
+        words = text.split()
+        step = max(1, int(len(words) * self.max_tokens / tokens))
+        while words:
+            piece = words[:step]
+            count = self.count_tokens([" ".join(piece)])[0]
+            while count > self.max_tokens and len(piece) > 1:
+                piece = piece[:max(1, len(piece) * self.max_tokens // count)]
+                count = self.count_tokens([" ".join(piece)])[0]
+            yield " ".join(piece), count, page, heading
+            words = words[len(piece):]
+
+    def chunk(self, blocks, source=None):
+        """
+        Yields the passages of one file as {"text", "source", "page"} dicts, in document order.
+
+        :param blocks: The file's paragraphs as {"text"} dicts, with optional "page" (pdf) and
+                       "heading" (docx/odt) entries, as returned by process.extract_paragraphs.
+        :param source: Provenance of the file (its path relative to the uploaded folder).
+        """
+        current = []
+        size = 0
+        for unit in self._units(blocks):
+            text, tokens, page, heading = unit
+            if current and (size + tokens > self.max_tokens or (heading and size >= self.min_tokens)):
+                yield self._passage(current, source)
+                current, size = self._overlap(current, tokens, heading)
+            current.append(unit)
+            size += tokens
+        if current:
+            yield self._passage(current, source)
+
+    def _overlap(self, units, next_tokens, heading):
+        # Trailing sentences of the previous passage that fit the overlap and leave room for the next unit
+        if heading or not self.overlap:
+            return [], 0
+        carried = []
+        size = 0
+        for unit in reversed(units):
+            if unit[3] or size + unit[1] > self.overlap or size + unit[1] + next_tokens > self.max_tokens:
+                break
+            carried.insert(0, unit)
+            size += unit[1]
+        return carried, size
+
+    def _passage(self, units, source):
+        passage = {"text": " ".join(unit[0] for unit in units), "source": source}
+        pages = [unit[2] for unit in units if unit[2] is not None]
+        if pages:
+            passage["page"] = pages[0]
+        return passage
@@ -0,0 +1,685 @@
+import argparse
+import itertools
+import json
+import logging
+import os
+import time
+
+import faiss
+import numpy as np
+
+from .filters import MetadataIndex
+from .metrics import log_event, metrics
+
+INDEX_TYPES = ("flat", "ivf", "hnsw", "ivfpq")
+
+# cosine: inner product over L2-normalized vectors, ip: raw inner product, l2: euclidean distance
+METRICS = ("cosine", "ip", "l2")
+
+# How vectors are stored: float32 (4 bytes per dimension), float16 (2), sq8 (int8 scalar
+# quantization, 1), pq (product quantization, pq_m bytes per vector) or binary (random-rotation
+# sign bits compared by Hamming distance, binary_bits / 8 bytes per vector; flat index only)
+STORAGES = ("float32", "float16", "sq8", "pq", "binary")
+
+_SQ_TYPES = {"float16": faiss.ScalarQuantizer.QT_fp16, "sq8": faiss.ScalarQuantizer.QT_8bit}
+
+# Build and search parameters of the approximate indexes, overridable through index_params
+DEFAULT_INDEX_PARAMS = {
+    "nlist": 256,  # ivf/ivfpq: number of coarse clusters
+    "nprobe": 16,  # ivf/ivfpq: clusters visited per query
+    "pq_m": None,  # ivfpq: sub-quantizers, defaults to the largest of 64/48/32/16/8 dividing the dimension
+    "pq_nbits": 8,  # ivfpq: bits per sub-quantizer code
+    "hnsw_m": 32,  # hnsw: neighbours per node
+    "ef_construction": 40,  # hnsw: candidate list size while building
+    "ef_search": 64,  # hnsw: candidate list size while searching
+    "train_size": None,  # vectors sampled for training, defaults to 64 per cluster (and enough for the PQ codebooks)
+    "storage": "float32",  # vector encoding, see STORAGES
+    "binary_bits": None,  # binary storage: bits per vector, defaults to the dimension
+    "rescore": 0,  # compressed storage: rescore rescore * k candidates with the float32 vectors, 0 disables
+}
+
+
+def index_params_with_defaults(index_params=None):
+    params = dict(DEFAULT_INDEX_PARAMS)
+    params.update(index_params or {})
+    if params["train_size"] is None:
+        params["train_size"] = max(64 * params["nlist"], 40 * 2 ** params["pq_nbits"])
+    return params
+
+
+def faiss_metric(metric):
+    if metric not in METRICS:
+        raise ValueError(f"Unknown metric '{metric}', expected one of {METRICS}")
+    return faiss.METRIC_L2 if metric == "l2" else faiss.METRIC_INNER_PRODUCT
+
+
+def _pq_m(dim, params):
+    return params["pq_m"] or next((m for m in (64, 48, 32, 16, 8) if dim % m == 0), 1)
+
+
+def make_index(dim, index_type="flat", index_params=None, use_gpu=False, metric="cosine"):
+    """
+    Creates an empty faiss index.
+
+    :param dim: Dimension of the embeddings.
+    :param index_type: "flat" (exact), "ivf" (IVFFlat), "hnsw" or "ivfpq" (compressed codes).
+    :param index_params: Overrides of DEFAULT_INDEX_PARAMS; "storage" picks the vector
+                         encoding of the flat, ivf and hnsw types (ivfpq always stores PQ codes).
+    :param use_gpu: Move the index to the first GPU when faiss supports it for this type.
+    :param metric: "cosine", "ip" or "l2"; cosine and ip use an inner-product index.
+    """
+    params = index_params_with_defaults(index_params)
+    faiss_metric_type = faiss_metric(metric)
+    storage = params["storage"]
+    if storage not in STORAGES:
+        raise ValueError(f"Unknown storage '{storage}', expected one of {STORAGES}")
+    if storage == "binary" and index_type != "flat":
+        raise ValueError("Binary storage is only available with the flat index type")
+    if index_type == "flat":
+        if storage == "float32":
+            index = faiss.IndexFlat(dim, faiss_metric_type)
+        elif storage == "pq":
+            index = faiss.IndexPQ(dim, _pq_m(dim, params), params["pq_nbits"], faiss_metric_type)
+        elif storage == "binary":
+            # Random rotation then one sign bit per dimension; no training needed
+            index = faiss.IndexLSH(dim, params["binary_bits"] or dim, True, False)
+        else:
+            index = faiss.IndexScalarQuantizer(dim, _SQ_TYPES[storage], faiss_metric_type)
+    elif index_type == "ivf":
+        quantizer = faiss.IndexFlat(dim, faiss_metric_type)
+        if storage == "float32":
+            index = faiss.IndexIVFFlat(quantizer, dim, params["nlist"], faiss_metric_type)
+        elif storage == "pq":
+            index = faiss.IndexIVFPQ(quantizer, dim, params["nlist"], _pq_m(dim, params), params["pq_nbits"], faiss_metric_type)
+        else:
+            index = faiss.IndexIVFScalarQuantizer(quantizer, dim, params["nlist"], _SQ_TYPES[storage], faiss_metric_type)
+    elif index_type == "hnsw":
+        if storage == "float32":
+            index = faiss.IndexHNSWFlat(dim, params["hnsw_m"], faiss_metric_type)
+        elif storage == "pq":
+            index = faiss.IndexHNSWPQ(dim, _pq_m(dim, params), params["hnsw_m"], params["pq_nbits"], faiss_metric_type)
+        else:
+            index = faiss.IndexHNSWSQ(dim, _SQ_TYPES[storage], params["hnsw_m"], faiss_metric_type)
+        index.hnsw.efConstruction = params["ef_construction"]
+    elif index_type == "ivfpq":
+        index = faiss.IndexIVFPQ(faiss.IndexFlat(dim, faiss_metric_type), dim, params["nlist"], _pq_m(dim, params), params["pq_nbits"], faiss_metric_type)
+    else:
+        raise ValueError(f"Unknown index type '{index_type}', expected one of {INDEX_TYPES}")
+    set_search_params(index, params)
+
+    if use_gpu and index_type != "hnsw" and storage != "binary":
+        index = faiss.index_cpu_to_gpu(faiss.StandardGpuResources(), 0, index)
+    return index
+
+
+def set_search_params(index, index_params):
+    """Applies the search-time parameters (nprobe, ef_search) that are relevant to the index."""
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None and index_params.get("nprobe") is not None:
+        ivf.nprobe = index_params["nprobe"]
+    if isinstance(index, faiss.IndexIDMap):
+        index = faiss.downcast_index(index.index)
+    hnsw = getattr(index, "hnsw", None)
+    if hnsw is not None and index_params.get("ef_search") is not None:
+        hnsw.efSearch = index_params["ef_search"]
+
+
+def normalize_inplace(embeddings):
+    """L2-normalizes the rows of a float32 array in place; zero rows are left as zeros."""
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    np.maximum(norms, np.finfo(np.float32).tiny, out=norms)
+    embeddings /= norms
+    return embeddings
+
+
+def _stores_ids(index):
+    # IVF indexes keep the ids given to add_with_ids in their inverted lists; IndexIDMap must
+    # not wrap them, as its remove_ids assumes the wrapped index renumbers remaining vectors
+    return isinstance(index, faiss.IndexIDMap) or faiss.try_extract_index_ivf(index) is not None
+
+
+def _binary_bits(index):
+    # Bits per code of a binary (IndexLSH) index, whose search returns Hamming distances; else None
+    if isinstance(index, faiss.IndexIDMap):
+        index = faiss.downcast_index(index.index)
+    return index.nbits if isinstance(index, faiss.IndexLSH) else None
+
+
+def _search_parameters(index, selector):
+    # Search parameters restricting a search to selector; IVF and HNSW ones must repeat the
+    # index's own nprobe/efSearch, which they otherwise reset to their defaults
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        return faiss.SearchParametersIVF(sel=selector, nprobe=ivf.nprobe)
+    if isinstance(index, faiss.IndexIDMap):
+        index = faiss.downcast_index(index.index)
+    hnsw = getattr(index, "hnsw", None)
+    if hnsw is not None:
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=hnsw.efSearch)
+    return faiss.SearchParameters(sel=selector)
+
+
+def _supports_selector(index):
+    # Flat PQ and binary (LSH) indexes ignore the selector of their search parameters, GPU indexes reject it
+    if isinstance(index, faiss.IndexIDMap):
+        index = faiss.downcast_index(index.index)
+    return not isinstance(index, (faiss.IndexPQ, faiss.IndexLSH)) and "Gpu" not in type(index).__name__
+
+
+def _read_index(path, mmap):
+    if not mmap:
+        return faiss.read_index(path)
+    # IO_FLAG_MMAP_IFC maps flat codes, IO_FLAG_MMAP maps inverted lists; older faiss builds lack
+    # the former, and IVF indexes refuse the combination
+    try:
+        return faiss.read_index(path, faiss.IO_FLAG_MMAP | getattr(faiss, "IO_FLAG_MMAP_IFC", 0))
+    except RuntimeError:
+        return faiss.read_index(path, faiss.IO_FLAG_MMAP)
+
+
+class FaissIndex:
+    def __init__(self, key, index=None, metric="cosine", train_size=None, rescore=0, metadata=None):
+        """
+        Faiss index with the document keys kept in a compact array.
+
+        Drop-in replacement for cherche's Faiss index (same add/__call__/len interface and
+        output format) that can be saved and memory-mapped back without re-encoding.
+        Indexes that need training (IVF, PQ) buffer the first train_size vectors, train on
+        them and then index incrementally.
+
+        With the cosine metric, vectors are normalized once, in place, as they are added and
+        searched with inner product, so similarities are exact cosines. Arrays passed to add
+        and __call__ may therefore be modified.
+
+        Every added vector gets a slot, its position in the keys array, which is also its id
+        in the faiss index (IVF indexes store ids themselves, others are wrapped in an
+        IndexIDMap). remove only marks slots as deleted and searches skip them; compact later
+        drops them from the index.
+
+        With compressed storage (see STORAGES), rescore > 0 keeps the float32 vectors by slot
+        as well: a search fetches rescore * k candidates from the compressed index and ranks
+        them by their exact similarity. save writes those vectors next to the index and load
+        memory-maps them, so only the rescored rows are read into RAM.
+
+        With a metadata index, searches take a where clause (see filters.MetadataIndex): it is
+        compiled to a bitmap over the slots that faiss applies while searching, through an
+        IDSelectorBitmap, so a filtered search returns k hits without over-fetching.
+
+        :param key: Identifier field of the documents.
+        :param index: Faiss index storing the embeddings, built by make_index with the same metric.
+        :param metric: "cosine", "ip" or "l2".
+        :param train_size: Number of vectors to collect before training an untrained index.
+        :param rescore: Candidates fetched per result for exact float32 rescoring, 0 disables it.
+        :param metadata: filters.MetadataIndex filled with the documents as they are added, or None.
+        """
+        faiss_metric(metric)
+        if index is not None and index.ntotal == 0 and not _stores_ids(index):
+            index = faiss.IndexIDMap(index)
+        self.key = key
+        self.index = index
+        self.metric = metric
+        self.normalize = metric == "cosine"
+        self.train_size = train_size or DEFAULT_INDEX_PARAMS["nlist"] * 64
+        self._keys = []
+        self._keys_array = None
+        self._pending = []
+        self._pending_size = 0
+        self._deleted = set()  # Slots removed from the documents but still in the index
+        self._slots = None  # Key -> slot of the live documents, built on the first change
+        self._mmapped = None  # Path of the file the index is memory-mapped from
+        self.rescore = rescore
+        self._vectors = []  # float32 vectors by slot, kept for rescoring
+        self._vectors_array = None
+        self.metadata = metadata
+
+    def __len__(self):
+        return (self.index.ntotal if self.index is not None else 0) + self._pending_size - len(self._deleted)
+
+    @property
+    def keys(self):
+        if self._keys:
+            new_keys = np.asarray(self._keys, dtype=np.int64 if all(isinstance(key, int) for key in self._keys) else object)
+            self._keys_array = new_keys if self._keys_array is None else np.concatenate([self._keys_array, new_keys])
+            self._keys = []
+        return self._keys_array if self._keys_array is not None else np.zeros(0, dtype=np.int64)
+
+    @property
+    def vectors(self):
+        """float32 vectors by slot when rescoring is enabled, or None."""
+        if self._vectors:
+            new_vectors = np.concatenate(self._vectors)
+            self._vectors_array = new_vectors if self._vectors_array is None else np.concatenate([self._vectors_array, new_vectors])
+            self._vectors = []
+        return self._vectors_array
+
+    @property
+    def deleted_fraction(self):
+        """Share of the indexed vectors that belong to removed documents."""
+        total = (self.index.ntotal if self.index is not None else 0) + self._pending_size
+        return len(self._deleted) / total if total else 0.0
+
+    def _prepare(self, embeddings):
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        if embeddings.ndim == 1:
+            embeddings = embeddings.reshape(1, -1)
+        if self.normalize:
+            normalize_inplace(embeddings)
+        return embeddings
+
+    def _new_flat_index(self, dim):
+        return faiss.IndexIDMap(faiss.IndexFlat(dim, faiss_metric(self.metric)))
+
+    def _similarity(self, score, binary_bits=None):
+        if binary_bits:
+            # Hamming distance between sign codes, mapped to [-1, 1] like a cosine
+            return 1 - 2 * float(score) / binary_bits
+        # Inner products are already similarities; distances are mapped to (0, 1] as cherche does
+        return 1 / (1 + score) if self.metric == "l2" else score
+
+    def _slot_map(self):
+        if self._slots is None:
+            self._slots = {key: slot for slot, key in enumerate(self.keys.tolist()) if slot not in self._deleted}
+        return self._slots
+
+    def _writable(self):
+        # Memory-mapped vectors are read-only and faiss aborts on any change, so read them into
+        # RAM first; the index is unchanged since it was loaded
+        if self._mmapped:
+            self.index = _read_index(self._mmapped, mmap=False)
+            self._mmapped = None
+
+    def _add_with_ids(self, embeddings, ids):
+        if _stores_ids(self.index):
+            self.index.add_with_ids(embeddings, ids)
+        else:
+            # Indexes saved before ids were stored number vectors in insertion order, like the slots
+            self.index.add(embeddings)
+
+    def add(self, documents, embeddings):
+        embeddings = self._prepare(embeddings)
+        if self.index is None:
+            self.index = self._new_flat_index(embeddings.shape[1])
+        self._writable()
+        first_slot = len(self._keys) + (len(self._keys_array) if self._keys_array is not None else 0)
+        keys = [document[self.key] for document in documents]
+        self._keys.extend(keys)
+        if self.rescore:
+            self._vectors.append(embeddings)
+        if self.metadata is not None:
+            self.metadata.append(documents)
+        metrics.count("indexed_vectors", len(keys))
+        if self._slots is not None:
+            self._slots.update(zip(keys, range(first_slot, first_slot + len(keys))))
+        ids = np.arange(first_slot, first_slot + len(embeddings), dtype=np.int64)
+        if self.index.is_trained:
+            self._add_with_ids(embeddings, ids)
+        else:
+            self._pending.append((ids, embeddings))
+            self._pending_size += len(embeddings)
+            if self._pending_size >= self.train_size:
+                self.train()
+        return self
+
+    def remove(self, keys):
+        """
+        Removes the documents with the given keys; unknown keys are ignored.
+
+        :return: Number of documents removed.
+        """
+        slots = self._slot_map()
+        removed = 0
+        for key in keys:
+            slot = slots.pop(key, None)
+            if slot is not None:
+                self._deleted.add(slot)
+                removed += 1
+        return removed
+
+    def train(self):
+        """Trains the index on a sample of the buffered vectors and indexes them."""
+        if not self._pending:
+            return
+        ids = np.concatenate([ids for ids, _ in self._pending])
+        embeddings = np.concatenate([embeddings for _, embeddings in self._pending])
+        self._pending, self._pending_size = [], 0
+        sample = embeddings
+        if len(embeddings) > self.train_size:
+            sample = embeddings[np.random.default_rng(0).choice(len(embeddings), self.train_size, replace=False)]
+        try:
+            self.index.train(sample)
+        except RuntimeError as e:
+            # Too few vectors for the requested clusters: an exact index is the right choice anyway
+            log_event(
+                "train_fallback", level=logging.WARNING, index=type(self.index).__name__, vectors=len(sample),
+                message=f"Could not train the index, using a flat index: {e}",
+            )
+            self.index = self._new_flat_index(embeddings.shape[1])
+        self._add_with_ids(embeddings, ids)
+
+    def compact(self):
+        """
+        Drops the vectors of removed documents from the index so that searches no longer skip them.
+
+        Flat and IVF indexes remove them in place; HNSW graphs, and flat indexes saved before
+        ids were stored, are rebuilt from their reconstructed vectors.
+        """
+        self.train()
+        if not self._deleted:
+            return
+        self._writable()
+        deleted = np.fromiter(self._deleted, dtype=np.int64, count=len(self._deleted))
+        if _stores_ids(self.index):
+            try:
+                self.index.remove_ids(deleted)
+                self._deleted = set()
+                return
+            except RuntimeError:
+                pass
+        self._rebuild(deleted)
+
+    def _rebuild(self, deleted):
+        if isinstance(self.index, faiss.IndexIDMap):
+            base = faiss.downcast_index(self.index.index)
+            slots = faiss.vector_to_array(self.index.id_map)
+        else:
+            base = self.index
+            slots = np.arange(self.index.ntotal, dtype=np.int64)
+        live = ~np.isin(slots, deleted)
+        embeddings = base.reconstruct_n(0, base.ntotal)[live]
+        keys = self.keys[slots[live]]
+        if self.vectors is not None:
+            self._vectors_array = np.ascontiguousarray(self.vectors[slots[live]])
+        if self.metadata is not None:
+            self.metadata = self.metadata.take(slots[live])
+        index = faiss.clone_index(base)
+        index.reset()
+        self.index = faiss.IndexIDMap(index)
+        # Slots are renumbered from zero, in the order of the surviving vectors
+        self.index.add_with_ids(embeddings, np.arange(len(embeddings), dtype=np.int64))
+        self._keys_array = np.asarray(keys)
+        self._deleted = set()
+        self._slots = None
+
+    def _allowed(self, where):
+        # Bitmap of the live slots matching where
+        if self.metadata is None:
+            raise ValueError("This index has no metadata to filter on; build it with a MetadataIndex")
+        allowed = self.metadata.mask(where).copy()
+        if self._deleted:
+            allowed[np.fromiter(self._deleted, dtype=np.int64, count=len(self._deleted))] = False
+        return allowed
+
+    def __call__(self, embeddings, k=None, where=None):
+        """
+        Searches the k nearest documents of each embedding.
+
+        :param where: Metadata filter, see filters.MetadataIndex; needs a metadata index.
+        :return: One list of {key, "similarity"} hits per embedding, best first.
+        """
+        if self._pending:
+            self.train()
+        if k is None:
+            k = len(self)
+        keys = self.keys
+        vectors = self.vectors if self.rescore else None
+        # Indexes saved without their vectors, or before rescoring was enabled, are not rescored
+        rescore = vectors is not None and len(vectors) == len(keys)
+        embeddings = self._prepare(embeddings)
+        params = None
+        if where is None:
+            # Removed documents may still be among the nearest vectors, so look past them
+            fetch = min((k * self.rescore if rescore else k) + len(self._deleted), self.index.ntotal)
+            deleted = self._deleted
+            keep = lambda idx: idx > -1 and idx not in deleted
+        else:
+            allowed = self._allowed(where)
+            keep = lambda idx: idx > -1 and allowed[idx]
+            fetch = min(k * self.rescore if rescore else k, int(allowed.sum()))
+            if _supports_selector(self.index):
+                # The selector skips removed slots too; bits must outlive the search
+                bits = np.packbits(allowed, bitorder="little")
+                params = _search_parameters(self.index, faiss.IDSelectorBitmap(len(allowed), faiss.swig_ptr(bits)))
+            elif fetch > 0:
+                # Rank every vector and keep the allowed ones
+                fetch = self.index.ntotal
+        if fetch <= 0:
+            return [[] for _ in embeddings]
+        with metrics.stage("faiss_search"):
+            if params is None:
+                distances, indexes = self.index.search(embeddings, fetch)
+            else:
+                distances, indexes = self.index.search(embeddings, fetch, params=params)
+        metrics.count("searched_queries", len(embeddings))
+        # Upper bound: approximate indexes visit only part of the vectors
+        metrics.count("searched_vectors", len(embeddings) * self.index.ntotal)
+        binary_bits = _binary_bits(self.index)
+        rank = []
+        for query, distance, index in zip(embeddings, distances, indexes):
+            if rescore:
+                slots = np.array([idx for idx in index if keep(idx)], dtype=np.int64)
+                distance, index = self._rescore(query, slots)
+                hits = zip(distance[:k], index[:k])
+                similarity = self._similarity
+            else:
+                hits = ((d, idx) for d, idx in zip(distance, index) if keep(idx))
+                similarity = lambda d: self._similarity(d, binary_bits)
+            rank.append([
+                {self.key: keys[idx].item() if keys.dtype != object else keys[idx], "similarity": float(similarity(d))}
+                for d, idx in itertools.islice(hits, k)
+            ])
+        return rank
+
+    def _rescore(self, query, slots):
+        # Exact scores of the candidates, best first, in the index's own units (squared distance for l2)
+        if not len(slots):
+            return np.zeros(0, dtype=np.float32), slots
+        order = np.argsort(slots)  # sorted rows read memory-mapped vectors sequentially
+        candidates = np.asarray(self.vectors[slots[order]], dtype=np.float32)
+        slots = slots[order]
+        if self.metric == "l2":
+            scores = ((candidates - query) ** 2).sum(axis=1)
+            best = np.argsort(scores, kind="stable")
+        else:
+            scores = candidates @ query
+            best = np.argsort(-scores, kind="stable")
+        return scores[best], slots[best]
+
+    def save(self, path):
+        """Writes the faiss index, the document keys and the settings to the directory path."""
+        os.makedirs(path, exist_ok=True)
+        self.train()
+        index = self.index
+        if "Gpu" in type(index).__name__:
+            index = faiss.index_gpu_to_cpu(index)
+        faiss.write_index(index, os.path.join(path, "index.faiss"))
+        keys = self.keys
+        if keys.dtype == object:
+            with open(os.path.join(path, "keys.json"), "w") as f:
+                json.dump(keys.tolist(), f)
+        else:
+            np.save(os.path.join(path, "keys.npy"), keys)
+        if self.vectors is not None:
+            np.save(os.path.join(path, "vectors.npy"), self.vectors)
+        if self.metadata is not None:
+            self.metadata.save(os.path.join(path, "metadata"))
+        with open(os.path.join(path, "faiss.json"), "w") as f:
+            json.dump({
+                "key": self.key,
+                "metric": self.metric,
+                "normalize": self.normalize,
+                "train_size": self.train_size,
+                "deleted": sorted(int(slot) for slot in self._deleted),
+                "rescore": self.rescore,
+            }, f)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Loads an index written by save.
+
+        :param path: Directory passed to save.
+        :param mmap: Memory-map the vectors and keys instead of reading them into RAM.
+        """
+        with open(os.path.join(path, "faiss.json"), "r") as f:
+            settings = json.load(f)
+        index = _read_index(os.path.join(path, "index.faiss"), mmap)
+        # Indexes saved before metrics existed are normalized L2 indexes
+        loaded = cls(key=settings["key"], index=index, metric=settings.get("metric", "l2"), train_size=settings.get("train_size"), rescore=settings.get("rescore", 0))
+        loaded.normalize = settings["normalize"]
+        loaded._deleted = set(settings.get("deleted", []))
+        if mmap:
+            loaded._mmapped = os.path.join(path, "index.faiss")
+        if os.path.exists(os.path.join(path, "keys.npy")):
+            loaded._keys_array = np.load(os.path.join(path, "keys.npy"), mmap_mode="r" if mmap else None)
+        else:
+            with open(os.path.join(path, "keys.json"), "r") as f:
+                loaded._keys_array = np.asarray(json.load(f), dtype=object)
+        if os.path.exists(os.path.join(path, "vectors.npy")):
+            loaded._vectors_array = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r" if mmap else None)
+        if os.path.exists(os.path.join(path, "metadata")):
+            loaded.metadata = MetadataIndex.load(os.path.join(path, "metadata"))
+        return loaded
+
+
+def recall_report(embeddings, queries, k=10, index_types=INDEX_TYPES, sweeps=None, index_params=None, metric="cosine"):
+    """
+    Measures recall@k and query latency of the approximate indexes against the exact flat index.
+
+    Each index type is built once over the embeddings and then searched with every value
+    of its search parameter, so operating points can be compared directly.
+
+    :param embeddings: float32 array of corpus embeddings.
+    :param queries: float32 array of query embeddings.
+    :param k: Number of neighbours compared with the exact result.
+    :param index_types: Index types to evaluate.
+    :param sweeps: {index_type: (param name, values)} search parameter sweeps.
+    :param index_params: Build parameters passed to make_index.
+    :param metric: Similarity metric of all indexes, including the exact reference.
+    :return: List of dicts with index_type, the parameter value, build_seconds, recall and
+             latency_ms (mean and p99 of single-query searches).
+    """
+    sweeps = sweeps or {
+        "ivf": ("nprobe", [1, 4, 16, 64]),
+        "ivfpq": ("nprobe", [1, 4, 16, 64]),
+        "hnsw": ("ef_search", [16, 32, 64, 128, 256]),
+    }
+    embeddings = np.array(embeddings, dtype=np.float32)
+    queries = np.array(queries, dtype=np.float32)
+    if metric == "cosine":
+        normalize_inplace(embeddings)
+        normalize_inplace(queries)
+    params = index_params_with_defaults(index_params)
+
+    exact = faiss.IndexFlat(embeddings.shape[1], faiss_metric(metric))
+    exact.add(embeddings)
+    _, truth = exact.search(queries, k)
+
+    report = []
+    for index_type in index_types:
+        start = time.perf_counter()
+        wrapper = FaissIndex(key="id", index=make_index(embeddings.shape[1], index_type, params, metric=metric), metric=metric, train_size=params["train_size"])
+        wrapper.normalize = False  # already normalized above
+        wrapper.add(({"id": i} for i in range(len(embeddings))), embeddings)
+        wrapper.train()
+        build_seconds = time.perf_counter() - start
+
+        name, values = sweeps.get(index_type, (None, [None]))
+        for value in values:
+            if name is not None:
+                set_search_params(wrapper.index, {name: value})
+            latencies = []
+            found = np.empty_like(truth)
+            for i in range(len(queries)):
+                start = time.perf_counter()
+                _, found[i:i + 1] = wrapper.index.search(queries[i:i + 1], k)
+                latencies.append((time.perf_counter() - start) * 1000)
+            recall = np.mean([len(set(a) & set(b)) / k for a, b in zip(found, truth)])
+            report.append({
+                "index_type": index_type,
+                "param": name,
+                "value": value,
+                "build_seconds": build_seconds,
+                "recall": float(recall),
+                "latency_ms": float(np.mean(latencies)),
+                "latency_p99_ms": float(np.percentile(latencies, 99)),
+            })
+    return report
+
+
+def storage_report(embeddings, queries, k=10, storages=STORAGES, rescore=4, index_type="flat", index_params=None, metric="cosine"):
+    """
+    Measures the memory footprint and recall@k of each storage against exact float32 search,
+    without and with float32 rescoring of rescore * k candidates.
+
+    :param embeddings: float32 array of corpus embeddings.
+    :param queries: float32 array of query embeddings.
+    :param storages: Storages to evaluate, see STORAGES.
+    :param rescore: Candidates per result when rescoring; rows with rescore 0 are always included.
+    :param index_type: Index type of every storage; binary is only measured with flat.
+    :return: List of dicts with storage, rescore, bytes_per_vector (serialized index, without
+             the float32 vectors rescoring reads from disk), compression against float32
+             vectors, recall and latency_ms (mean of single-query searches).
+    """
+    embeddings = np.array(embeddings, dtype=np.float32)
+    queries = np.array(queries, dtype=np.float32)
+    if metric == "cosine":
+        normalize_inplace(embeddings)
+        normalize_inplace(queries)
+    exact = faiss.IndexFlat(embeddings.shape[1], faiss_metric(metric))
+    exact.add(embeddings)
+    _, truth = exact.search(queries, k)
+
+    report = []
+    for storage in storages:
+        if storage == "binary" and index_type != "flat":
+            continue
+        params = index_params_with_defaults(dict(index_params or {}, storage=storage))
+        wrapper = FaissIndex(key="id", index=make_index(embeddings.shape[1], index_type, params, metric=metric), metric=metric, train_size=params["train_size"], rescore=rescore)
+        wrapper.normalize = False  # already normalized above
+        wrapper.add([{"id": i} for i in range(len(embeddings))], embeddings)
+        wrapper.train()
+        bytes_per_vector = len(faiss.serialize_index(wrapper.index)) / len(embeddings)
+        for factor in sorted({0, rescore}):
+            wrapper.rescore = factor
+            latencies = []
+            recalls = []
+            for query, expected in zip(queries, truth):
+                start = time.perf_counter()
+                hits = wrapper(query.reshape(1, -1), k=k)[0]
+                latencies.append((time.perf_counter() - start) * 1000)
+                recalls.append(len({hit["id"] for hit in hits} & set(expected.tolist())) / k)
+            report.append({
+                "storage": storage,
+                "index_type": index_type,
+                "rescore": factor,
+                "bytes_per_vector": bytes_per_vector,
+                "compression": embeddings.shape[1] * 4 / bytes_per_vector,
+                "recall": float(np.mean(recalls)),
+                "latency_ms": float(np.mean(latencies)),
+            })
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall@k vs. latency of approximate faiss indexes against the exact flat index.")
+    parser.add_argument('vectors', type=str, help="Raw float32 embedding file, e.g. vectors.f32 from the embedding cache")
+    parser.add_argument('--dim', type=int, required=True, help="Embedding dimension")
+    parser.add_argument('--queries', type=int, default=1000, help="Number of held-out vectors used as queries")
+    parser.add_argument('--k', type=int, default=10, help="Number of neighbours")
+    parser.add_argument('--nlist', type=int, default=DEFAULT_INDEX_PARAMS["nlist"], help="Clusters of the IVF indexes")
+    parser.add_argument('--metric', choices=METRICS, default="cosine", help="Similarity metric")
+    parser.add_argument('--storage', action='store_true', help="Compare vector storages (memory, recall) instead of index types")
+    parser.add_argument('--index-type', choices=INDEX_TYPES, default="flat", help="Index type of the --storage comparison")
+    parser.add_argument('--rescore', type=int, default=4, help="Candidates per result rescored with float32 vectors in the --storage comparison")
+    args = parser.parse_args()
+
+    vectors = np.fromfile(args.vectors, dtype=np.float32).reshape(-1, args.dim)
+    if args.storage:
+        report = storage_report(vectors[:-args.queries], vectors[-args.queries:], k=args.k, rescore=args.rescore, index_type=args.index_type, index_params={"nlist": args.nlist}, metric=args.metric)
+    else:
+        report = recall_report(vectors[:-args.queries], vectors[-args.queries:], k=args.k, index_params={"nlist": args.nlist}, metric=args.metric)
+    for row in report:
+        print(json.dumps(row))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,351 @@
+import json
+import os
+import shutil
+from array import array
+
+import numpy as np
+
+STORE_VERSION = 1
+
+STORE_FILES = ("store.json", "ids.npy", "ids.json", "text.bin", "text_offsets.npy", "has_text.npy", "extra.bin", "extra_offsets.npy")
+
+
+def _is_int(value):
+    return isinstance(value, (int, np.integer)) and not isinstance(value, bool)
+
+
+def _as_id(value):
+    # NumPy integers from id arrays come back as Python ints, like the ids of the documents
+    return value.item() if isinstance(value, np.generic) else value
+
+
+class _ColumnWriter:
+    def __init__(self, handle=None):
+        # UTF-8 values appended to a file, or to memory without one; offsets[i]:offsets[i + 1] is value i
+        self.handle = handle
+        self.buffer = bytearray() if handle is None else None
+        self.offsets = array("q", [0])
+
+    def append(self, text):
+        data = text.encode("utf-8")
+        if self.handle is None:
+            self.buffer.extend(data)
+        else:
+            self.handle.write(data)
+        self.offsets.append(self.offsets[-1] + len(data))
+
+
+def _write_columns(documents, key, text_field, text_handle=None, extra_handle=None):
+    text = _ColumnWriter(text_handle)
+    extra = _ColumnWriter(extra_handle)
+    ids = []
+    has_text = array("b")
+    for document in documents:
+        ids.append(document[key])
+        value = document.get(text_field)
+        has_text.append(isinstance(value, str))
+        text.append(value if isinstance(value, str) else "")
+        fields = {name: field for name, field in document.items() if name != key and not (name == text_field and isinstance(field, str))}
+        extra.append(json.dumps(fields, ensure_ascii=False, separators=(",", ":")) if fields else "")
+    if all(_is_int(value) for value in ids):
+        ids = np.asarray(ids, dtype=np.int64)
+    return ids, text, extra, np.frombuffer(has_text, dtype=np.int8).astype(bool)
+
+
+class KeyView:
+    def __init__(self, key, ids):
+        """
+        Read-only list of {key: id} dicts over an array of ids, in place of the one-entry dict
+        per document that cherche's TfIdf and BM25 keep to map matrix columns to ids.
+        """
+        self.key = key
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, position):
+        return {self.key: _as_id(self.ids[position])}
+
+    def __iter__(self):
+        for value in self.ids:
+            yield {self.key: _as_id(value)}
+
+
+class DocumentStore:
+    def __init__(self, ids, text_offsets, text, has_text, extra_offsets, extra, key="id", text_field="text", path=None, read_only=False):
+        """
+        Columnar, read-mostly document store shared by the retrievers of a corpus.
+
+        The text field of every document is held in a single UTF-8 buffer sliced by an offsets
+        array, and the remaining fields as compact JSON in a second buffer, so a document costs
+        its bytes plus about 17 bytes instead of a dict and string objects (several hundred
+        bytes per paragraph). A store saved to disk is memory-mapped by load. Ids map to rows
+        in O(1): through a dense array when they are integers of a compact range (as the ids of
+        process.py, from 1), else a dict. Documents are only materialized as dicts when read.
+
+        Use build or load rather than this constructor. Documents added with extend go to an
+        in-memory tail and deleted or replaced ones are only hidden, until compact.
+
+        :param key: Identifier field of the documents.
+        :param text_field: Field held in the text column.
+        :param path: Directory the columns are mapped from, if any.
+        :param read_only: The files at path are shared (e.g. derived from an extracted data file
+                          and mapped by other retrievers and processes) and are never rewritten:
+                          compact builds a private copy in memory instead.
+        """
+        self.key = key
+        self.text_field = text_field
+        self.path = path
+        self.read_only = read_only
+        self._set_columns(ids, text_offsets, text, has_text, extra_offsets, extra)
+
+    def _set_columns(self, ids, text_offsets, text, has_text, extra_offsets, extra):
+        self._ids = ids
+        self._text_offsets = text_offsets
+        self._text = text
+        self._has_text = has_text
+        self._extra_offsets = extra_offsets
+        self._extra = extra
+        self._tail = []  # Documents added by extend, rows len(ids) onwards
+        self._overrides = {}  # id -> row of its latest version, or -1 once deleted
+        self._build_index()
+
+    def _build_index(self):
+        ids = self._ids
+        self._dense = None
+        self._index = None
+        if isinstance(ids, np.ndarray) and (not len(ids) or (ids.min() >= 0 and ids.max() < 2 * len(ids) + 1024)):
+            self._dense = np.full(int(ids.max()) + 1 if len(ids) else 0, -1, dtype=np.int64)
+            # Later rows win, as if the documents had been added one by one
+            self._dense[ids] = np.arange(len(ids))
+            self._live = int(np.count_nonzero(self._dense >= 0))
+        else:
+            self._index = {_as_id(value): row for row, value in enumerate(ids)}
+            self._live = len(self._index)
+
+    @classmethod
+    def build(cls, documents, path=None, key="id", text_field="text"):
+        """
+        Builds a store from any iterable of documents, read once.
+
+        :param path: Directory to write the columns to and map them from; in memory if None.
+        """
+        if isinstance(documents, DocumentStore):
+            return documents
+        if path is None:
+            ids, text, extra, has_text = _write_columns(documents, key, text_field)
+            return cls(
+                ids, np.frombuffer(text.offsets, dtype=np.int64), np.frombuffer(text.buffer, dtype=np.uint8), has_text,
+                np.frombuffer(extra.offsets, dtype=np.int64), np.frombuffer(extra.buffer, dtype=np.uint8), key=key, text_field=text_field,
+            )
+        os.makedirs(path, exist_ok=True)
+        for name in STORE_FILES:
+            if os.path.exists(os.path.join(path, name)):
+                os.remove(os.path.join(path, name))
+        with open(os.path.join(path, "text.bin"), "wb") as text_handle, open(os.path.join(path, "extra.bin"), "wb") as extra_handle:
+            ids, text, extra, has_text = _write_columns(documents, key, text_field, text_handle, extra_handle)
+        cls._write_arrays(path, ids, np.frombuffer(text.offsets, dtype=np.int64), has_text, np.frombuffer(extra.offsets, dtype=np.int64), key, text_field)
+        return cls.load(path)
+
+    @staticmethod
+    def _write_arrays(path, ids, text_offsets, has_text, extra_offsets, key, text_field):
+        if isinstance(ids, np.ndarray):
+            np.save(os.path.join(path, "ids.npy"), ids)
+        else:
+            with open(os.path.join(path, "ids.json"), "w") as f:
+                json.dump(ids, f)
+        np.save(os.path.join(path, "text_offsets.npy"), text_offsets)
+        np.save(os.path.join(path, "has_text.npy"), has_text)
+        np.save(os.path.join(path, "extra_offsets.npy"), extra_offsets)
+        # Written last: a directory without it is an interrupted build
+        with open(os.path.join(path, "store.json"), "w") as f:
+            json.dump({"version": STORE_VERSION, "key": key, "text_field": text_field, "rows": len(ids)}, f)
+
+    @classmethod
+    def load(cls, path, mmap=True, read_only=False):
+        """
+        Loads a store written by build or save, memory-mapping the columns unless mmap is False.
+
+        :param read_only: Never rewrite the files, see __init__.
+        """
+        with open(os.path.join(path, "store.json"), "r") as f:
+            meta = json.load(f)
+        mode = "r" if mmap else None
+        if os.path.exists(os.path.join(path, "ids.npy")):
+            ids = np.load(os.path.join(path, "ids.npy"), mmap_mode=mode)
+        else:
+            with open(os.path.join(path, "ids.json"), "r") as f:
+                ids = json.load(f)
+        return cls(
+            ids,
+            np.load(os.path.join(path, "text_offsets.npy"), mmap_mode=mode),
+            _load_buffer(os.path.join(path, "text.bin"), mmap),
+            np.load(os.path.join(path, "has_text.npy"), mmap_mode=mode),
+            np.load(os.path.join(path, "extra_offsets.npy"), mmap_mode=mode),
+            _load_buffer(os.path.join(path, "extra.bin"), mmap),
+            key=meta["key"], text_field=meta["text_field"], path=path if mmap else None, read_only=read_only and mmap,
+        )
+
+    def save(self, path):
+        """Writes the current documents to the directory path, compacted; load maps them back."""
+        if path == self.path and not self._tail and not self._overrides:
+            return path
+        if path == self.path and self.read_only:
+            raise ValueError(f"The store at {path} is read-only; save it to another directory")
+        tmp_path = path + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        self.build(iter(self), path=tmp_path, key=self.key, text_field=self.text_field)
+        # Files mapped from the old directory stay readable after it is removed
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+        return path
+
+    def compact(self):
+        """
+        Drops deleted and replaced versions and folds the tail into the columns, on disk if the
+        store is mapped from there. A read-only store is copied on write: it is compacted into
+        memory and no longer mapped, leaving the shared files to their other readers.
+        """
+        if not self._tail and not self._overrides:
+            return self
+        if self.path is not None and not self.read_only:
+            compacted = DocumentStore.load(self.save(self.path))
+        else:
+            compacted = DocumentStore.build(iter(self), key=self.key, text_field=self.text_field)
+            self.path = None
+            self.read_only = False
+        self._set_columns(compacted._ids, compacted._text_offsets, compacted._text, compacted._has_text, compacted._extra_offsets, compacted._extra)
+        return self
+
+    def copy(self):
+        """A store over the same columns (mapped files are not copied) whose changes are its own."""
+        copied = DocumentStore.__new__(DocumentStore)
+        copied.__dict__.update(self.__dict__)
+        copied._tail = list(self._tail)
+        copied._overrides = dict(self._overrides)
+        return copied
+
+    @property
+    def rows(self):
+        """Number of rows, including versions deleted or replaced since the last compact."""
+        return len(self._ids) + len(self._tail)
+
+    def __len__(self):
+        return self._live
+
+    def row(self, key):
+        """Row of the current version of the document with id key, or None."""
+        row = self._overrides.get(key)
+        if row is not None:
+            return row if row >= 0 else None
+        if self._dense is not None:
+            if _is_int(key) and 0 <= key < len(self._dense):
+                row = int(self._dense[key])
+                return row if row >= 0 else None
+            return None
+        return self._index.get(key)
+
+    def __contains__(self, key):
+        return self.row(key) is not None
+
+    def id(self, row):
+        if row >= len(self._ids):
+            return self._tail[row - len(self._ids)][self.key]
+        return _as_id(self._ids[row])
+
+    def text(self, row):
+        """Text field of a row, without materializing the rest of the document."""
+        if row >= len(self._ids):
+            return self._tail[row - len(self._ids)].get(self.text_field, "")
+        return bytes(self._text[self._text_offsets[row]:self._text_offsets[row + 1]]).decode("utf-8")
+
+    def __getitem__(self, row):
+        """The document at row, as a new dict."""
+        if row >= len(self._ids):
+            return dict(self._tail[row - len(self._ids)])
+        document = {self.key: _as_id(self._ids[row])}
+        if self._has_text[row]:
+            document[self.text_field] = self.text(row)
+        start, end = self._extra_offsets[row], self._extra_offsets[row + 1]
+        if end > start:
+            document.update(json.loads(bytes(self._extra[start:end]).decode("utf-8")))
+        return document
+
+    def get(self, key, default=None):
+        """The current version of the document with id key, as a new dict, or default."""
+        row = self.row(key)
+        return default if row is None else self[row]
+
+    def __iter__(self):
+        """Yields the current documents in row order, materialized one at a time."""
+        for row in range(self.rows):
+            if not self._overrides or self.row(self.id(row)) == row:
+                yield self[row]
+
+    def ids(self):
+        """Ids of all rows; equal to the ids of the documents, in order, once compacted."""
+        if not self._tail:
+            return self._ids
+        tail = [document[self.key] for document in self._tail]
+        if isinstance(self._ids, np.ndarray) and all(_is_int(value) for value in tail):
+            return np.concatenate([self._ids, np.asarray(tail, dtype=np.int64)])
+        return [_as_id(value) for value in self._ids] + tail
+
+    def key_view(self):
+        """{key: id} per current document, see KeyView; compacts the store first if needed."""
+        if self.rows != len(self):
+            self.compact()
+        return KeyView(self.key, self.ids())
+
+    def extend(self, documents):
+        """Adds documents to the tail; a document replaces the current version with the same id unless equal to it."""
+        for document in documents:
+            key = document[self.key]
+            row = self.row(key)
+            if row is not None and self[row] == document:
+                continue
+            if row is None:
+                self._live += 1
+            self._overrides[key] = self.rows
+            self._tail.append(document)
+        return self
+
+    def delete(self, keys):
+        """Hides the documents with the given ids; unknown ids are ignored."""
+        for key in keys:
+            if self.row(key) is not None:
+                self._live -= 1
+                self._overrides[key] = -1
+        return self
+
+    def materialize(self, hits):
+        """
+        Merges the documents into retrieval hits ({key, "similarity"} dicts), for one list of
+        hits or one list per query. Hits whose document is unknown are left as they are.
+        """
+        if hits and isinstance(hits[0], list):
+            return [self.materialize(query_hits) for query_hits in hits]
+        return [{**self.get(hit[self.key], {}), **hit} for hit in hits]
+
+    def nbytes(self):
+        """Bytes of the columns, whether in memory or mapped."""
+        arrays = [self._text_offsets, self._text, self._has_text, self._extra_offsets, self._extra]
+        if isinstance(self._ids, np.ndarray):
+            arrays.append(self._ids)
+        if self._dense is not None:
+            arrays.append(self._dense)
+        return sum(array.nbytes for array in arrays)
+
+    def __reduce__(self):
+        # A store mapped from disk pickles as its path, so worker processes map the same files
+        if self.path is None or self._tail or self._overrides:
+            raise TypeError("only a compacted DocumentStore mapped from disk can be pickled; use save and load")
+        return DocumentStore.load, (self.path, True, self.read_only)
+
+
+def _load_buffer(path, mmap):
+    if not mmap or os.path.getsize(path) == 0:
+        with open(path, "rb") as f:
+            return np.frombuffer(f.read(), dtype=np.uint8)
+    return np.memmap(path, dtype=np.uint8, mode="r")
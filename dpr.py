@@ -1,58 +1,189 @@
-from cherche import retrieve
-from sentence_transformers import SentenceTransformer
-import faiss
+import json
+import os
+
+from .cache import DEFAULT_CACHE_DIR, QueryCache, get_cache, normalize_text
+from .docstore import DocumentStore
+from .models import acquire_model, embedding_dimension, release_models
+from .encoding import DEFAULT_WINDOW, iter_encoded, model_token_counter
+from .filters import DEFAULT_METADATA_FIELDS, MetadataIndex, where_key
+from .metrics import instrument_encoder, metrics
+from .utils import batched
 
 class DPRRetriever:
-    def __init__(self, documents, document_model="facebook-dpr-ctx_encoder-single-nq-base", query_model="facebook-dpr-question_encoder-single-nq-base", device="cpu"):
+    def __init__(self, documents, document_model="facebook-dpr-ctx_encoder-single-nq-base", query_model="facebook-dpr-question_encoder-single-nq-base", device="cpu", cache_dir=DEFAULT_CACHE_DIR, batch_size=64, encode_window=DEFAULT_WINDOW, index_type="flat", index_params=None, metric="cosine", query_cache_size=1024, query_cache_ttl=300, metadata_fields=DEFAULT_METADATA_FIELDS):
         """
         Initialize the DPRRetriever with a list of documents and DPR models for both documents and queries.
         
-        :param documents: List of documents where each document is a dictionary with an "id", "title", and "article".
+        :param documents: List of documents where each document is a dictionary with an "id", "title", and "article";
+                          any iterable, or a DocumentStore, which is kept to materialize hits.
         :param document_model: Name of the document encoder model from Sentence Transformers.
         :param query_model: Name of the query encoder model from Sentence Transformers.
         :param device: Device to run the models on ("cpu" or "cuda").
+        :param cache_dir: Directory of the on-disk embedding cache, or None to always encode.
+        :param batch_size: Number of documents encoded per model call; documents of similar length are batched together.
+        :param encode_window: Number of documents read and sorted by length at a time; documents may be any iterable.
+        :param index_type: Faiss index type: "flat" (exact), "ivf", "hnsw" or "ivfpq", see dense.make_index.
+        :param index_params: Build and search parameters of the index, see dense.DEFAULT_INDEX_PARAMS.
+        :param metric: Similarity metric: "cosine" (normalized inner product), "ip" or "l2".
+        :param query_cache_size: Number of query results (and, four times as many, query embeddings) kept in memory; 0 disables them.
+        :param query_cache_ttl: Seconds a cached query result stays valid, or None.
+        :param metadata_fields: Document fields that searches can filter on, see filters.MetadataIndex.
         """
-        self.documents = documents
+        # The index keeps the ids only; a list of documents is not held past indexing
+        self.documents = documents if isinstance(documents, DocumentStore) else None
         self.device = device
+        self.version = 0  # Part of the result cache keys; bump it when the index changes
+        self.query_cache = QueryCache(max_size=query_cache_size, ttl=query_cache_ttl, embedding_size=4 * query_cache_size)
+        self.document_model = document_model
+        self.query_model = query_model
         
-        # Load the document and query encoders
-        self.document_encoder = SentenceTransformer(document_model, device=device)
-        self.query_encoder = SentenceTransformer(query_model, device=device)
+        # Load the document and query encoders, shared with other retrievers in this process
+        self.document_encoder = acquire_model(self, document_model, device=device)
+        self.query_encoder = acquire_model(self, query_model, device=device)
+
+        # Document embeddings are cached on disk; query embeddings only in memory, in self.query_cache
+        self.cache = get_cache(cache_dir, document_model)
         
         # Get the embedding dimension from the document encoder
-        embedding_dim = self.document_encoder.encode("Test document").shape[0]
+        embedding_dim = embedding_dimension(self.document_encoder)
         
         # Create a Faiss index for storing document embeddings
-        if device == "cuda":
-            self.index = faiss.IndexFlatL2(embedding_dim)
-            self.index = faiss.index_cpu_to_gpu(faiss.StandardGpuResources(), 0, self.index)
-        else:
-            self.index = faiss.IndexFlatL2(embedding_dim)
+        from .dense import FaissIndex, index_params_with_defaults, make_index
+
+        index_params = index_params_with_defaults(index_params)
+        index = make_index(embedding_dim, index_type, index_params, use_gpu=device == "cuda", metric=metric)
+        self.index = FaissIndex(key="id", index=index, metric=metric, train_size=index_params["train_size"], rescore=index_params["rescore"], metadata=MetadataIndex(metadata_fields))
         
         # Initialize the retriever with the encoders and index
-        self.retriever = retrieve.DPR(
-            encoder=self.document_encoder.encode,
+        self.retriever = self._init_retriever()
+        
+        # Encode in batches of similar length, a window at a time so documents can be streamed from disk
+        with metrics.stage("index", method="dpr"):
+            text = lambda document: " ".join(document.get(field, "") for field in self.retriever.on)
+            for batch, embeddings in iter_encoded(documents, self.retriever.encoder, text, batch_size=batch_size, window=encode_window, count_tokens=model_token_counter(self.document_encoder)):
+                self.index.add(batch, embeddings)
+            self.index.train()
+            self.retriever.k = len(self.index)
+
+    def _init_retriever(self):
+        from cherche import retrieve
+
+        document_encoder = instrument_encoder(self.document_encoder.encode)
+        document_encoder = self.cache.wrap(document_encoder) if self.cache is not None else document_encoder
+        retriever = retrieve.DPR(
+            encoder=document_encoder,
             query_encoder=self.query_encoder.encode,
             key="id",
             on=["title", "article"],
-            index=self.index,
             normalize=True
         )
-        
-        # Add documents to the retriever
-        self.retriever = self.retriever.add(documents=documents)
+        # Swap cherche's index for one that can be saved and memory-mapped
+        retriever.index = self.index
+        return retriever
     
-    def retrieve(self, query, k=10):
+    def retrieve(self, query, k=10, where=None):
         """
         Retrieve the top k documents that are most similar to the query.
         
         :param query: A string or list of strings representing the query/queries.
         :param k: Number of top documents to retrieve.
+        :param where: Only retrieve documents whose metadata (e.g. {"source": ..., "page": {"$gte": 2}})
+                      matches, see filters.MetadataIndex; applied inside the FAISS search.
         :return: List of dictionaries with document IDs and their similarity scores.
         """
-        results = self.retriever(query, k=k)
+        # Repeated queries are answered from the result cache, and their embeddings from the query-embedding cache
+        normalized = normalize_text(query) if isinstance(query, str) else tuple(normalize_text(q) for q in query)
+        return self.query_cache.cached(("retrieve", normalized, k, self.version, where_key(where)), lambda: self._retrieve(query, k, where))
+
+    def _retrieve(self, query, k, where=None):
+        with metrics.stage("search", method="dpr"):
+            return self._search(query, k, where)
+
+    def _search(self, query, k, where=None):
+        queries = [query] if isinstance(query, str) else query
+        results = self.index(self.query_cache.encode(queries, self.query_encoder.encode), k=k, where=where)
+        return results[0] if isinstance(query, str) else results
+
+    def retrieve_batch(self, queries, k=10, batch_size=64, where=None):
+        """
+        Retrieve the top k documents for many queries, encoding them and searching the index batch by batch.
+        
+        :param queries: List of query strings.
+        :param k: Number of top documents to retrieve per query.
+        :param batch_size: Number of queries encoded by the query encoder and searched in a single index call.
+        :param where: Metadata filter of every query, see retrieve.
+        :return: One list of dictionaries with document IDs and similarity scores per query.
+        """
+        return self.query_cache.retrieve_batch(("batch", where_key(where)), self.version, list(queries), k, lambda missing: self._retrieve_batch(missing, k, batch_size, where))
+
+    def _retrieve_batch(self, queries, k, batch_size, where=None):
+        with metrics.stage("search", method="dpr"):
+            return self._search_batch(queries, k, batch_size, where)
+
+    def _search_batch(self, queries, k, batch_size, where=None):
+        results = []
+        for batch in batched(queries, batch_size):
+            query_embeddings = self.query_cache.encode(batch, lambda texts: self.query_encoder.encode(texts, batch_size=batch_size))
+            results.extend(self.index(query_embeddings, k=k, where=where))
         return results
 
+    def cache_stats(self):
+        """Hit rates of the result and query-embedding caches, and of the document embedding cache."""
+        stats = self.query_cache.stats()
+        if self.cache is not None:
+            stats["document_embeddings"] = self.cache.stats()
+        return stats
+
+    def close(self):
+        """
+        Release this retriever's references to the shared models. This also happens when the retriever is garbage collected.
+        """
+        release_models(self)
+
+    def save(self, path):
+        """
+        Save the index and document ids to a directory so the retriever can be loaded without re-encoding.
+        
+        :param path: Directory to write to.
+        """
+        self.index.save(path)
+        with open(os.path.join(path, "retriever.json"), "w") as f:
+            json.dump({"document_model": self.document_model, "query_model": self.query_model}, f)
+
+    @classmethod
+    def load(cls, path, mmap=True, device="cpu", cache_dir=DEFAULT_CACHE_DIR, query_cache_size=1024, query_cache_ttl=300):
+        """
+        Load a retriever written by save.
+        
+        :param path: Directory passed to save.
+        :param mmap: Memory-map the index instead of reading it into RAM.
+        :param device: Device to run the models on ("cpu" or "cuda").
+        :param cache_dir: Directory of the on-disk embedding cache, or None to always encode.
+        :param query_cache_size: Number of query results kept in memory, see __init__.
+        :param query_cache_ttl: Seconds a cached query result stays valid, or None.
+        """
+        with open(os.path.join(path, "retriever.json"), "r") as f:
+            settings = json.load(f)
+        self = cls.__new__(cls)
+        self.documents = None
+        self.device = device
+        self.version = 0
+        self.query_cache = QueryCache(max_size=query_cache_size, ttl=query_cache_ttl, embedding_size=4 * query_cache_size)
+        self.document_model = settings["document_model"]
+        self.query_model = settings["query_model"]
+        self.document_encoder = acquire_model(self, self.document_model, device=device)
+        self.query_encoder = acquire_model(self, self.query_model, device=device)
+        self.cache = get_cache(cache_dir, self.document_model)
+        from .dense import FaissIndex
+
+        self.index = FaissIndex.load(path, mmap=mmap and device != "cuda")
+        if device == "cuda":
+            import faiss
+
+            self.index.index = faiss.index_cpu_to_gpu(faiss.StandardGpuResources(), 0, self.index.index)
+        self.retriever = self._init_retriever()
+        return self
+
 ''' # Example usage
 documents = [
     {
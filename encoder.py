@@ -1,53 +1,181 @@
-from cherche import retrieve
-from sentence_transformers import SentenceTransformer
-import faiss
+import json
+import os
+
+from .cache import DEFAULT_CACHE_DIR, QueryCache, get_cache, normalize_text
+from .docstore import DocumentStore
+from .models import acquire_model, embedding_dimension, release_models
+from .encoding import DEFAULT_WINDOW, iter_encoded, model_token_counter
+from .filters import DEFAULT_METADATA_FIELDS, MetadataIndex, where_key
+from .metrics import instrument_encoder, metrics
+from .utils import batched
 
 class DocumentRetriever:
-    def __init__(self, documents, model_name="sentence-transformers/all-mpnet-base-v2", device="cpu"):
+    def __init__(self, documents, model_name="sentence-transformers/all-mpnet-base-v2", device="cpu", cache_dir=DEFAULT_CACHE_DIR, batch_size=64, encode_window=DEFAULT_WINDOW, index_type="flat", index_params=None, metric="cosine", query_cache_size=1024, query_cache_ttl=300, metadata_fields=DEFAULT_METADATA_FIELDS):
         """
         Initialize the DocumentRetriever with a list of documents and a sentence transformer model.
         
-        :param documents: List of documents where each document is a dictionary with an "id", "title", and "article".
+        :param documents: List of documents where each document is a dictionary with an "id", "title", and "article";
+                          any iterable, or a DocumentStore, which is kept to materialize hits.
         :param model_name: Name of the model from Sentence Transformers.
         :param device: Device to run the model on ("cpu" or "cuda").
+        :param cache_dir: Directory of the on-disk embedding cache, or None to always encode.
+        :param batch_size: Number of documents encoded per model call; documents of similar length are batched together.
+        :param encode_window: Number of documents read and sorted by length at a time; documents may be any iterable.
+        :param index_type: Faiss index type: "flat" (exact), "ivf", "hnsw" or "ivfpq", see dense.make_index.
+        :param index_params: Build and search parameters of the index, see dense.DEFAULT_INDEX_PARAMS.
+        :param metric: Similarity metric: "cosine" (normalized inner product), "ip" or "l2".
+        :param query_cache_size: Number of query results (and, four times as many, query embeddings) kept in memory; 0 disables them.
+        :param query_cache_ttl: Seconds a cached query result stays valid, or None.
+        :param metadata_fields: Document fields that searches can filter on, see filters.MetadataIndex.
         """
-        self.documents = documents
+        # The index keeps the ids only; a list of documents is not held past indexing
+        self.documents = documents if isinstance(documents, DocumentStore) else None
         self.device = device
-        self.model = SentenceTransformer(model_name, device=device)
+        self.version = 0  # Part of the result cache keys; bump it when the index changes
+        self.query_cache = QueryCache(max_size=query_cache_size, ttl=query_cache_ttl, embedding_size=4 * query_cache_size)
+        self.model_name = model_name
+        # Shared with every other retriever using the same model in this process
+        self.model = acquire_model(self, model_name, device=device)
+
+        # Route document encoding through the embedding cache so unchanged texts are not re-encoded
+        self.cache = get_cache(cache_dir, model_name)
         
         # Get the embedding dimension from the model
-        embedding_dim = self.model.encode("Test sentence").shape[0]
+        embedding_dim = embedding_dimension(self.model)
         
         # Create a Faiss index for storing embeddings
-        if device == "cuda":
-            self.index = faiss.IndexFlatL2(embedding_dim)
-            self.index = faiss.index_cpu_to_gpu(faiss.StandardGpuResources(), 0, self.index)
-        else:
-            self.index = faiss.IndexFlatL2(embedding_dim)
+        from .dense import FaissIndex, index_params_with_defaults, make_index
+
+        index_params = index_params_with_defaults(index_params)
+        index = make_index(embedding_dim, index_type, index_params, use_gpu=device == "cuda", metric=metric)
+        self.index = FaissIndex(key="id", index=index, metric=metric, train_size=index_params["train_size"], rescore=index_params["rescore"], metadata=MetadataIndex(metadata_fields))
         
         # Initialize the retriever with the encoder and index
-        self.retriever = retrieve.Encoder(
+        self.retriever = self._init_retriever()
+        
+        # Encode in batches of similar length, a window at a time so documents can be streamed from disk
+        with metrics.stage("index", method="encoder"):
+            text = lambda document: " ".join(document.get(field, "") for field in self.retriever.on)
+            for batch, embeddings in iter_encoded(documents, self.retriever.encoder, text, batch_size=batch_size, window=encode_window, count_tokens=model_token_counter(self.model)):
+                self.index.add(batch, embeddings)
+            self.index.train()
+
+    def _init_retriever(self):
+        from cherche import retrieve
+
+        encoder = instrument_encoder(self.model.encode)
+        encoder = self.cache.wrap(encoder) if self.cache is not None else encoder
+        retriever = retrieve.Encoder(
             key="id",
             on=["title", "article"],
-            encoder=self.model.encode,
-            index=self.index,
+            encoder=encoder,
             normalize=True
         )
-        
-        # Add documents to the retriever
-        self.retriever = self.retriever.add(documents=documents)
+        # Swap cherche's index for one that can be saved and memory-mapped
+        retriever.index = self.index
+        return retriever
     
-    def retrieve(self, query, k=10):
+    def retrieve(self, query, k=10, where=None):
         """
         Retrieve the top k documents that are most similar to the query.
         
         :param query: A string or list of strings representing the query/queries.
         :param k: Number of top documents to retrieve.
+        :param where: Only retrieve documents whose metadata (e.g. {"source": ..., "page": {"$gte": 2}})
+                      matches, see filters.MetadataIndex; applied inside the FAISS search.
         :return: List of dictionaries with document IDs and their similarity scores.
         """
-        results = self.retriever(query, k=k)
+        # Repeated queries are answered from the result cache, and their embeddings from the query-embedding cache
+        normalized = normalize_text(query) if isinstance(query, str) else tuple(normalize_text(q) for q in query)
+        return self.query_cache.cached(("retrieve", normalized, k, self.version, where_key(where)), lambda: self._retrieve(query, k, where))
+
+    def _retrieve(self, query, k, where=None):
+        with metrics.stage("search", method="encoder"):
+            return self._search(query, k, where)
+
+    def _search(self, query, k, where=None):
+        queries = [query] if isinstance(query, str) else query
+        results = self.index(self.query_cache.encode(queries, self.model.encode), k=k, where=where)
+        return results[0] if isinstance(query, str) else results
+
+    def retrieve_batch(self, queries, k=10, batch_size=64, where=None):
+        """
+        Retrieve the top k documents for many queries, encoding them and searching the index batch by batch.
+        
+        :param queries: List of query strings.
+        :param k: Number of top documents to retrieve per query.
+        :param batch_size: Number of queries encoded by the model and searched in a single index call.
+        :param where: Metadata filter of every query, see retrieve.
+        :return: One list of dictionaries with document IDs and similarity scores per query.
+        """
+        return self.query_cache.retrieve_batch(("batch", where_key(where)), self.version, list(queries), k, lambda missing: self._retrieve_batch(missing, k, batch_size, where))
+
+    def _retrieve_batch(self, queries, k, batch_size, where=None):
+        with metrics.stage("search", method="encoder"):
+            return self._search_batch(queries, k, batch_size, where)
+
+    def _search_batch(self, queries, k, batch_size, where=None):
+        results = []
+        for batch in batched(queries, batch_size):
+            query_embeddings = self.query_cache.encode(batch, lambda texts: self.model.encode(texts, batch_size=batch_size))
+            results.extend(self.index(query_embeddings, k=k, where=where))
         return results
 
+    def cache_stats(self):
+        """Hit rates of the result and query-embedding caches, and of the document embedding cache."""
+        stats = self.query_cache.stats()
+        if self.cache is not None:
+            stats["document_embeddings"] = self.cache.stats()
+        return stats
+
+    def close(self):
+        """
+        Release this retriever's references to the shared models. This also happens when the retriever is garbage collected.
+        """
+        release_models(self)
+
+    def save(self, path):
+        """
+        Save the index and document ids to a directory so the retriever can be loaded without re-encoding.
+        
+        :param path: Directory to write to.
+        """
+        self.index.save(path)
+        with open(os.path.join(path, "retriever.json"), "w") as f:
+            json.dump({"model_name": self.model_name}, f)
+
+    @classmethod
+    def load(cls, path, mmap=True, device="cpu", cache_dir=DEFAULT_CACHE_DIR, query_cache_size=1024, query_cache_ttl=300):
+        """
+        Load a retriever written by save.
+        
+        :param path: Directory passed to save.
+        :param mmap: Memory-map the index instead of reading it into RAM.
+        :param device: Device to run the model on ("cpu" or "cuda").
+        :param cache_dir: Directory of the on-disk embedding cache, or None to always encode.
+        :param query_cache_size: Number of query results kept in memory, see __init__.
+        :param query_cache_ttl: Seconds a cached query result stays valid, or None.
+        """
+        with open(os.path.join(path, "retriever.json"), "r") as f:
+            settings = json.load(f)
+        self = cls.__new__(cls)
+        self.documents = None
+        self.device = device
+        self.version = 0
+        self.query_cache = QueryCache(max_size=query_cache_size, ttl=query_cache_ttl, embedding_size=4 * query_cache_size)
+        self.model_name = settings["model_name"]
+        self.model = acquire_model(self, self.model_name, device=device)
+        self.cache = get_cache(cache_dir, self.model_name)
+        from .dense import FaissIndex
+
+        self.index = FaissIndex.load(path, mmap=mmap and device != "cuda")
+        if device == "cuda":
+            import faiss
+
+            self.index.index = faiss.index_cpu_to_gpu(faiss.StandardGpuResources(), 0, self.index.index)
+        self.retriever = self._init_retriever()
+        return self
+
 '''
 # Example usage
 documents = [
@@ -0,0 +1,86 @@
+import numpy as np
+
+from .chunking import regex_token_count
+from .utils import batched
+
+# Texts per model call; sentence-transformers' own default
+DEFAULT_BATCH_SIZE = 32
+
+# Documents read and sorted by length together; bounds the texts held besides the index
+DEFAULT_WINDOW = 4096
+
+
+def model_token_counter(model):
+    """
+    Returns a function mapping a list of texts to their number of tokens for model.
+
+    A sentence-transformers model counts with its own tokenizer, in one batched call, up to
+    its max_seq_length (longer texts are truncated, so they pad alike). Models without a
+    tokenizer, such as test stubs, fall back to chunking.regex_token_count (words and
+    punctuation marks): closer to the padded length than characters for punctuation-heavy
+    text, but it undercounts subword tokens, most of all in scripts written without spaces.
+    """
+    tokenizer = getattr(model, "tokenizer", None)
+    if not callable(tokenizer):
+        return regex_token_count
+    limit = getattr(model, "max_seq_length", None)
+
+    def count(texts):
+        if not texts:
+            return []
+        lengths = [len(ids) for ids in tokenizer(list(texts), add_special_tokens=False)["input_ids"]]
+        return [min(length, limit) for length in lengths] if limit else lengths
+    return count
+
+
+def length_sorted_batches(texts, batch_size=DEFAULT_BATCH_SIZE, count_tokens=regex_token_count):
+    """
+    Groups the positions of texts into batches of similar length in tokens, longest first.
+
+    A transformer pads every text of a batch to the longest one, so batching texts of
+    similar length wastes little compute on padding; longest first makes an out-of-memory
+    batch fail at the start rather than at the end of a long run.
+
+    :param count_tokens: Function mapping a list of texts to their number of tokens, see
+                         model_token_counter.
+    :return: List of arrays of positions in texts.
+    """
+    lengths = np.asarray(count_tokens(texts), dtype=np.int64).reshape(-1)
+    order = np.argsort(-lengths, kind="stable")
+    return [order[start:start + batch_size] for start in range(0, len(order), batch_size)]
+
+
+def iter_encoded(documents, encode, text, batch_size=DEFAULT_BATCH_SIZE, window=DEFAULT_WINDOW, count_tokens=regex_token_count):
+    """
+    Encodes documents window by window, in batches of similar length.
+
+    Batches come out in length order, not document order: feed them straight into an index,
+    which keeps the key of each vector, or use encode_texts to get the document order back.
+
+    :param documents: Any iterable of documents; only window documents are held at a time.
+    :param encode: Encode function taking a list of texts and a batch_size keyword.
+    :param text: Function returning the text to encode of a document.
+    :param batch_size: Texts per encode call, i.e. per forward pass of the model.
+    :param window: Documents read and sorted together.
+    :param count_tokens: Token counter the batches are sorted by, see model_token_counter.
+    :return: Generator of (documents, embeddings) batches.
+    """
+    for chunk in batched(documents, window):
+        texts = [text(document) for document in chunk]
+        for positions in length_sorted_batches(texts, batch_size, count_tokens):
+            embeddings = encode([texts[position] for position in positions], batch_size=batch_size)
+            yield [chunk[position] for position in positions], np.asarray(embeddings, dtype=np.float32)
+
+
+def encode_texts(texts, encode, batch_size=DEFAULT_BATCH_SIZE, window=DEFAULT_WINDOW, count_tokens=regex_token_count):
+    """Encodes texts in batches of similar length and returns the embeddings in the order of texts."""
+    texts = list(texts)
+    embeddings = None
+    for start in range(0, len(texts), window):
+        chunk = texts[start:start + window]
+        for positions in length_sorted_batches(chunk, batch_size, count_tokens):
+            batch = np.asarray(encode([chunk[position] for position in positions], batch_size=batch_size), dtype=np.float32)
+            if embeddings is None:
+                embeddings = np.empty((len(texts), batch.shape[1]), dtype=np.float32)
+            embeddings[start + positions] = batch
+    return embeddings if embeddings is not None else np.zeros((0, 0), dtype=np.float32)
@@ -0,0 +1,243 @@
+import json
+import os
+from array import array
+
+import numpy as np
+
+# Operators of a where clause; a bare value means $eq and a list means $in
+OPERATORS = ("$eq", "$ne", "$in", "$nin", "$gt", "$gte", "$lt", "$lte", "$prefix")
+
+# Provenance fields of process.py passages, the fields indexed unless told otherwise
+DEFAULT_METADATA_FIELDS = ("source", "file_type", "folder", "uploaded_at", "page")
+
+# Compiled masks kept per index; they are dropped whenever the index changes
+DEFAULT_MASK_CACHE_SIZE = 64
+
+_SCALARS = (str, int, float, bool)
+
+
+def _conditions(where):
+    # (field, operator, operand) triples of a where clause
+    conditions = []
+    for field, condition in where.items():
+        if isinstance(condition, dict):
+            for operator, operand in condition.items():
+                if operator not in OPERATORS:
+                    raise ValueError(f"Unknown filter operator '{operator}' on '{field}', expected one of {OPERATORS}")
+                if operator in ("$in", "$nin") and not isinstance(operand, (list, tuple, set)):
+                    raise ValueError(f"'{operator}' on '{field}' expects a list, got {operand!r}")
+                conditions.append((field, operator, operand))
+        elif isinstance(condition, (list, tuple, set)):
+            conditions.append((field, "$in", condition))
+        else:
+            conditions.append((field, "$eq", condition))
+    return conditions
+
+
+def _holds(value, operator, operand):
+    # Whether a present metadata value satisfies one condition; values of another type never match
+    try:
+        if operator == "$eq":
+            return value == operand
+        if operator == "$ne":
+            return value != operand
+        if operator == "$in":
+            return value in operand
+        if operator == "$nin":
+            return value not in operand
+        if operator == "$prefix":
+            return isinstance(value, str) and value.startswith(operand)
+        if isinstance(value, bool) or isinstance(value, str) != isinstance(operand, str):
+            return False
+        if operator == "$gt":
+            return value > operand
+        if operator == "$gte":
+            return value >= operand
+        if operator == "$lt":
+            return value < operand
+        return value <= operand
+    except TypeError:
+        return False
+
+
+def check_fields(where, fields):
+    """Raises ValueError if where has a condition on a field outside fields, which are not indexed."""
+    unknown = sorted(set(where) - set(fields))
+    if unknown:
+        raise ValueError(f"Cannot filter on {unknown}: only {list(fields)} are indexed, see metadata_fields")
+
+
+def where_key(where):
+    """Hashable form of a where clause, for result cache keys; None stays None."""
+    return None if where is None else json.dumps(where, sort_keys=True, default=sorted)
+
+
+def matches(document, where):
+    """
+    Whether a document satisfies a where clause, see MetadataIndex.mask; used where an index
+    cannot filter inside its search.
+    """
+    return all(
+        isinstance(document.get(field), _SCALARS) and _holds(document[field], operator, operand)
+        for field, operator, operand in _conditions(where)
+    )
+
+
+class MetadataIndex:
+    def __init__(self, fields=DEFAULT_METADATA_FIELDS, cache_size=DEFAULT_MASK_CACHE_SIZE):
+        """
+        Metadata fields of the documents of an index, by position, for filtering inside searches.
+
+        Each field is kept as one int32 code per position into its list of distinct values, so
+        a condition is evaluated once per distinct value and expanded to every position with a
+        single array lookup. mask compiles a where clause into a boolean array over the
+        positions that indexes apply while scoring (FAISS IDSelector, masked sparse scores);
+        compiled masks are cached until the next change.
+
+        Where clauses map fields to a value (equality), a list of values (any of them), or a
+        dict of operators: $eq, $ne, $in, $nin, $gt, $gte, $lt, $lte and $prefix (strings).
+        A document matches when every condition holds; a document without the field never
+        matches a condition on it. Only the given fields are indexed, and only their scalar
+        values (str, int, float, bool); filtering on another field is an error.
+
+        :param fields: Metadata fields indexed. Every distinct value is kept in memory and
+                       saved, so text fields belong in the document store, not here.
+        :param cache_size: Number of compiled masks kept.
+        """
+        self.fields = list(fields)
+        self.cache_size = cache_size
+        self.size = 0
+        self._codes = {}  # field -> array of codes by position, -1 where the field is missing
+        self._values = {}  # field -> distinct values, by code
+        self._lookup = {}  # field -> value -> code
+        self._arrays = {}
+        self._masks = {}
+
+    def __len__(self):
+        return self.size
+
+    def _changed(self):
+        self._arrays = {}
+        self._masks = {}
+
+    def _field(self, field):
+        if field not in self._codes:
+            self._codes[field] = array("i", [-1]) * self.size
+            self._values[field] = []
+            self._lookup[field] = {}
+        return self._codes[field]
+
+    def _code(self, field, value):
+        lookup = self._lookup[field]
+        # True == 1 in a dict, so booleans are told apart by their type
+        token = (type(value) is bool, value)
+        code = lookup.get(token)
+        if code is None:
+            code = lookup[token] = len(self._values[field])
+            self._values[field].append(value)
+        return code
+
+    def append(self, documents):
+        """Indexes the metadata of documents at the next positions."""
+        for document in documents:
+            for field in self.fields:
+                value = document.get(field)
+                if not isinstance(value, _SCALARS):
+                    continue
+                codes = self._field(field)
+                codes.extend([-1] * (self.size - len(codes)))
+                codes.append(self._code(field, value))
+            self.size += 1
+        for codes in self._codes.values():
+            codes.extend([-1] * (self.size - len(codes)))
+        self._changed()
+        return self
+
+    def set(self, position, document):
+        """Replaces the metadata at position by that of document."""
+        for field in self.fields:
+            value = document.get(field)
+            if field not in self._codes and not isinstance(value, _SCALARS):
+                continue
+            self._field(field)[position] = self._code(field, value) if isinstance(value, _SCALARS) else -1
+        self._changed()
+        return self
+
+    def take(self, positions):
+        """New index holding the metadata at positions, in their order, e.g. the survivors of a compaction."""
+        taken = MetadataIndex(self.fields, self.cache_size)
+        positions = np.asarray(positions, dtype=np.int64)
+        taken.size = len(positions)
+        for field in self._codes:
+            taken._codes[field] = array("i", self._array(field)[positions].tobytes())
+            taken._values[field] = list(self._values[field])
+            taken._lookup[field] = dict(self._lookup[field])
+        return taken
+
+    def _array(self, field):
+        codes = self._arrays.get(field)
+        if codes is None:
+            codes = self._arrays[field] = np.frombuffer(self._codes[field].tobytes(), dtype=np.int32)
+        return codes
+
+    def _condition_mask(self, field, operator, operand):
+        if field not in self._codes:
+            return np.zeros(self.size, dtype=bool)
+        # One entry per distinct value, plus a last False one that code -1 (missing) lands on
+        table = np.zeros(len(self._values[field]) + 1, dtype=bool)
+        if operator in ("$eq", "$in"):
+            # Equality on distinct values is a dict lookup rather than a scan
+            lookup = self._lookup[field]
+            for value in ([operand] if operator == "$eq" else operand):
+                code = lookup.get((type(value) is bool, value)) if isinstance(value, _SCALARS) else None
+                if code is not None:
+                    table[code] = True
+        else:
+            for code, value in enumerate(self._values[field]):
+                table[code] = _holds(value, operator, operand)
+        return table[self._array(field)]
+
+    def mask(self, where):
+        """
+        Boolean array over the positions, True where the document satisfies where (see __init__).
+
+        :param where: Dict of field -> condition.
+        """
+        cache_key = where_key(where)
+        mask = self._masks.get(cache_key)
+        if mask is None:
+            check_fields(where, self.fields)
+            mask = np.ones(self.size, dtype=bool)
+            for field, operator, operand in _conditions(where):
+                mask &= self._condition_mask(field, operator, operand)
+            if len(self._masks) >= self.cache_size:
+                self._masks.pop(next(iter(self._masks)))
+            self._masks[cache_key] = mask
+        return mask
+
+    def save(self, path):
+        """Writes the codes and distinct values of every field to the directory path."""
+        os.makedirs(path, exist_ok=True)
+        coded = list(self._codes)
+        for number, field in enumerate(coded):
+            np.save(os.path.join(path, f"codes_{number}.npy"), self._array(field))
+        with open(os.path.join(path, "metadata.json"), "w") as f:
+            json.dump({
+                "size": self.size,
+                "fields": self.fields,
+                "coded": coded,
+                "values": [self._values[field] for field in coded],
+            }, f)
+
+    @classmethod
+    def load(cls, path):
+        """Loads an index written by save."""
+        with open(os.path.join(path, "metadata.json"), "r") as f:
+            settings = json.load(f)
+        loaded = cls(fields=settings["fields"])
+        loaded.size = settings["size"]
+        for number, (field, values) in enumerate(zip(settings["coded"], settings["values"])):
+            loaded._codes[field] = array("i", np.load(os.path.join(path, f"codes_{number}.npy")).astype(np.int32).tobytes())
+            loaded._values[field] = values
+            loaded._lookup[field] = {(type(value) is bool, value): code for code, value in enumerate(values)}
+        return loaded
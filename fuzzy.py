@@ -0,0 +1,187 @@
+import numpy as np
+from rapidfuzz import fuzz, process, utils
+from scipy.sparse import csr_matrix
+
+from .filters import DEFAULT_METADATA_FIELDS, MetadataIndex
+
+# Character n-grams of the words, padded with a space on both sides
+DEFAULT_NGRAM = 3
+# Documents scored per query after pruning; None scores every document
+DEFAULT_CANDIDATES = 1000
+# Share of a query word's n-grams a vocabulary word must contain to count as a match
+DEFAULT_WORD_SIMILARITY = 0.5
+
+# Scorers comparing whole strings: their best matches need not share a word with the query, so they score every document
+WHOLE_STRING_SCORERS = (fuzz.ratio, fuzz.QRatio, fuzz.token_sort_ratio)
+
+
+def char_ngrams(word, n=DEFAULT_NGRAM):
+    padded = f" {word} "
+    if len(padded) <= n:
+        return {padded}
+    return {padded[i:i + n] for i in range(len(padded) - n + 1)}
+
+
+def _postings(matrix, rows):
+    # Column indices of the given rows of a CSR matrix, and the row each one came from
+    sub = matrix[rows]
+    return sub.indices, np.repeat(np.arange(len(rows)), np.diff(sub.indptr))
+
+
+class FuzzyIndex:
+    def __init__(self, key, on, fuzzer=fuzz.partial_ratio, default_process=True, candidates=DEFAULT_CANDIDATES,
+                 score_cutoff=None, ngram=DEFAULT_NGRAM, word_similarity=DEFAULT_WORD_SIMILARITY, workers=-1,
+                 metadata_fields=DEFAULT_METADATA_FIELDS):
+        """
+        Fuzzy retriever with the interface of cherche's Fuzz, for large corpora.
+
+        cherche's Fuzz calls the scorer on every document for every query. Here the documents
+        that can score well are found first through two inverted indexes: vocabulary words by
+        character n-gram, and documents by word. Each query word matches the vocabulary words
+        containing at least word_similarity of its n-grams (so typos and prefixes match), and
+        documents are ranked by how many query words they match and how closely; the top
+        candidates are then scored in one native rapidfuzz cdist call over all cores. Documents
+        sharing no word with any query word are never returned. The scorers comparing whole
+        strings (ratio, QRatio, token_sort_ratio) are not pruned: their best matches often
+        share no word with the query. A where clause (see filters.MetadataIndex) masks the
+        documents before candidates are picked, so a filtered search still scores up to
+        candidates documents, all matching it.
+
+        :param fuzzer: Any similarity scorer of rapidfuzz.fuzz, see golden._init_fuzz.
+        :param default_process: Lowercase and strip punctuation from documents and queries.
+        :param candidates: Documents scored per query, or None to score all of them (exact,
+                           still one cdist call per query).
+        :param score_cutoff: Minimum score of a hit; scorers skip the rest of the work on
+                             pairs that cannot reach it.
+        :param ngram: Length of the character n-grams.
+        :param word_similarity: Share of a query word's n-grams a vocabulary word must contain.
+        :param workers: Threads of the cdist call, -1 for all cores.
+        :param metadata_fields: Document fields that searches can filter on.
+        """
+        self.key = key
+        self.on = on if isinstance(on, list) else [on]
+        self.fuzzer = fuzzer
+        self.default_process = default_process
+        self.candidates = candidates
+        self.score_cutoff = score_cutoff
+        self.ngram = ngram
+        self.word_similarity = word_similarity
+        self.workers = workers
+        self.keys = []
+        self.texts = []
+        self.positions = {}
+        self.metadata = MetadataIndex(metadata_fields)
+        self._words = None  # Inverted indexes, built on the first query after a change
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __repr__(self):
+        return f"FuzzyIndex retriever\n\tkey      : {self.key}\n\ton       : {', '.join(self.on)}\n\tdocuments: {len(self)}"
+
+    def empty(self):
+        """Returns an index with the same settings and no documents."""
+        return FuzzyIndex(
+            key=self.key, on=self.on, fuzzer=self.fuzzer, default_process=self.default_process,
+            candidates=self.candidates, score_cutoff=self.score_cutoff, ngram=self.ngram,
+            word_similarity=self.word_similarity, workers=self.workers, metadata_fields=self.metadata.fields,
+        )
+
+    def _process(self, text):
+        return utils.default_process(text) if self.default_process else text
+
+    def add(self, documents):
+        """Indexes documents; a document whose key is already indexed replaces the old version."""
+        for document in documents:
+            text = self._process(" ".join([document.get(field, "") for field in self.on]))
+            position = self.positions.get(document[self.key])
+            if position is None:
+                self.positions[document[self.key]] = len(self.keys)
+                self.keys.append(document[self.key])
+                self.texts.append(text)
+                self.metadata.append([document])
+            else:
+                self.texts[position] = text
+                self.metadata.set(position, document)
+        self._words = None
+        return self
+
+    def _build(self):
+        words = {}
+        documents = []
+        for text in self.texts:
+            ids = {words.setdefault(word, len(words)) for word in text.split()}
+            documents.append(np.fromiter(ids, dtype=np.int32, count=len(ids)))
+        lengths = np.fromiter((len(ids) for ids in documents), dtype=np.int64, count=len(documents))
+        word_ids = np.concatenate(documents) if documents else np.zeros(0, dtype=np.int32)
+        positions = np.repeat(np.arange(len(documents), dtype=np.int32), lengths)
+        # word -> documents containing it
+        self._word_documents = csr_matrix((np.ones(len(word_ids), dtype=np.float32), (word_ids, positions)), shape=(len(words), len(self.texts)))
+
+        grams = {}
+        rows = []
+        columns = []
+        for word, word_id in words.items():
+            for gram in char_ngrams(word, self.ngram):
+                rows.append(grams.setdefault(gram, len(grams)))
+                columns.append(word_id)
+        # n-gram -> vocabulary words containing it
+        self._gram_words = csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, columns)), shape=(len(grams), len(words)))
+        self._grams = grams
+        self._words = words
+
+    def _match_words(self, word):
+        # Vocabulary words containing at least word_similarity of the n-grams of word, and that share of each
+        grams = char_ngrams(word, self.ngram)
+        rows = [self._grams[gram] for gram in grams if gram in self._grams]
+        if not rows:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        word_ids, _ = _postings(self._gram_words, rows)
+        matched, shared = np.unique(word_ids, return_counts=True)
+        similarity = (shared / len(grams)).astype(np.float32)
+        keep = similarity >= self.word_similarity
+        return matched[keep], similarity[keep]
+
+    def _candidates(self, query, allowed=None):
+        if self.candidates is None or self.fuzzer in WHOLE_STRING_SCORERS or not query.split():
+            return np.arange(len(self.texts)) if allowed is None else np.flatnonzero(allowed)
+        scores = np.zeros(len(self.texts), dtype=np.float32)
+        for word in set(query.split()):
+            matched, similarity = self._match_words(word)
+            if not len(matched):
+                continue
+            # A document counts once per query word, with its closest word; squaring favours exact matches
+            positions, rows = _postings(self._word_documents, matched)
+            best = np.zeros(len(self.texts), dtype=np.float32)
+            np.maximum.at(best, positions, (similarity ** 2)[rows])
+            scores += best
+        if allowed is not None:
+            scores[~allowed] = 0
+        found = np.flatnonzero(scores)
+        if len(found) > self.candidates:
+            found = np.sort(found[np.argpartition(-scores[found], self.candidates - 1)[:self.candidates]])
+        return found
+
+    def search(self, query, k=None, where=None):
+        """Returns the top k hits of one query as {key, "similarity"} dicts, best first, among the documents matching where."""
+        if self._words is None:
+            self._build()
+        query = self._process(query)
+        candidates = self._candidates(query, None if where is None else self.metadata.mask(where))
+        if not len(candidates):
+            return []
+        texts = self.texts if len(candidates) == len(self.texts) else [self.texts[position] for position in candidates.tolist()]
+        scores = process.cdist([query], texts, scorer=self.fuzzer, score_cutoff=self.score_cutoff, dtype=np.float64, workers=self.workers)[0]
+        # Stable sort: equal scores keep document order, as in cherche
+        order = np.argsort(-scores, kind="stable")
+        if self.score_cutoff is not None:
+            order = order[scores[order] >= self.score_cutoff]
+        if k is not None:
+            order = order[:k]
+        return [{self.key: self.keys[candidates[i]], "similarity": float(scores[i])} for i in order.tolist()]
+
+    def __call__(self, q, k=None, tqdm_bar=False, where=None, **kwargs):
+        """Same interface and output as cherche's Fuzz.__call__, without the progress bar."""
+        if isinstance(q, str):
+            return self.search(q, k, where)
+        return [self.search(query, k, where) for query in q]
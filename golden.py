@@ -1,63 +1,118 @@
-from cherche import retrieve
-from sentence_transformers import SentenceTransformer
-import faiss
-from rapidfuzz import fuzz
-from lenlp import sparse
+import os
+import pickle
+
+import numpy as np
+
+from .cache import DEFAULT_CACHE_DIR, QueryCache, get_cache, normalize_text
+from .docstore import DocumentStore
+from .models import acquire_model, embedding_dimension, release_models
+from .encoding import DEFAULT_BATCH_SIZE, DEFAULT_WINDOW, iter_encoded, model_token_counter
+from .filters import DEFAULT_METADATA_FIELDS, MetadataIndex, check_fields, matches, where_key
+from .metrics import instrument_encoder, metrics
+from .utils import batched
+
+# cherche, flashtext, rapidfuzz, lenlp and scipy take about a second to import, so each is
+# imported by the methods that use it: looking the class up stays cheap (see main.retriever_class)
+
 
 class DocumentRetriever:
     def __init__(self, method, documents, on, key="id", use_gpu=False, **kwargs):
         self.method = method.lower()
+        # The embedding method consumes documents in batches; the sparse methods read them several
+        # times and keep them for compact, in a columnar store rather than a list of dicts
+        if self.method != "embedding":
+            documents = DocumentStore.build(documents, key=key)
         self.documents = documents
+        self._owns_documents = False  # Whether self.documents is this retriever's own copy, see _track
         self.key = key
         self.on = on
         self.use_gpu = use_gpu
         self.kwargs = kwargs
+        # Fields searches can filter on (kwarg metadata_fields), see filters.MetadataIndex
+        self.metadata_fields = kwargs.get("metadata_fields", DEFAULT_METADATA_FIELDS)
         self.retriever = None
         self.encoder_model = None  # Ensuring it's defined for encoder methods
         self.query_encoder = None  # Ensuring it's defined for DPR method
+        self.cache = None  # Embedding cache, set for the embedding method
+        self.version = 0  # Bumped by every change to the index, part of the result cache keys
+        self.query_cache = self._init_query_cache()
+        with metrics.stage("index", method=self.method):
+            self.retriever = self._init_retriever()
+        if self.method != "embedding":
+            # Embedding documents stream in and are counted as indexed_vectors by the FAISS index
+            metrics.count("indexed_documents", len(self.documents), method=self.method)
 
+    def _init_query_cache(self):
+        valid_params = ['query_cache_size', 'query_cache_ttl', 'query_embedding_cache_size']
+        filtered_kwargs = self._filter_kwargs(valid_params)
+        max_size = filtered_kwargs.get("query_cache_size", 1024)
+        return QueryCache(
+            max_size=max_size,
+            ttl=filtered_kwargs.get("query_cache_ttl", 300),
+            embedding_size=filtered_kwargs.get("query_embedding_cache_size", 4 * max_size),
+        )
+
+    def _init_retriever(self):
         if self.method == "bm25":
-            self.retriever = self._init_bm25()
+            return self._init_bm25()
         elif self.method == "tfidf":
-            self.retriever = self._init_tfidf()
+            return self._init_tfidf()
         elif self.method == "flash":
-            self.retriever = self._init_flash()
+            return self._init_flash()
         elif self.method == "lunr":
-            self.retriever = self._init_lunr()
+            return self._init_lunr()
         elif self.method == "fuzz":
-            self.retriever = self._init_fuzz()
+            return self._init_fuzz()
         elif self.method == "embedding":
-            self.retriever = self._init_embedding()
+            return self._init_embedding()
 
     def _filter_kwargs(self, valid_params):
         return {k: v for k, v in self.kwargs.items() if k in valid_params}
 
     def _init_bm25(self):
+        from cherche import retrieve
         valid_params = ['k']
         filtered_kwargs = self._filter_kwargs(valid_params)
-        return retrieve.BM25(key=self.key, on=self.on, documents=self.documents, **filtered_kwargs)
+        return self._share_keys(retrieve.BM25(key=self.key, on=self.on, documents=self.documents, **filtered_kwargs))
 
     def _init_tfidf(self):
+        from cherche import retrieve
+        from lenlp import sparse
         valid_params = ['vectorizer_params']
         filtered_kwargs = self._filter_kwargs(valid_params)
         count_vectorizer = sparse.TfidfVectorizer(**filtered_kwargs.get("vectorizer_params", {}))
-        return retrieve.TfIdf(key=self.key, on=self.on, documents=self.documents, tfidf=count_vectorizer)
+        return self._share_keys(retrieve.TfIdf(key=self.key, on=self.on, documents=self.documents, tfidf=count_vectorizer))
+
+    def _share_keys(self, retriever):
+        # cherche maps matrix columns to ids with a dict per document; read them from the store's id column
+        retriever.documents = self.documents.key_view()
+        # Only cherche's own add reads it; changes go through SparseDelta
+        retriever.duplicates = {}
+        return retriever
 
     def _init_flash(self):
+        from cherche import retrieve
         retriever = retrieve.Flash(key=self.key, on=self.on)
         retriever.add(self.documents)
         return retriever
 
     def _init_lunr(self):
+        from cherche import retrieve
         return retrieve.Lunr(key=self.key, on=self.on, documents=self.documents)
 
     def _init_fuzz(self):
-        valid_params = ['fuzzer']
+        from rapidfuzz import fuzz
+        from .fuzzy import DEFAULT_CANDIDATES, FuzzyIndex
+        valid_params = ['fuzzer', 'fuzz_candidates', 'fuzz_score_cutoff']
         filtered_kwargs = self._filter_kwargs(valid_params)
         fuzzer = filtered_kwargs.get("fuzzer", fuzz.partial_ratio)
-        retriever = retrieve.Fuzz(key=self.key, on=self.on, fuzzer=fuzzer)
-        retriever.add(self.documents)
-        return retriever
+        # Only the fuzz_candidates documents sharing the most (fuzzily matched) words with the query are scored
+        retriever = FuzzyIndex(
+            key=self.key, on=self.on, fuzzer=fuzzer,
+            candidates=filtered_kwargs.get("fuzz_candidates", DEFAULT_CANDIDATES),
+            score_cutoff=filtered_kwargs.get("fuzz_score_cutoff"), metadata_fields=self.metadata_fields,
+        )
+        return retriever.add(self.documents)
     '''
 # List of available scoring function
 >>> scoring = [
@@ -78,32 +133,80 @@ class DocumentRetriever:
 
 
     def _init_embedding(self):
-        valid_params = ['model_name']
+        # faiss is only loaded by the embedding method
+        from cherche import retrieve
+        from .dense import FaissIndex, index_params_with_defaults, make_index
+        valid_params = ['model_name', 'cache_dir', 'encode_batch_size', 'encode_window', 'index_type', 'index_params', 'metric']
         filtered_kwargs = self._filter_kwargs(valid_params)
         model_name = filtered_kwargs.get("model_name", "sentence-transformers/all-mpnet-base-v2")
-        self.encoder_model = SentenceTransformer(model_name, device="cuda" if self.use_gpu else "cpu")
-        encoder = self.encoder_model.encode
+        # Shared with every other retriever using the same model in this process
+        self.encoder_model = acquire_model(self, model_name, device="cuda" if self.use_gpu else "cpu")
+        self.cache = get_cache(filtered_kwargs.get("cache_dir", DEFAULT_CACHE_DIR), model_name)
+        wrapped_encoder = self._document_encoder()
+        d = embedding_dimension(self.encoder_model)
+        # Exact flat index by default; ivf/hnsw/ivfpq trade some recall for sub-linear search
+        index_params = index_params_with_defaults(filtered_kwargs.get("index_params"))
+        metric = filtered_kwargs.get("metric", "cosine")
+        index = make_index(d, filtered_kwargs.get("index_type", "flat"), index_params, use_gpu=self.use_gpu, metric=metric)
+
+        retriever = retrieve.Embedding(key=self.key)
+        # Swap cherche's index for one that can be saved and memory-mapped
+        retriever.index = FaissIndex(key=self.key, index=index, metric=metric, train_size=index_params["train_size"], rescore=index_params["rescore"], metadata=MetadataIndex(self.metadata_fields))
+        # Encode in batches of similar length, a window at a time so documents may be streamed from disk
+        for batch, embeddings_documents in self._encode(self.documents, wrapped_encoder):
+            retriever.add(documents=batch, embeddings_documents=embeddings_documents)
+        retriever.index.train()
+        return retriever
+
+    def _encode(self, documents, encoder):
+        # encode_batch_size texts per model call, encode_window documents sorted by length together
+        return iter_encoded(
+            documents, encoder, lambda doc: doc["text"],
+            batch_size=self.kwargs.get("encode_batch_size", DEFAULT_BATCH_SIZE),
+            window=self.kwargs.get("encode_window", DEFAULT_WINDOW),
+            count_tokens=model_token_counter(self.encoder_model),
+        )
 
-        def wrapped_encoder(texts):
+    def _document_encoder(self):
+        encoder = instrument_encoder(self.encoder_model.encode)
+        # Only documents missing from the on-disk cache go through the model
+        if self.cache is not None:
+            encoder = self.cache.wrap(encoder)
+
+        def wrapped_encoder(texts, **kwargs):
             if isinstance(texts, str):
                 texts = [texts]
-            return encoder(texts)
-        d = wrapped_encoder(["This is a sample document."])[0].shape[0]
-        index = faiss.IndexFlatL2(d)
-        if self.use_gpu:
-            index = faiss.index_cpu_to_gpu(faiss.StandardGpuResources(), 0, index)
-
-        retriever = retrieve.Embedding(key=self.key, index=index)
-        embeddings_documents = wrapped_encoder([doc["text"] for doc in self.documents])
-        retriever.add(documents=self.documents, embeddings_documents=embeddings_documents)
-        return retriever
+            return encoder(texts, **kwargs)
+        return wrapped_encoder
+
+    def retrieve(self, query, k=10, batch_size=64, where=None):
+        """
+        Retrieves the top k documents of a query, or one list of hits per query for a list of queries.
+
+        :param where: Only retrieve documents whose metadata matches, e.g. {"file_type": "pdf",
+                      "page": {"$lte": 10}}, see filters.MetadataIndex. embedding, bm25, tfidf
+                      and fuzz apply it inside the search (FAISS IDSelector, masked scores,
+                      masked candidates); lunr and flash filter all their matches.
+        """
+        # Repeated queries are answered from the result cache until the index changes
+        normalized = normalize_text(query) if isinstance(query, str) else tuple(normalize_text(q) for q in query)
+        return self.query_cache.cached(("retrieve", self.method, normalized, k, self.version, where_key(where)), lambda: self._retrieve(query, k, where))
 
-    def retrieve(self, query, k=10, batch_size=64):
+    def _retrieve(self, query, k, where=None):
+        with metrics.stage("search", method=self.method):
+            if where is not None:
+                hits = self._search_filtered([query] if isinstance(query, str) else query, k, where)
+                # Same shape as _search: cherche's Embedding unwraps a single query, the other
+                # retrievers keep one list per query even for a string
+                return hits[0] if isinstance(query, str) and self.method == "embedding" else hits
+            return self._search(query, k)
+
+    def _search(self, query, k):
         if isinstance(query, str):
             query = [query]
 
         if self.method in ["encoder", "embedding"]:
-            query_embeddings = self.encoder_model.encode(query)
+            query_embeddings = self.query_cache.encode(query, self.encoder_model.encode)
             return self.retriever(q=query_embeddings, k=k)
         elif self.method == "dpr":
             query_embeddings = self.query_encoder(query)
@@ -113,6 +216,284 @@ class DocumentRetriever:
         else:
             return self.retriever(query, k=k)
 
+    def retrieve_batch(self, queries, k=10, batch_size=64, where=None):
+        """
+        Retrieves documents for many queries at once, batch_size queries at a time.
+
+        Embedding queries are encoded together and searched with one FAISS call per batch;
+        bm25/tfidf score each batch as a single query-matrix x document-matrix product.
+        Unlike retrieve, the result always holds one list of hits per query. Queries seen
+        since the last change to the index are answered from the result cache. where filters
+        every query, see retrieve.
+        """
+        return self.query_cache.retrieve_batch((self.method, where_key(where)), self.version, list(queries), k, lambda missing: self._retrieve_batch(missing, k, batch_size, where))
+
+    def _retrieve_batch(self, queries, k, batch_size, where=None):
+        with metrics.stage("search", method=self.method):
+            if where is not None:
+                return [hits for batch in batched(queries, batch_size) for hits in self._search_filtered(batch, k, where, batch_size)]
+            return self._search_batch(queries, k, batch_size)
+
+    def _search_filtered(self, queries, k, where, batch_size=64):
+        # One list of hits per query, among the documents matching where
+        if self.method == "embedding":
+            query_embeddings = self.query_cache.encode(queries, lambda texts: self.encoder_model.encode(texts, batch_size=batch_size))
+            return self.retriever.index(query_embeddings, k=k, where=where)
+        if self.method in ["bm25", "tfidf"]:
+            return self._sparse_metadata()(queries, k=k, batch_size=batch_size, where=where)
+        from .fuzzy import FuzzyIndex
+
+        if self.method == "fuzz" and isinstance(getattr(self.retriever, "retriever", self.retriever), FuzzyIndex):
+            return self.retriever(queries, k=k, tqdm_bar=False, where=where)
+        # lunr and flash rank all their matches, which are filtered on the stored documents
+        check_fields(where, self.metadata_fields)
+        ranked = self.retriever(queries, tqdm_bar=False) if self.method == "flash" else self.retriever(queries, k=None, tqdm_bar=False)
+        return [
+            [hit for hit in hits if matches(self.documents.get(hit[self.key]) or {}, where)][:k]
+            for hits in ranked
+        ]
+
+    def _sparse_metadata(self):
+        # Metadata of the bm25/tfidf columns, read from the store on the first filtered search
+        retriever = self._live()
+        if retriever.metadata is None:
+            keys = (retriever._document(position)[self.key] for position in range(len(retriever.alive)))
+            retriever.metadata = MetadataIndex(self.metadata_fields).append(self.documents.get(key) or {} for key in keys)
+        return retriever
+
+    def _search_batch(self, queries, k, batch_size):
+        results = []
+        for batch in batched(queries, batch_size):
+            if self.method == "embedding":
+                query_embeddings = self.query_cache.encode(batch, lambda texts: self.encoder_model.encode(texts, batch_size=batch_size))
+                results.extend(self.retriever.index(query_embeddings, k=k))
+            elif self.method in ["bm25", "tfidf"]:
+                results.extend(self.retriever(batch, k=k, batch_size=batch_size, tqdm_bar=False))
+            elif self.method == "flash":
+                results.extend(self.retriever(batch, tqdm_bar=False))
+            else:
+                results.extend(self.retriever(batch, k=k, tqdm_bar=False))
+        return results
+
+    def add(self, documents):
+        """
+        Indexes new documents without rebuilding the index; a document whose key is already
+        indexed replaces the old version.
+
+        Embeddings go straight into the FAISS index. bm25/tfidf vectorize the documents with
+        the fitted vocabulary into a delta matrix (IDF is recomputed by compact(refit=True)),
+        and lunr/flash/fuzz index them in a small side retriever. The index is compacted once
+        the changes exceed the compact_threshold fraction of it (kwarg, 0.25 by default).
+        """
+        documents = list(documents)
+        keys = [document[self.key] for document in documents]
+        self.version += 1
+        self._track(keys, documents)
+        if self.method == "embedding":
+            index = self.retriever.index
+            index.remove(keys)
+            for batch, embeddings in self._encode(documents, self._document_encoder()):
+                index.add(batch, embeddings)
+        else:
+            self._live().delete(keys).add(documents)
+        self._maybe_compact()
+        return self
+
+    def update(self, documents):
+        """Replaces indexed documents by key, see add; documents not indexed yet are added."""
+        return self.add(documents)
+
+    def delete(self, ids):
+        """Removes the documents with the given keys from the index; unknown keys are ignored."""
+        ids = list(ids)
+        self.version += 1
+        self._track(ids)
+        if self.method == "embedding":
+            self.retriever.index.remove(ids)
+        else:
+            self._live().delete(ids)
+        self._maybe_compact()
+        return self
+
+    def compact(self, refit=False):
+        """
+        Folds the changes made by add/update/delete into the main index.
+
+        bm25/tfidf merge the delta matrix and drop removed documents; with refit=True the
+        vectorizer is refitted on the current documents instead, updating the vocabulary and
+        IDF. lunr/flash/fuzz are rebuilt from the current documents, which compact first
+        drops the deleted and replaced versions from (see DocumentStore.compact).
+
+        :param refit: Rebuild the sparse index from the documents instead of merging.
+        """
+        from .live import DeltaRetriever, SparseDelta
+
+        self.version += 1
+        if self.method == "embedding":
+            self.retriever.index.compact()
+            return self
+        rebuild = refit or isinstance(self.retriever, DeltaRetriever)
+        if rebuild and self.documents is not None:
+            self.documents.compact()
+            self.retriever = self._init_retriever()
+        elif isinstance(self.retriever, SparseDelta):
+            self.retriever.compact()
+        return self
+
+    def _live(self):
+        # Static retrievers are only wrapped on their first change, so searches stay as fast
+        from .live import DeltaRetriever, SparseDelta
+
+        if self.method in ["bm25", "tfidf"] and not isinstance(self.retriever, SparseDelta):
+            self.retriever = SparseDelta(self.retriever)
+        elif self.method in ["lunr", "flash", "fuzz"] and not isinstance(self.retriever, DeltaRetriever):
+            self.retriever = DeltaRetriever(self.retriever)
+        return self.retriever
+
+    def _track(self, keys, documents=()):
+        # Keeps self.documents current so compact can rebuild from it
+        if self.method == "embedding" or self.documents is None:
+            return
+        if self.documents.read_only and not self._owns_documents:
+            # A read-only store is shared with other retrievers, which must not see this one's changes
+            self.documents = self.documents.copy()
+            self._owns_documents = True
+        replaced = {document[self.key] for document in documents}
+        self.documents.delete([key for key in keys if key not in replaced])
+        self.documents.extend(documents)
+
+    def _maybe_compact(self):
+        if self.method == "embedding":
+            changed = self.retriever.index.deleted_fraction
+        else:
+            changed = self.retriever.changed_fraction
+        if changed > self.kwargs.get("compact_threshold", 0.25):
+            self.compact()
+
+    def cache_stats(self):
+        """Hit rates of the result and query-embedding caches, and of the document embedding cache."""
+        stats = self.query_cache.stats()
+        if self.cache is not None:
+            stats["document_embeddings"] = self.cache.stats()
+        return stats
+
+    def close(self):
+        """Releases this retriever's reference to the shared encoder model (also done on garbage collection)."""
+        release_models(self)
+
+    def save(self, path):
+        """
+        Saves the index to the directory path so that it can be loaded without re-indexing.
+
+        The FAISS index and document keys of the embedding method and the sparse matrix of
+        bm25/tfidf are written as raw arrays that load can memory-map; the remaining state
+        (vocabulary, id mapping, settings) is pickled. Flash keyword tries are too deep to
+        pickle and are rebuilt from the keyword -> documents mapping on load. The documents of
+        the sparse methods are saved as a DocumentStore, for compact and materializing hits.
+        """
+        os.makedirs(path, exist_ok=True)
+        state = {"method": self.method, "key": self.key, "on": self.on, "kwargs": self.kwargs, "retriever": None}
+        matrix = None
+        flash = _flash_retrievers(self.retriever)
+        keywords = [retriever.keywords for retriever in flash]
+        for retriever in flash:
+            retriever.keywords = None
+        if self.method == "embedding":
+            self.retriever.index.save(os.path.join(path, "faiss"))
+        else:
+            if self.documents is not None:
+                self.documents.save(os.path.join(path, "documents"))
+            state["retriever"] = self.retriever
+            matrix = getattr(self.retriever, "matrix", None)
+            if matrix is not None:
+                _save_sparse_matrix(os.path.join(path, "matrix"), matrix)
+                self.retriever.matrix = None
+        try:
+            with open(os.path.join(path, "retriever.pkl"), "wb") as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        finally:
+            if matrix is not None:
+                self.retriever.matrix = matrix
+            for retriever, processor in zip(flash, keywords):
+                retriever.keywords = processor
+
+    @classmethod
+    def load(cls, path, mmap=True, use_gpu=False):
+        """
+        Loads a retriever written by save.
+
+        :param path: Directory passed to save.
+        :param mmap: Memory-map the FAISS index and sparse matrix instead of reading them into RAM.
+        :param use_gpu: Load the embedding model (and index) on the GPU.
+        """
+        with open(os.path.join(path, "retriever.pkl"), "rb") as f:
+            state = pickle.load(f)
+        self = cls.__new__(cls)
+        self.method = state["method"]
+        documents_path = os.path.join(path, "documents")
+        self.documents = DocumentStore.load(documents_path, mmap=mmap) if os.path.isdir(documents_path) else None
+        self._owns_documents = False
+        self.key = state["key"]
+        self.on = state["on"]
+        self.use_gpu = use_gpu
+        self.kwargs = state["kwargs"]
+        self.metadata_fields = self.kwargs.get("metadata_fields", DEFAULT_METADATA_FIELDS)
+        self.retriever = state["retriever"]
+        self.encoder_model = None
+        self.query_encoder = None
+        self.cache = None
+        self.version = 0
+        self.query_cache = self._init_query_cache()
+
+        if self.method == "embedding":
+            model_name = self.kwargs.get("model_name", "sentence-transformers/all-mpnet-base-v2")
+            self.encoder_model = acquire_model(self, model_name, device="cuda" if use_gpu else "cpu")
+            self.cache = get_cache(self.kwargs.get("cache_dir", DEFAULT_CACHE_DIR), model_name)
+            from .dense import FaissIndex
+            index = FaissIndex.load(os.path.join(path, "faiss"), mmap=mmap and not use_gpu)
+            if use_gpu:
+                import faiss
+                index.index = faiss.index_cpu_to_gpu(faiss.StandardGpuResources(), 0, index.index)
+            from cherche import retrieve
+
+            self.retriever = retrieve.Embedding(key=self.key)
+            self.retriever.index = index
+        elif os.path.isdir(os.path.join(path, "matrix")):
+            self.retriever.matrix = _load_sparse_matrix(os.path.join(path, "matrix"), mmap=mmap)
+        for retriever in _flash_retrievers(self.retriever):
+            from flashtext import KeywordProcessor
+
+            if retriever.keywords is None:
+                retriever.keywords = KeywordProcessor()
+                retriever.keywords.add_keywords_from_list(list(retriever.documents))
+        return self
+
+
+def _flash_retrievers(retriever):
+    # A Flash retriever, or the original and side retrievers of a DeltaRetriever over one
+    from cherche import retrieve
+
+    candidates = [retriever, getattr(retriever, "retriever", None), getattr(retriever, "delta", None)]
+    return [candidate for candidate in candidates if isinstance(candidate, retrieve.Flash)]
+
+
+def _save_sparse_matrix(path, matrix):
+    from scipy.sparse import csr_matrix
+
+    os.makedirs(path, exist_ok=True)
+    matrix = csr_matrix(matrix)
+    for name in ("data", "indices", "indptr"):
+        np.save(os.path.join(path, f"{name}.npy"), getattr(matrix, name))
+    np.save(os.path.join(path, "shape.npy"), np.asarray(matrix.shape, dtype=np.int64))
+
+
+def _load_sparse_matrix(path, mmap=True):
+    from scipy.sparse import csr_matrix
+
+    arrays = [np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r" if mmap else None) for name in ("data", "indices", "indptr")]
+    shape = tuple(np.load(os.path.join(path, "shape.npy")))
+    return csr_matrix(tuple(arrays), shape=shape, copy=False)
+
 
 '''
 # Example Usage
@@ -0,0 +1,127 @@
+from concurrent.futures import ThreadPoolExecutor
+
+FUSIONS = ("rrf", "weighted")
+
+# Rank offset of reciprocal rank fusion; 60 is the usual choice and damps the weight of the top ranks
+RRF_K = 60
+
+# Hits fetched from each retriever before fusion, at least k
+DEFAULT_CANDIDATES = 50
+
+
+def rrf(rankings, key="id", weights=None, rrf_k=RRF_K):
+    """
+    Reciprocal rank fusion: a document scores sum(weight / (rrf_k + rank)) over the rankings it appears in.
+
+    :param rankings: Lists of hits ({key, "similarity"}), best first.
+    :param weights: One weight per ranking, 1 by default.
+    :return: Dict of document key -> fused score.
+    """
+    weights = weights or [1.0] * len(rankings)
+    scores = {}
+    for ranking, weight in zip(rankings, weights):
+        for rank, hit in enumerate(ranking, start=1):
+            scores[hit[key]] = scores.get(hit[key], 0.0) + weight / (rrf_k + rank)
+    return scores
+
+
+def weighted_scores(rankings, key="id", weights=None):
+    """
+    Weighted sum of the similarities, min-max normalized to [0, 1] within each ranking so that
+    BM25 scores and cosine similarities are comparable.
+
+    :return: Dict of document key -> fused score.
+    """
+    weights = weights or [1.0] * len(rankings)
+    scores = {}
+    for ranking, weight in zip(rankings, weights):
+        if not ranking:
+            continue
+        similarities = [float(hit["similarity"]) for hit in ranking]
+        low, high = min(similarities), max(similarities)
+        for hit, similarity in zip(ranking, similarities):
+            normalized = (similarity - low) / (high - low) if high > low else 1.0
+            scores[hit[key]] = scores.get(hit[key], 0.0) + weight * normalized
+    return scores
+
+
+class HybridRetriever:
+    def __init__(self, sparse, dense, fusion="rrf", weights=(1.0, 1.0), candidates=DEFAULT_CANDIDATES, rrf_k=RRF_K, key="id"):
+        """
+        Runs a sparse and a dense retriever concurrently and fuses their rankings.
+
+        The sparse search runs on a worker thread while the dense one runs in the calling
+        thread; faiss, numpy and the encoder release the GIL, so a query costs about the
+        slower of the two rather than their sum. Build both retrievers on the same documents
+        list (see main.build_retriever) so the corpus is held once.
+
+        :param sparse: Sparse retriever, e.g. a golden bm25 or tfidf DocumentRetriever.
+        :param dense: Dense retriever: golden embedding, encoder.DocumentRetriever or DPRRetriever.
+        :param fusion: "rrf" (reciprocal rank fusion) or "weighted" (normalized score sum).
+        :param weights: Weights of the sparse and dense rankings.
+        :param candidates: Hits fetched from each retriever before fusion, raised to k if smaller.
+        :param rrf_k: Rank offset of reciprocal rank fusion.
+        :param key: Identifier field of the documents.
+        """
+        if fusion not in FUSIONS:
+            raise ValueError(f"Unknown fusion '{fusion}', expected one of {FUSIONS}")
+        self.sparse = sparse
+        self.dense = dense
+        self.fusion = fusion
+        self.weights = list(weights)
+        self.candidates = candidates
+        self.rrf_k = rrf_k
+        self.key = key
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def _fuse(self, sparse_hits, dense_hits, k):
+        rankings = [sparse_hits, dense_hits]
+        if self.fusion == "rrf":
+            scores = rrf(rankings, key=self.key, weights=self.weights, rrf_k=self.rrf_k)
+        else:
+            scores = weighted_scores(rankings, key=self.key, weights=self.weights)
+        best = sorted(scores, key=scores.get, reverse=True)[:k]
+        return [{self.key: key, "similarity": scores[key]} for key in best]
+
+    def retrieve_batch(self, queries, k=10, batch_size=64, where=None):
+        """
+        Retrieves the fused top k documents for each query.
+
+        :param where: Metadata filter applied by both retrievers, see filters.MetadataIndex.
+        :return: One list of {key, "similarity"} hits per query, best first.
+        """
+        queries = list(queries)
+        candidates = max(k, self.candidates)
+        sparse = self.executor.submit(self.sparse.retrieve_batch, queries, candidates, batch_size, where)
+        dense_results = self.dense.retrieve_batch(queries, k=candidates, batch_size=batch_size, where=where)
+        sparse_results = sparse.result()
+        return [self._fuse(sparse_hits, dense_hits, k) for sparse_hits, dense_hits in zip(sparse_results, dense_results)]
+
+    def retrieve(self, query, k=10, where=None):
+        """Retrieves the fused top k documents for a query, or one list of hits per query for a list of queries."""
+        if isinstance(query, str):
+            return self.retrieve_batch([query], k=k, where=where)[0]
+        return self.retrieve_batch(query, k=k, where=where)
+
+    def add(self, documents):
+        """Indexes documents in both retrievers, replacing those whose key is already indexed."""
+        documents = list(documents)
+        self.sparse.add(documents)
+        self.dense.add(documents)
+        return self
+
+    def update(self, documents):
+        return self.add(documents)
+
+    def delete(self, ids):
+        ids = list(ids)
+        self.sparse.delete(ids)
+        self.dense.delete(ids)
+        return self
+
+    def close(self):
+        """Stops the worker thread and releases the retrievers' models."""
+        self.executor.shutdown(wait=False)
+        for retriever in (self.sparse, self.dense):
+            if hasattr(retriever, "close"):
+                retriever.close()
@@ -0,0 +1,216 @@
+import numpy as np
+from cherche import retrieve
+from scipy.sparse import csc_matrix, csr_matrix, hstack
+
+from .docstore import KeyView
+from .fuzzy import FuzzyIndex
+from .utils import batched
+
+
+class SparseDelta:
+    def __init__(self, retriever):
+        """
+        Makes a cherche TfIdf or BM25 retriever mutable without refitting it.
+
+        Added documents are vectorized with the fitted vocabulary and IDF into a small delta
+        matrix that is scored next to the main one, and removed documents are masked out of
+        the scores, so a change costs about as much as vectorizing the changed documents.
+        compact merges the delta into the main matrix and drops the removed columns. Terms
+        unseen when the vectorizer was fitted are ignored until the retriever is rebuilt.
+
+        Once metadata is set (a filters.MetadataIndex over the columns, main then delta),
+        searches take a where clause whose mask zeroes the scores of the other documents
+        like the removed ones, so filtering costs one lookup per non-zero score.
+
+        :param retriever: cherche TfIdf or BM25 retriever.
+        """
+        self.retriever = retriever
+        self.key = retriever.key
+        self.on = retriever.on
+        self.delta = None
+        self.delta_documents = []
+        self.alive = np.ones(len(retriever.documents), dtype=bool)
+        self.removed = 0
+        self.metadata = None
+        self._positions = None
+
+    @property
+    def matrix(self):
+        return self.retriever.matrix
+
+    @matrix.setter
+    def matrix(self, matrix):
+        self.retriever.matrix = matrix
+
+    def __len__(self):
+        return len(self.alive) - self.removed
+
+    @property
+    def changed_fraction(self):
+        """Share of the columns that are either in the delta or removed."""
+        return (len(self.delta_documents) + self.removed) / max(len(self.alive), 1)
+
+    def _document(self, position):
+        base = len(self.retriever.documents)
+        return self.retriever.documents[position] if position < base else self.delta_documents[position - base]
+
+    def _position_map(self):
+        if self._positions is None:
+            self._positions = {
+                self._document(position)[self.key]: position
+                for position in np.flatnonzero(self.alive).tolist()
+            }
+        return self._positions
+
+    def add(self, documents):
+        documents = list(documents)
+        if not documents:
+            return self
+        matrix = csc_matrix(
+            self.retriever.tfidf.transform([" ".join([doc.get(field, "") for field in self.on]) for doc in documents]),
+            dtype=np.float32,
+        ).T
+        self.delta = matrix if self.delta is None else hstack((self.delta, matrix), format="csr")
+        positions = self._position_map()
+        first = len(self.alive)
+        for offset, document in enumerate(documents):
+            positions[document[self.key]] = first + offset
+            self.delta_documents.append({self.key: document[self.key]})
+        if self.metadata is not None:
+            self.metadata.append(documents)
+        self.alive = np.concatenate([self.alive, np.ones(len(documents), dtype=bool)])
+        self.retriever.n = len(self.alive)
+        return self
+
+    def delete(self, keys):
+        positions = self._position_map()
+        for key in keys:
+            position = positions.pop(key, None)
+            if position is not None:
+                self.alive[position] = False
+                self.removed += 1
+        return self
+
+    def __call__(self, q, k=None, batch_size=None, where=None, **kwargs):
+        """
+        Same interface and output as cherche's TfIdf.__call__, without the progress bar.
+
+        :param where: Metadata filter, see filters.MetadataIndex; needs metadata.
+        """
+        k = k if k is not None else len(self)
+        alive = self.alive if self.removed else None
+        if where is not None:
+            if self.metadata is None:
+                raise ValueError("Set the metadata of the documents to filter on them")
+            alive = self.metadata.mask(where) if alive is None else alive & self.metadata.mask(where)
+        ranked = []
+        for batch in batched([q] if isinstance(q, str) else q, batch_size or self.retriever.batch_size):
+            vectors = self.retriever.tfidf.transform(batch)
+            similarities = vectors.dot(self.retriever.matrix)
+            if self.delta is not None:
+                similarities = hstack((similarities, vectors.dot(self.delta)), format="csr")
+            similarities = csr_matrix(similarities)
+            if alive is not None:
+                similarities.data *= alive[similarities.indices]
+                similarities.eliminate_zeros()
+            batch_match, batch_similarities = self.retriever.top_k(similarities=-1 * similarities, k=k)
+            for match, scores in zip(batch_match, batch_similarities):
+                ranked.append([
+                    {**self._document(idx), "similarity": similarity}
+                    for idx, similarity in zip(match, scores)
+                    if similarity > 0
+                ])
+        return ranked[0] if isinstance(q, str) else ranked
+
+    def compact(self):
+        """Merges the delta into the main matrix and drops the columns of removed documents."""
+        matrix = self.retriever.matrix
+        keys = [document[self.key] for document in self.retriever.documents] + [document[self.key] for document in self.delta_documents]
+        if self.delta is not None:
+            matrix = hstack((matrix, self.delta), format="csr")
+        if self.removed:
+            keep = np.flatnonzero(self.alive)
+            matrix = csr_matrix(matrix)[:, keep]
+            keys = [keys[position] for position in keep.tolist()]
+            if self.metadata is not None:
+                self.metadata = self.metadata.take(keep)
+        self.retriever.matrix = csr_matrix(matrix, dtype=np.float32)
+        self.retriever.documents = KeyView(self.key, np.asarray(keys, dtype=np.int64) if all(isinstance(key, int) for key in keys) else keys)
+        self.retriever.duplicates = {}
+        self.retriever.n = len(keys)
+        self.delta = None
+        self.delta_documents = []
+        self.alive = np.ones(len(keys), dtype=bool)
+        self.removed = 0
+        self._positions = None
+        return self
+
+
+class DeltaRetriever:
+    def __init__(self, retriever):
+        """
+        Makes a cherche Lunr or Flash retriever, or a FuzzyIndex, mutable.
+
+        The original retriever is left untouched: documents deleted or replaced since it was
+        built are filtered out of its results, and added or updated documents go to a small
+        retriever of the same kind, rebuilt on the first query after a change. Both result
+        lists are merged by similarity. Folding the delta back in needs the full documents,
+        see DocumentRetriever.compact.
+
+        :param retriever: cherche Lunr, Flash or Fuzz retriever, or a FuzzyIndex.
+        """
+        self.retriever = retriever
+        self.key = retriever.key
+        self.on = retriever.on
+        self.hidden = set()  # Keys whose version in the original retriever is no longer valid
+        self.delta_documents = {}
+        self.delta = None
+        self._stale = False
+
+    @property
+    def changed_fraction(self):
+        return (len(self.hidden) + len(self.delta_documents)) / max(len(self.retriever), 1)
+
+    def build(self, documents):
+        """Creates a retriever of the same kind and settings as the original over documents."""
+        if isinstance(self.retriever, FuzzyIndex):
+            return self.retriever.empty().add(documents)
+        if isinstance(self.retriever, retrieve.Lunr):
+            return retrieve.Lunr(key=self.key, on=self.on, documents=documents)
+        if isinstance(self.retriever, retrieve.Flash):
+            retriever = retrieve.Flash(key=self.key, on=self.on, lowercase=self.retriever.lowercase)
+        else:
+            retriever = retrieve.Fuzz(key=self.key, on=self.on, fuzzer=self.retriever.fuzzer, default_process=self.retriever.default_process)
+        return retriever.add(documents)
+
+    def add(self, documents):
+        for document in documents:
+            self.hidden.add(document[self.key])
+            self.delta_documents[document[self.key]] = document
+        self._stale = True
+        return self
+
+    def delete(self, keys):
+        for key in keys:
+            self.hidden.add(key)
+            if self.delta_documents.pop(key, None) is not None:
+                self._stale = True
+        return self
+
+    def __call__(self, q, k=None, where=None, **kwargs):
+        """Searches both retrievers; where (see filters.MetadataIndex) is only supported over FuzzyIndex retrievers."""
+        queries = [q] if isinstance(q, str) else list(q)
+        # Filtered searches are only asked of retrievers that support them
+        filters = {} if where is None else {"where": where}
+        if self._stale:
+            self.delta = self.build(list(self.delta_documents.values())) if self.delta_documents else None
+            self._stale = False
+        # Hidden documents may take places in the original top k, so ask for that many more
+        base = self.retriever(queries, k=None if k is None else k + len(self.hidden), tqdm_bar=False, **filters)
+        delta = self.delta(queries, k=k, tqdm_bar=False, **filters) if self.delta is not None else [[] for _ in queries]
+        ranked = []
+        for base_hits, delta_hits in zip(base, delta):
+            hits = [hit for hit in base_hits if hit[self.key] not in self.hidden] + delta_hits
+            hits.sort(key=lambda hit: hit["similarity"], reverse=True)
+            ranked.append(hits if k is None else hits[:k])
+        return ranked[0] if isinstance(q, str) else ranked
@@ -1,49 +1,134 @@
 # main.py
 
-from .dpr import DPRRetriever
-from .encoder import DocumentRetriever as EncoderDocumentRetriever
-from .golden import DocumentRetriever as GoldenDocumentRetriever
+import importlib
+import logging
+import time
+
+from .docstore import DocumentStore
+from .metrics import configure_logging, log_event
+
+GOLDEN_METHODS = ["bm25", "tfidf", "flash", "lunr", "fuzz", "embedding"]
+
+# Method -> (module, class) of its retriever, imported on first use: a bm25 run never loads
+# the DPR/encoder code, faiss or torch
+RETRIEVER_CLASSES = {
+    **{method: (".golden", "DocumentRetriever") for method in GOLDEN_METHODS},
+    "dpr": (".dpr", "DPRRetriever"),
+    "encoder": (".encoder", "DocumentRetriever"),
+    "hybrid": (".hybrid", "HybridRetriever"),
+}
+
+# Every method main dispatches to
+METHODS = list(RETRIEVER_CLASSES)
+
+def register_method(method, module, name):
+    """
+    Adds a retrieval method: build_retriever imports module (absolute, or relative to this
+    package) on first use and builds name like the golden DocumentRetriever, i.e. with
+    method, documents, on, use_gpu, model_name and the extra keyword arguments.
+    """
+    RETRIEVER_CLASSES[method] = (module, name)
+    if method not in METHODS:
+        METHODS.append(method)
+
+def retriever_class(method):
+    """Imports and returns the retriever class of method."""
+    if method not in RETRIEVER_CLASSES:
+        raise ValueError(f"Invalid method specified: {method}")
+    module, name = RETRIEVER_CLASSES[method]
+    return getattr(importlib.import_module(module, __package__), name)
 
 def run_dpr_retriever(documents, query, k, device="cpu"):
-    print("DPRRetriever results:")
-    dpr_retriever = DPRRetriever(documents, device=device)
+    dpr_retriever = build_retriever(documents, "dpr", device=device)
     results = dpr_retriever.retrieve(query, k=k)
-    print(results)
+    log_event("results", retriever="DPRRetriever", query=query, k=k, results=results)
     return results
 
 def run_encoder_retriever(documents, query, k, model_name="sentence-transformers/all-mpnet-base-v2", device="cpu"):
-    print("\nEncoderDocumentRetriever results:")
-    encoder_retriever = EncoderDocumentRetriever(documents, model_name=model_name, device=device)
+    encoder_retriever = build_retriever(documents, "encoder", model_name=model_name, device=device)
     results = encoder_retriever.retrieve(query, k=k)
-    print(results)
+    log_event("results", retriever="EncoderDocumentRetriever", query=query, k=k, results=results)
     return results
 
 def run_golden_retriever(documents, query, method, k, model_name="sentence-transformers/all-mpnet-base-v2", use_gpu=False):
-    print(f"\nGoldenDocumentRetriever results using method '{method}':")
     try:
-        golden_retriever = GoldenDocumentRetriever(
-            method=method,
-            documents=documents,
-            on=["text"],
-            use_gpu=use_gpu,
-            model_name=model_name
-        )
+        golden_retriever = build_retriever(documents, method, model_name=model_name, device="cuda" if use_gpu else "cpu")
         results = golden_retriever.retrieve(query, k=k)
-        print(results)
+        log_event("results", retriever="GoldenDocumentRetriever", method=method, query=query, k=k, results=results)
         return results
     except Exception as e:
-        print("ERROR")
-        print(e)
+        log_event("error", level=logging.ERROR, retriever="GoldenDocumentRetriever", method=method, message=str(e))
+
+def run_hybrid_retriever(documents, query, k, model_name="sentence-transformers/all-mpnet-base-v2", device="cpu"):
+    hybrid_retriever = build_retriever(documents, "hybrid", model_name=model_name, device=device)
+    results = hybrid_retriever.retrieve(query, k=k)
+    # bm25 + embedding, reciprocal rank fusion
+    log_event("results", retriever="HybridRetriever", query=query, k=k, results=results)
+    return results
 
 def main(documents, query, method, k):
     if method == "dpr":
-        run_dpr_retriever(documents, query, k)
+        return run_dpr_retriever(documents, query, k)
     elif method == "encoder":
-        run_encoder_retriever(documents, query, k)
-    elif method in ["bm25", "tfidf", "flash", "lunr", "fuzz", "embedding"]:
-        run_golden_retriever(documents, query, method, k)
+        return run_encoder_retriever(documents, query, k)
+    elif method == "hybrid":
+        return run_hybrid_retriever(documents, query, k)
+    elif method in RETRIEVER_CLASSES:
+        return run_golden_retriever(documents, query, method, k)
     else:
-        print("Invalid method specified.")
+        log_event("error", level=logging.ERROR, message="Invalid method specified.", method=method)
+
+def build_retriever(documents, method, model_name="sentence-transformers/all-mpnet-base-v2", device="cpu", **kwargs):
+    """
+    Builds the retriever of a method; extra keyword arguments (cache_dir, query_cache_size, ...)
+    are passed on to the retriever constructors. Only the modules of method are imported.
+    """
+    retriever = retriever_class(method)
+    if method == "dpr":
+        return retriever(documents, device=device, **kwargs)
+    elif method == "encoder":
+        return retriever(documents, model_name=model_name, device=device, **kwargs)
+    elif method == "hybrid":
+        # Both retrievers index the same store, so the documents are held once
+        documents = DocumentStore.build(documents)
+        sparse = build_retriever(documents, "bm25", **kwargs)
+        dense = build_retriever(documents, "embedding", model_name=model_name, device=device, **kwargs)
+        return retriever(sparse, dense)
+    return retriever(method=method, documents=documents, on=["text"], use_gpu=device == "cuda", model_name=model_name, **kwargs)
+
+def measure_throughput(retriever, queries, k, batch_size=64):
+    """Times a per-query retrieve loop against retrieve_batch over the same queries and reports queries/sec."""
+    start = time.perf_counter()
+    for query in queries:
+        retriever.retrieve(query, k=k)
+    loop_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    results = retriever.retrieve_batch(queries, k=k, batch_size=batch_size)
+    batch_seconds = time.perf_counter() - start
+
+    stats = {
+        "queries": len(queries),
+        "loop_qps": len(queries) / loop_seconds if loop_seconds else float("inf"),
+        "batch_qps": len(queries) / batch_seconds if batch_seconds else float("inf"),
+    }
+    stats["speedup"] = loop_seconds / batch_seconds if batch_seconds else float("inf")
+    return stats, results
+
+def main_batch(documents, queries, method, k, batch_size=64):
+    retriever = build_retriever(documents, method)
+    stats, results = measure_throughput(retriever, queries, k, batch_size=batch_size)
+    log_event("throughput", method=method, **stats)
+    return results
+
+def main_rerank(documents, query, method, k, n=100, time_budget=None, scorer=None):
+    from .rerank import RerankPipeline
+    documents = DocumentStore.build(documents)
+    pipeline = RerankPipeline(build_retriever(documents, method), documents, scorer=scorer, n=n, time_budget=time_budget)
+    results = pipeline.retrieve(query, k=k)
+    stages = pipeline.stats()["stages"]
+    log_event("results", retriever="RerankPipeline", method=method, n=n, stages=stages, query=query, k=k, results=results)
+    return results
 
 if __name__ == "__main__":
     # Example parameters for standalone execution
@@ -53,8 +138,9 @@ if __name__ == "__main__":
     #    {"id": 2, "text": "The City of Paris is the centre and seat of government of the region and province of Île-de-France.", "title": "Paris", "url": "https://en.wikipedia.org/wiki/Paris"}
     #]
     #query = "Paris"
-    #method = "bm25"  # Replace with "dpr", "encoder", or any valid Golden Retriever method
+    #method = "bm25"  # Replace with "dpr", "encoder", "hybrid", or any valid Golden Retriever method
     #k = 3  # Number of results to retrieve
 
     # Call main with parameters
+    configure_logging()
     main(documents, query, method, k)
@@ -0,0 +1,260 @@
+import contextlib
+import cProfile
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+
+logger = logging.getLogger("retrievers")
+
+# Environment variables turning on the profiling hooks of the process-wide metrics
+PROFILE_DIR_ENV = "RETRIEVERS_PROFILE_DIR"
+TRACEMALLOC_ENV = "RETRIEVERS_TRACEMALLOC"
+
+PROMETHEUS_PREFIX = "retrievers"
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def _label_text(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+
+class Metrics:
+    def __init__(self, profile_dir=None, trace_memory=False):
+        """
+        Counters and per-stage timers of the upload -> extract -> index -> query pipeline.
+
+        Stages are timed with the stage() context manager; counters (files, pages, paragraphs,
+        texts encoded, vectors searched, ...) are bumped with count(). Both take optional
+        labels, e.g. the retrieval method. Each finished stage is logged at DEBUG level as a
+        structured event, so logging costs nothing unless enabled, see configure_logging.
+
+        :param profile_dir: If set, each outermost stage runs under cProfile and its stats are
+                            dumped to <profile_dir>/<stage>-<pid>-<n>.prof.
+        :param trace_memory: Record the peak traced memory of each outermost stage with
+                             tracemalloc, which slows Python allocations down noticeably.
+        """
+        self.profile_dir = profile_dir
+        self.trace_memory = trace_memory
+        self.counters = {}
+        self.gauges = {}
+        self.timers = {}  # (name, labels) -> [count, total seconds, max seconds]
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._profiles = 0
+
+    def count(self, name, value=1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, value, **labels):
+        with self._lock:
+            self.gauges[_key(name, labels)] = value
+
+    def observe(self, name, seconds, **labels):
+        """Records one run of stage name that took seconds."""
+        key = _key(name, labels)
+        with self._lock:
+            timer = self.timers.get(key)
+            if timer is None:
+                self.timers[key] = [1, seconds, seconds]
+            else:
+                timer[0] += 1
+                timer[1] += seconds
+                timer[2] = max(timer[2], seconds)
+
+    @contextlib.contextmanager
+    def stage(self, name, **labels):
+        """Times the enclosed block as one run of stage name, profiling it if enabled."""
+        # cProfile and tracemalloc cover the outermost stage only: profilers cannot nest
+        outermost = not getattr(self._local, "depth", 0)
+        self._local.depth = getattr(self._local, "depth", 0) + 1
+        profiler = None
+        tracing = False
+        if outermost and self.profile_dir:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # Another profiler is active in this process
+                profiler = None
+        if outermost and self.trace_memory:
+            tracing = not tracemalloc.is_tracing()
+            if tracing:
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+        error = None
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            self._local.depth -= 1
+            self.observe(name, seconds, **labels)
+            fields = dict(labels, stage=name, seconds=seconds)
+            if error is not None:
+                fields["error"] = error
+            if profiler is not None:
+                profiler.disable()
+                fields["profile"] = self._dump_profile(profiler, name)
+            if outermost and self.trace_memory:
+                peak = tracemalloc.get_traced_memory()[1]
+                if tracing:
+                    tracemalloc.stop()
+                self.gauge("stage_peak_memory_bytes", peak, stage=name, **labels)
+                fields["peak_memory_bytes"] = peak
+            log_event("stage", level=logging.DEBUG, **fields)
+
+    def _dump_profile(self, profiler, name):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        with self._lock:
+            self._profiles += 1
+            number = self._profiles
+        path = os.path.join(self.profile_dir, f"{name}-{os.getpid()}-{number}.prof")
+        profiler.dump_stats(path)
+        return path
+
+    def take(self):
+        """
+        Returns the counters and timers recorded so far and resets them, so a worker process
+        can ship what it recorded to the parent, which adds it with merge.
+        """
+        with self._lock:
+            snapshot = {"counters": self.counters, "timers": self.timers}
+            self.counters = {}
+            self.timers = {}
+        return snapshot
+
+    def merge(self, snapshot):
+        with self._lock:
+            for key, value in snapshot["counters"].items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, (count, total, longest) in snapshot["timers"].items():
+                timer = self.timers.setdefault(key, [0, 0.0, 0.0])
+                timer[0] += count
+                timer[1] += total
+                timer[2] = max(timer[2], longest)
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.gauges = {}
+            self.timers = {}
+
+    def snapshot(self):
+        """JSON-friendly view: counters and gauges by name{labels}, and count/total/mean/max seconds per stage."""
+        with self._lock:
+            counters = {name + _label_text(labels): value for (name, labels), value in self.counters.items()}
+            gauges = {name + _label_text(labels): value for (name, labels), value in self.gauges.items()}
+            stages = {
+                name + _label_text(labels): {"count": count, "seconds": total, "mean_ms": total / count * 1000, "max_ms": longest * 1000}
+                for (name, labels), (count, total, longest) in self.timers.items()
+            }
+        return {"counters": counters, "gauges": gauges, "stages": stages}
+
+    def prometheus(self, prefix=PROMETHEUS_PREFIX):
+        """Renders the metrics in the Prometheus text exposition format."""
+        with self._lock:
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+            timers = sorted(self.timers.items())
+        lines = []
+        declared = set()
+
+        def declare(name, kind):
+            if name not in declared:
+                declared.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in counters:
+            metric = f"{prefix}_{name}_total"
+            declare(metric, "counter")
+            lines.append(f"{metric}{_label_text(labels)} {value}")
+        for (name, labels), value in gauges:
+            metric = f"{prefix}_{name}"
+            declare(metric, "gauge")
+            lines.append(f"{metric}{_label_text(labels)} {value}")
+        for (name, labels), (count, total, longest) in timers:
+            stage_labels = (("stage", name),) + labels
+            declare(f"{prefix}_stage_seconds", "summary")
+            lines.append(f"{prefix}_stage_seconds_count{_label_text(stage_labels)} {count}")
+            lines.append(f"{prefix}_stage_seconds_sum{_label_text(stage_labels)} {total}")
+        for (name, labels), (count, total, longest) in timers:
+            declare(f"{prefix}_stage_seconds_max", "gauge")
+            lines.append(f"{prefix}_stage_seconds_max{_label_text((('stage', name),) + labels)} {longest}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path, prefix=PROMETHEUS_PREFIX):
+        """Writes the Prometheus text to path through a temporary file, for a textfile collector."""
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.prometheus(prefix))
+        os.replace(tmp_path, path)
+        return path
+
+
+# Process-wide metrics recorded by upload, process, the retrievers and the server
+metrics = Metrics(profile_dir=os.environ.get(PROFILE_DIR_ENV) or None, trace_memory=bool(os.environ.get(TRACEMALLOC_ENV)))
+
+
+def instrument_encoder(encode, stage="encode"):
+    """Wraps an encode function (e.g. SentenceTransformer.encode) to time it and count the texts and words it encodes."""
+    def encoder(texts, *args, **kwargs):
+        batch = [texts] if isinstance(texts, str) else texts
+        with metrics.stage(stage):
+            embeddings = encode(texts, *args, **kwargs)
+        metrics.count("encoded_texts", len(batch), stage=stage)
+        metrics.count("encoded_words", sum(len(text.split()) for text in batch), stage=stage)
+        return embeddings
+    return encoder
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as one JSON object per line, with the fields passed to log_event."""
+
+    def format(self, record):
+        entry = {
+            "time": round(record.created, 6),
+            "level": record.levelname,
+            "logger": record.name,
+            "event": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=_json_default)
+
+
+def _json_default(value):
+    # NumPy scalars (similarities) expose .item()
+    if hasattr(value, "item"):
+        return value.item()
+    return str(value)
+
+
+def log_event(event, level=logging.INFO, **fields):
+    """Logs a structured event; the fields are only serialized when the level is enabled."""
+    if logger.isEnabledFor(level):
+        logger.log(level, event, extra={"fields": fields})
+
+
+def configure_logging(level=logging.INFO, stream=None):
+    """Sends the retrievers logs to stream (stderr by default) as JSON lines."""
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(JsonFormatter())
+    logger.handlers[:] = [handler]
+    logger.setLevel(level)
+    logger.propagate = False
+    return logger
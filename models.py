@@ -0,0 +1,97 @@
+import os
+import threading
+import weakref
+from collections import OrderedDict
+
+# Models nobody references any more are kept loaded (least recently released first out) up to this many
+DEFAULT_MAX_IDLE_MODELS = int(os.environ.get("RETRIEVERS_MAX_IDLE_MODELS", 2))
+
+
+def load_sentence_transformer(name, device="cpu"):
+    # Imported on first load: sentence_transformers pulls in torch, seconds of startup the sparse methods never need
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(name, device=device)
+
+
+class ModelRegistry:
+    def __init__(self, max_idle=DEFAULT_MAX_IDLE_MODELS):
+        """
+        Process-wide cache of loaded SentenceTransformer (or CrossEncoder) models keyed by (name, device).
+
+        acquire returns the shared instance and increments its reference count; release
+        decrements it. Unreferenced models stay loaded in LRU order so that a retriever
+        rebuilt shortly after does not reload weights, and are evicted beyond max_idle.
+
+        :param max_idle: Number of unreferenced models kept loaded.
+        """
+        self.max_idle = max_idle
+        self._lock = threading.Lock()
+        self._models = {}
+        self._refs = {}
+        self._idle = OrderedDict()
+        self.loads = 0
+
+    def acquire(self, name, device="cpu", loader=load_sentence_transformer):
+        key = (name, device)
+        with self._lock:
+            model = self._models.get(key)
+            if model is None:
+                # Loading under the lock means concurrent acquires of the same model load it once
+                model = loader(name, device=device)
+                self._models[key] = model
+                self.loads += 1
+            self._refs[key] = self._refs.get(key, 0) + 1
+            self._idle.pop(key, None)
+            return model
+
+    def release(self, name, device="cpu"):
+        key = (name, device)
+        with self._lock:
+            if self._refs.get(key, 0) <= 0:
+                return
+            self._refs[key] -= 1
+            if self._refs[key] == 0:
+                self._idle[key] = True
+                while len(self._idle) > self.max_idle:
+                    evicted, _ = self._idle.popitem(last=False)
+                    del self._models[evicted]
+                    del self._refs[evicted]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "loaded": [f"{name} ({device})" for name, device in self._models],
+                "references": {f"{name} ({device})": refs for (name, device), refs in self._refs.items()},
+                "idle": len(self._idle),
+                "loads": self.loads,
+            }
+
+
+registry = ModelRegistry()
+
+
+def acquire_model(owner, name, device="cpu", loader=load_sentence_transformer):
+    """
+    Returns the shared model for (name, device) and ties one reference to owner.
+
+    The reference is released when owner is garbage collected, or earlier through
+    release_models(owner). loader creates the model on first use, e.g. CrossEncoder.
+    """
+    model = registry.acquire(name, device, loader=loader)
+    finalizers = owner.__dict__.setdefault("_model_finalizers", [])
+    finalizers.append(weakref.finalize(owner, registry.release, name, device))
+    return model
+
+
+def release_models(owner):
+    """Releases every model reference held by owner."""
+    for finalizer in owner.__dict__.pop("_model_finalizers", []):
+        finalizer()
+
+
+def embedding_dimension(model):
+    """Embedding dimension from the model config, falling back to encoding a probe sentence."""
+    dim = model.get_sentence_embedding_dimension()
+    if dim is None:
+        dim = model.encode("Test sentence").shape[0]
+    return dim
@@ -1,75 +1,543 @@
 import os
 import json
+import bisect
+import time
+import hashlib
+import logging
 import argparse
-import pdfplumber
-from docx import Document
-from odf.opendocument import load
-from odf.text import P
+from datetime import datetime
+import multiprocessing
+from multiprocessing.connection import wait
+from retrievers.chunking import DEFAULT_MAX_TOKENS, DEFAULT_OVERLAP, Chunker, token_counter
+from retrievers.docstore import DocumentStore
+from retrievers.metrics import configure_logging, log_event, metrics
+
+# Extractors return the paragraphs of a file as {"text"} dicts, with the 1-based "page" for pdf
+# files and "heading": True for docx/odt headings, which the chunking stage uses. Each imports its
+# parser on first use, so a folder of pdf files never loads python-docx or odfpy
 
 def extract_paragraphs_from_pdf(file_path):
+    import pdfplumber
     paragraphs = []
     try:
         with pdfplumber.open(file_path) as pdf:
-            for page in pdf.pages:
+            for page_number, page in enumerate(pdf.pages, start=1):
+                metrics.count("extracted_pages")
                 text = page.extract_text()
                 if text:
-                    paragraphs.extend(text.split('\n\n'))  # Assuming paragraphs are separated by double newlines
+                    # Assuming paragraphs are separated by double newlines; the chunker re-splits whole pages
+                    paragraphs.extend({"text": para, "page": page_number} for para in text.split('\n\n'))
     except Exception as e:
-        print(f"Error reading .pdf file '{file_path}': {e}")
+        metrics.count("extraction_errors", format=".pdf")
+        log_event("extract_error", level=logging.WARNING, path=file_path, format=".pdf", error=str(e))
     return paragraphs
 
 def extract_paragraphs_from_docx(file_path):
+    from docx import Document
     paragraphs = []
     try:
         doc = Document(file_path)
         for paragraph in doc.paragraphs:
-            paragraphs.append(paragraph.text)
+            style = paragraph.style.name if paragraph.style is not None else ""
+            paragraphs.append({"text": paragraph.text, "heading": style.startswith(("Heading", "Title"))})
     except Exception as e:
-        print(f"Error reading .docx file '{file_path}': {e}")
+        metrics.count("extraction_errors", format=".docx")
+        log_event("extract_error", level=logging.WARNING, path=file_path, format=".docx", error=str(e))
     return paragraphs
 
+def _odt_paragraphs(node, paragraphs):
+    # text:p and text:h elements in document order; getElementsByType(P) used to drop the headings
+    from odf.namespaces import TEXTNS
+    for child in node.childNodes:
+        if getattr(child, "qname", None) == (TEXTNS, 'p'):
+            paragraphs.append({"text": str(child), "heading": False})
+        elif getattr(child, "qname", None) == (TEXTNS, 'h'):
+            paragraphs.append({"text": str(child), "heading": True})
+        else:
+            _odt_paragraphs(child, paragraphs)
+
 def extract_paragraphs_from_odt(file_path):
+    from odf.opendocument import load
     paragraphs = []
     try:
         odt_file = load(file_path)
-        paragraphs_elements = odt_file.getElementsByType(P)
-        for paragraph in paragraphs_elements:
-            paragraphs.append(paragraph.textContent)
+        _odt_paragraphs(odt_file.text, paragraphs)
     except Exception as e:
-        print(f"Error reading .odt file '{file_path}': {e}")
+        metrics.count("extraction_errors", format=".odt")
+        log_event("extract_error", level=logging.WARNING, path=file_path, format=".odt", error=str(e))
     return paragraphs
 
-def extract_text_from_folder(folder_path):
-    output = []
+# Extractors by file extension
+EXTRACTORS = {
+    '.pdf': extract_paragraphs_from_pdf,
+    '.docx': extract_paragraphs_from_docx,
+    '.odt': extract_paragraphs_from_odt,
+}
+
+def register_extractor(extension, extractor):
+    """Adds a file format: extractor(file_path) returns the paragraphs of a file, as the ones above."""
+    EXTRACTORS[extension] = extractor
+
+# Output directory created inside the processed folder; never treated as input
+OUTPUT_SUBDIR = os.path.join('sys', 'temp')
+
+def extract_paragraphs(file_path):
+    """Extracts paragraphs from a supported file, or returns None for unsupported formats."""
+    extension = os.path.splitext(file_path)[1]
+    extractor = EXTRACTORS.get(extension)
+    if extractor is None:
+        return None
+    with metrics.stage("extract_file", format=extension):
+        paragraphs = extractor(file_path)
+    metrics.count("extracted_files", format=extension)
+    return paragraphs
+
+def walk_files(folder_path):
+    """Yields the paths of all files below folder_path, skipping the output directory."""
+    output_dir = os.path.normpath(os.path.join(folder_path, OUTPUT_SUBDIR))
+    for root, dirs, files in os.walk(folder_path):
+        dirs[:] = [d for d in dirs if os.path.normpath(os.path.join(root, d)) != output_dir]
+        for file_name in files:
+            yield os.path.join(root, file_name)
+
+def _extraction_worker(conn):
+    """Worker process loop: receives file paths and sends back their paragraphs and the metrics recorded reading them."""
+    # A forked worker starts with a copy of the parent's metrics, which the parent already has
+    metrics.reset()
+    while True:
+        file_path = conn.recv()
+        if file_path is None:
+            break
+        paragraphs = extract_paragraphs(file_path)
+        conn.send((paragraphs, metrics.take()))
+
+class _ExtractionProcess:
+    def __init__(self, ctx):
+        # One pipe per worker, so killing a hung worker cannot corrupt the others' channels
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_extraction_worker, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.task = None
+        self.started = None
+
+    def submit(self, task, file_path):
+        self.task = task
+        self.started = time.monotonic()
+        self.conn.send(file_path)
+
+    def stop(self, kill=False):
+        if kill:
+            self.process.kill()
+        else:
+            try:
+                self.conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        self.process.join()
+        self.conn.close()
+
+def _replace_worker(worker, ctx):
+    worker.stop(kill=True)
+    return _ExtractionProcess(ctx)
+
+def iter_files_parallel(file_paths, workers=None, timeout=None):
+    """
+    Extracts paragraphs from files on a pool of worker processes.
+
+    Files are handed out one at a time, so a slow file only occupies its own worker. A worker
+    that exceeds the timeout on a file is killed and replaced, and the file is skipped.
+    Results are yielded in the order of file_paths; workers are kept at most a few files
+    ahead of the consumer so buffered results stay bounded.
+
+    :param file_paths: List of supported file paths.
+    :param workers: Number of worker processes (defaults to the number of CPUs).
+    :param timeout: Seconds allowed per file, or None to wait indefinitely.
+    :return: Generator of each file's paragraphs, or None for files that timed out or
+             crashed their worker.
+    """
+    if not file_paths:
+        return
+    ctx = multiprocessing.get_context()
+    pool = [_ExtractionProcess(ctx) for _ in range(min(workers or os.cpu_count() or 1, len(file_paths)))]
+    max_ahead = 4 * len(pool)
+    results = {}
+    next_task = 0
+    next_result = 0
+
+    def dispatch(worker):
+        nonlocal next_task
+        if next_task < len(file_paths) and next_task < next_result + max_ahead:
+            worker.submit(next_task, file_paths[next_task])
+            next_task += 1
+        else:
+            worker.task = None
+
+    try:
+        while next_result < len(file_paths):
+            for worker in pool:
+                if worker.task is None:
+                    dispatch(worker)
+            busy = [worker for worker in pool if worker.task is not None]
+            wait_timeout = None
+            if timeout is not None:
+                wait_timeout = max(0, min(worker.started for worker in busy) + timeout - time.monotonic())
+
+            ready = wait([worker.conn for worker in busy], timeout=wait_timeout)
+            for worker in busy:
+                if worker.conn in ready:
+                    try:
+                        results[worker.task], recorded = worker.conn.recv()
+                        metrics.merge(recorded)
+                    except (EOFError, OSError):
+                        metrics.count("failed_files", reason="crash")
+                        log_event("extract_worker_crashed", level=logging.WARNING, path=file_paths[worker.task])
+                        results[worker.task] = None
+                        pool[pool.index(worker)] = worker = _replace_worker(worker, ctx)
+                elif timeout is not None and time.monotonic() - worker.started > timeout:
+                    metrics.count("failed_files", reason="timeout")
+                    log_event("extract_timeout", level=logging.WARNING, path=file_paths[worker.task], timeout=timeout)
+                    results[worker.task] = None
+                    pool[pool.index(worker)] = worker = _replace_worker(worker, ctx)
+                else:
+                    continue
+                worker.task = None
+
+            while next_result in results:
+                yield results.pop(next_result)
+                next_result += 1
+    finally:
+        for worker in pool:
+            worker.stop(kill=worker.task is not None)
+
+def extract_files_parallel(file_paths, workers=None, timeout=None):
+    """Same as iter_files_parallel, collected into a list aligned with file_paths."""
+    return list(iter_files_parallel(file_paths, workers=workers, timeout=timeout))
+
+def iter_extract_files(file_paths, workers=1, timeout=None):
+    """Yields the paragraphs of supported files in order, extracted serially or on a process pool."""
+    if workers == 1 and timeout is None:
+        return (extract_paragraphs(file_path) for file_path in file_paths)
+    return iter_files_parallel(file_paths, workers=workers, timeout=timeout)
+
+def extract_files(file_paths, workers=1, timeout=None):
+    """Extracts paragraphs from supported files, serially or on a process pool."""
+    return list(iter_extract_files(file_paths, workers=workers, timeout=timeout))
+
+def make_chunker(chunk_tokens=DEFAULT_MAX_TOKENS, chunk_overlap=DEFAULT_OVERLAP, tokenizer=None):
+    """
+    Chunker of the extracted paragraphs, or None to index them as they are.
+
+    :param chunk_tokens: Token budget of a passage, or None/0 to disable chunking.
+    :param chunk_overlap: Tokens repeated from the previous passage.
+    :param tokenizer: Model name whose tokenizer counts the tokens (e.g. the encoder's);
+                      words and punctuation are counted without one.
+    """
+    if not chunk_tokens:
+        return None
+    return Chunker(max_tokens=chunk_tokens, overlap=min(chunk_overlap, chunk_tokens // 2), count_tokens=token_counter(tokenizer))
+
+def file_metadata(folder_path, file_path):
+    """
+    Provenance carried by every passage of a file, for filtered retrieval: its "source" path
+    relative to folder_path, its "file_type" (extension without the dot), the "folder" it was
+    extracted from and, when that is a timestamped upload folder (see upload.py), the
+    "uploaded_at" time in ISO format, which sorts and compares as text.
+    """
+    folder = os.path.basename(os.path.normpath(folder_path))
+    metadata = {
+        "source": os.path.relpath(file_path, folder_path),
+        "file_type": os.path.splitext(file_path)[1].lstrip('.').lower(),
+        "folder": folder,
+    }
+    try:
+        metadata["uploaded_at"] = datetime.strptime(folder, "%Y%m%d_%H%M%S").isoformat()
+    except ValueError:
+        pass
+    return metadata
+
+def iter_passages(paragraphs, chunker=None, source=None):
+    """Yields the documents of one file without ids: its chunks, or its non-empty paragraphs (with their page) without a chunker."""
+    if chunker is not None:
+        yield from chunker.chunk(paragraphs, source=source)
+        return
+    for para in paragraphs:
+        if para["text"]:  # Ensure that we are not adding empty paragraphs
+            passage = {"text": para["text"]}
+            if para.get("page") is not None:
+                passage["page"] = para["page"]
+            yield passage
+
+def iter_text_from_folder(folder_path, workers=1, timeout=None, chunker=None, manifest=None):
+    """
+    Yields {"id", "text"} documents from the folder one at a time, in walk order, with the
+    provenance of their file (see file_metadata) and, for pdf files, their (first) "page".
+
+    With a chunker (see make_chunker), documents are token-bounded passages. Given a fresh
+    manifest ({"next_id": 1, "files": {}}), the files and id ranges of this run are recorded
+    in it, as update_text_from_folder would, so a later incremental run starts from them.
+    """
     paragraph_id = 1
 
     # Traverse the folder and subfolders
-    for root, _, files in os.walk(folder_path):
-        for file_name in files:
-            file_path = os.path.join(root, file_name)
+    file_paths = []
+    for file_path in walk_files(folder_path):
+        if os.path.splitext(file_path)[1] not in EXTRACTORS:
+            metrics.count("skipped_files")
+            log_event("skipped_file", level=logging.WARNING, path=file_path, reason="unsupported format")
+            continue
+        file_paths.append(file_path)
+
+    # Ids are assigned in walk order, so parallel extraction numbers paragraphs like a serial run
+    for file_path, paragraphs in zip(file_paths, iter_extract_files(file_paths, workers=workers, timeout=timeout)):
+        first_id = paragraph_id
+        metrics.count("extracted_paragraphs", len(paragraphs or []))
+        metadata = file_metadata(folder_path, file_path)
+        for passage in iter_passages(paragraphs or [], chunker, metadata["source"]):
+            yield {"id": paragraph_id, **passage, **metadata}
+            paragraph_id += 1
+        metrics.count("passages", paragraph_id - first_id)
+        if manifest is not None:
+            manifest["next_id"] = paragraph_id
+            # Failed files are left out so the next incremental run retries them
+            if paragraphs is not None:
+                stat = os.stat(file_path)
+                manifest["files"][os.path.relpath(file_path, folder_path)] = {
+                    "size": stat.st_size,
+                    "mtime": stat.st_mtime,
+                    "hash": hash_file(file_path),
+                    "first_id": first_id,
+                    "last_id": paragraph_id - 1,
+                }
+
+def extract_text_from_folder(folder_path, workers=1, timeout=None, chunker=None):
+    return list(iter_text_from_folder(folder_path, workers=workers, timeout=timeout, chunker=chunker))
+
+def hash_file(file_path, chunk_size=1 << 20):
+    """Returns the sha1 hex digest of a file, read in chunks."""
+    digest = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def load_manifest(manifest_path):
+    """Loads the ingestion manifest, or returns an empty one if none exists yet."""
+    if not os.path.exists(manifest_path):
+        return {"next_id": 1, "files": {}}
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+def write_json(path, data, **kwargs):
+    """Writes JSON through a temporary file so readers never see a partial file."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, **kwargs)
+    os.replace(tmp_path, path)
+
+def iter_documents(path):
+    """Lazily yields documents from a .jsonl file, or from a .json list written by older runs."""
+    if path.endswith('.jsonl'):
+        with open(path, 'r') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    else:
+        with open(path, 'r') as f:
+            data = json.load(f)
+        if isinstance(data, list):
+            yield from data
+
+def document_store_path(documents_path):
+    """Directory of the DocumentStore built from an extracted data file."""
+    return os.path.splitext(documents_path)[0] + '_store'
+
+def open_document_store(documents_path):
+    """
+    Returns the memory-mapped DocumentStore of an extracted data file, building it on first
+    use and again whenever the file is newer than the store.
+
+    The store is shared by every retriever and process opening the file, so it is read-only:
+    changes made through a retriever are compacted into a private copy, and the files keep
+    matching the extracted data (see DocumentStore.compact).
+    """
+    store_path = document_store_path(documents_path)
+    meta_path = os.path.join(store_path, 'store.json')
+    if not (os.path.exists(meta_path) and os.path.getmtime(meta_path) >= os.path.getmtime(documents_path)):
+        DocumentStore.build(iter_documents(documents_path), path=store_path)
+    return DocumentStore.load(store_path, read_only=True)
+
+def write_documents(path, documents):
+    """
+    Streams documents to path as JSON Lines (or a JSON list for a .json path) without holding
+    them in memory, through a temporary file so readers never see a partial file.
+
+    :return: Number of documents written.
+    """
+    tmp_path = path + '.tmp'
+    count = 0
+    with open(tmp_path, 'w') as f:
+        if path.endswith('.jsonl'):
+            for doc in documents:
+                f.write(json.dumps(doc) + '\n')
+                count += 1
+        else:
+            f.write('[')
+            for doc in documents:
+                f.write((',\n' if count else '\n') + json.dumps(doc))
+                count += 1
+            f.write('\n]\n')
+    os.replace(tmp_path, path)
+    return count
+
+def update_text_from_folder(folder_path, documents, manifest, workers=1, timeout=None, summary=None, chunker=None):
+    """
+    Incrementally brings documents in line with the files currently in folder_path.
+
+    The manifest maps each file (relative path) to its size, mtime, content hash and the
+    range of paragraph ids it produced. Files whose size and mtime are unchanged are not
+    read at all; files whose content hash changed are re-parsed and get fresh ids, so the
+    ids of untouched files stay stable across runs. Deleted files are tombstoned in the
+    manifest and their paragraphs dropped. Ids are never reused.
+
+    This is a generator: it yields the surviving previous paragraphs followed by the new
+    ones, and the manifest is only complete once it has been exhausted.
+
+    :param folder_path: Folder containing the documents.
+    :param documents: Iterable of previously extracted paragraphs ({"id", "text"} dicts).
+    :param manifest: Manifest returned by load_manifest; updated in place.
+    :param workers: Number of extraction processes for the changed files.
+    :param timeout: Seconds allowed per file; files that time out are retried on the next run.
+    :param summary: Optional dict that receives counts of unchanged/added/modified/deleted/failed files.
+    :param chunker: Chunker of the changed files' paragraphs, see make_chunker.
+    """
+    files = manifest["files"]
+    seen = set()
+    stale_ranges = []
+    changed = []
+    if summary is None:
+        summary = {}
+    summary.update(unchanged=0, added=0, modified=0, deleted=0, failed=0)
 
-            if file_name.endswith('.pdf'):
-                paragraphs = extract_paragraphs_from_pdf(file_path)
-            elif file_name.endswith('.docx'):
-                paragraphs = extract_paragraphs_from_docx(file_path)
-            elif file_name.endswith('.odt'):
-                paragraphs = extract_paragraphs_from_odt(file_path)
-            else:
-                print(f"Skipping unsupported file format: {file_name}")
-                continue
+    for file_path in walk_files(folder_path):
+        rel_path = os.path.relpath(file_path, folder_path)
+        if os.path.splitext(file_path)[1] not in EXTRACTORS:
+            continue
+        seen.add(rel_path)
 
-            for para in paragraphs:
-                if para:  # Ensure that we are not adding empty paragraphs
-                    output.append({"id": paragraph_id, "text": para})
-                    paragraph_id += 1
+        stat = os.stat(file_path)
+        entry = files.get(rel_path)
+        if entry and not entry.get("deleted") and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            summary["unchanged"] += 1
+            continue
 
-    return output
+        content_hash = hash_file(file_path)
+        if entry and not entry.get("deleted") and entry["hash"] == content_hash:
+            # Touched but not modified: refresh the stat fields only
+            entry.update(size=stat.st_size, mtime=stat.st_mtime)
+            summary["unchanged"] += 1
+            continue
+
+        if entry and not entry.get("deleted"):
+            # The old content is gone whether or not the new one parses
+            stale_ranges.append((entry["first_id"], entry["last_id"]))
+        changed.append((rel_path, file_path, stat, content_hash))
+
+    for rel_path, entry in files.items():
+        if rel_path not in seen and not entry.get("deleted"):
+            stale_ranges.append((entry["first_id"], entry["last_id"]))
+            entry["deleted"] = True
+            summary["deleted"] += 1
+
+    # Id ranges never overlap, so the range that could hold an id is the last one starting at or before it
+    stale_ranges = sorted((first, last) for first, last in stale_ranges if first <= last)
+    stale_starts = [first for first, _ in stale_ranges]
+    for doc in documents:
+        position = bisect.bisect_right(stale_starts, doc["id"]) - 1
+        if position < 0 or doc["id"] > stale_ranges[position][1]:
+            yield doc
+
+    paragraph_lists = iter_extract_files([file_path for _, file_path, _, _ in changed], workers=workers, timeout=timeout)
+    for (rel_path, file_path, stat, content_hash), paragraphs in zip(changed, paragraph_lists):
+        if paragraphs is None:
+            # Leave the previous entry in place so the file is picked up again next run
+            summary["failed"] += 1
+            continue
+
+        entry = files.get(rel_path)
+        summary["modified" if entry and not entry.get("deleted") else "added"] += 1
+
+        first_id = manifest["next_id"]
+        metrics.count("extracted_paragraphs", len(paragraphs))
+        metadata = file_metadata(folder_path, file_path)
+        for passage in iter_passages(paragraphs, chunker, rel_path):
+            yield {"id": manifest["next_id"], **passage, **metadata}
+            manifest["next_id"] += 1
+        metrics.count("passages", manifest["next_id"] - first_id)
+        files[rel_path] = {
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "hash": content_hash,
+            "first_id": first_id,
+            "last_id": manifest["next_id"] - 1,
+        }
+
+def process_folder(folder_path, incremental=False, workers=1, timeout=None, output_format='jsonl', chunk_tokens=DEFAULT_MAX_TOKENS, chunk_overlap=DEFAULT_OVERLAP, tokenizer=None):
+    """
+    Extracts the documents of folder_path into its sys/temp output directory.
+
+    :param folder_path: Folder containing the documents.
+    :param incremental: Only parse new or modified files, using the manifest from the previous run.
+    :param workers: Number of extraction processes (0 for one per CPU).
+    :param timeout: Seconds allowed per file before it is skipped.
+    :param output_format: 'jsonl' or 'json'.
+    :param chunk_tokens: Token budget of the passages, or None/0 to keep the extracted paragraphs.
+    :param chunk_overlap: Tokens repeated from the previous passage of the same file.
+    :param tokenizer: Model name whose tokenizer counts tokens, ideally the encoder's.
+    :return: Path of the extracted data file.
+    """
+    # Create the output directory inside destination_folder if it does not exist
+    output_dir = os.path.join(folder_path, OUTPUT_SUBDIR)
+    os.makedirs(output_dir, exist_ok=True)
+    output_file_path = os.path.join(output_dir, f'extracted_data.{output_format}')
+    manifest_path = os.path.join(output_dir, 'manifest.json')
+    chunker = make_chunker(chunk_tokens, chunk_overlap, tokenizer)
+
+    if incremental:
+        # Start from the previous output and only parse what changed since
+        manifest = load_manifest(manifest_path)
+        previous = []
+        if os.path.exists(output_file_path):
+            previous = iter_documents(output_file_path)
+        elif manifest["files"]:
+            # Without the previous output the file entries are meaningless: re-parse everything
+            manifest = {"next_id": manifest["next_id"], "files": {}}
+        documents = update_text_from_folder(folder_path, previous, manifest, workers=workers, timeout=timeout, chunker=chunker)
+    else:
+        # A full run renumbers every paragraph, so the previous manifest is replaced rather than kept
+        manifest = {"next_id": 1, "files": {}}
+        documents = iter_text_from_folder(folder_path, workers=workers, timeout=timeout, chunker=chunker, manifest=manifest)
+
+    # Stream the extracted paragraphs to disk as they are produced
+    with metrics.stage("extract"):
+        write_documents(output_file_path, documents)
+    write_json(manifest_path, manifest, indent=2)
+    return output_file_path
 
 def main():
     # Set up argument parsing
     parser = argparse.ArgumentParser(description="Extract text from documents in a specified folder.")
     parser.add_argument('folder_path', type=str, help="Path to the folder containing the documents")
+    parser.add_argument('--incremental', action='store_true', help="Only parse new or modified files, using the manifest from the previous run")
+    parser.add_argument('--workers', type=int, default=1, help="Number of extraction processes (0 for one per CPU)")
+    parser.add_argument('--timeout', type=float, default=None, help="Seconds allowed per file before it is skipped")
+    parser.add_argument('--format', choices=['jsonl', 'json'], default='jsonl', help="Output format of the extracted data")
+    parser.add_argument('--chunk-tokens', type=int, default=DEFAULT_MAX_TOKENS, help="Token budget of the passages (0 keeps the extracted paragraphs)")
+    parser.add_argument('--chunk-overlap', type=int, default=DEFAULT_OVERLAP, help="Tokens repeated from the previous passage")
+    parser.add_argument('--tokenizer', type=str, default=None, help="Model whose tokenizer counts tokens, e.g. the encoder's")
     args = parser.parse_args()
+    # Warnings go to stderr as JSON lines; stdout only carries the output path for runner.py
+    configure_logging()
 
     # Check if the provided path is a directory
     if not os.path.isdir(args.folder_path):
@@ -81,19 +549,12 @@ def main():
         print(error_file_path)  # Print path for runner.py to capture
         return
 
-    # Create the output directory inside destination_folder if it does not exist
-    output_dir = os.path.join(args.folder_path, 'sys/temp')
-    os.makedirs(output_dir, exist_ok=True)
-
-    # Process the folder and extract text
-    documents = extract_text_from_folder(args.folder_path)
-
-    # Write the extracted text data to a JSON file
-    output_file_path = os.path.join(output_dir, 'extracted_data.json')
-    with open(output_file_path, 'w') as f:
-        json.dump(documents, f, indent=2)
+    output_file_path = process_folder(
+        args.folder_path, incremental=args.incremental, workers=args.workers, timeout=args.timeout, output_format=args.format,
+        chunk_tokens=args.chunk_tokens, chunk_overlap=args.chunk_overlap, tokenizer=args.tokenizer,
+    )
 
-    # Print the path to the JSON file
+    # Print the path to the output file
     print(output_file_path)
 
 if __name__ == "__main__":
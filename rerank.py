@@ -0,0 +1,160 @@
+import time
+
+from rapidfuzz import fuzz, process, utils
+
+from .docstore import DocumentStore
+from .models import acquire_model, release_models
+from .utils import LatencyRecorder
+
+DEFAULT_CROSS_ENCODER = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+
+
+class FuzzScorer:
+    def __init__(self, scorer=fuzz.token_set_ratio):
+        """
+        Rescores candidates with a rapidfuzz scorer, see golden._init_fuzz for the available ones.
+
+        All candidates of a query are scored in one native cdist call instead of one Python
+        call per document.
+        """
+        self.scorer = scorer
+
+    def __call__(self, query, texts):
+        return process.cdist([query], texts, scorer=self.scorer, processor=utils.default_process, workers=-1)[0].tolist()
+
+
+class CrossEncoderScorer:
+    def __init__(self, model_name=DEFAULT_CROSS_ENCODER, device="cpu"):
+        """
+        Rescores candidates with a sentence-transformers cross-encoder reading (query, text) pairs.
+
+        :param model_name: Name of the cross-encoder model.
+        :param device: Device to run the model on ("cpu" or "cuda").
+        """
+        from sentence_transformers import CrossEncoder
+        self.model = acquire_model(self, model_name, device=device, loader=CrossEncoder)
+
+    def __call__(self, query, texts):
+        return self.model.predict([(query, text) for text in texts], batch_size=len(texts), show_progress_bar=False).tolist()
+
+    def close(self):
+        release_models(self)
+
+
+class RerankPipeline:
+    def __init__(self, retriever, documents, scorer=None, n=100, batch_size=32, time_budget=None, key="id", field="text"):
+        """
+        Two-stage retrieval: a cheap first stage fetches the top n candidates and a scorer
+        rescores only those.
+
+        Candidates are rescored batch_size at a time, in first-stage order. Once time_budget
+        seconds have been spent reranking a query, the remaining candidates are not rescored:
+        they keep their first-stage hit and are ranked after the rescored ones. The latency of
+        each stage is recorded so that n can be tuned against a latency target, see stats.
+
+        :param retriever: First stage, any retriever with retrieve_batch (golden, encoder, dpr, hybrid).
+        :param documents: Documents indexed by the first stage, to look up candidate texts by key;
+                          a DocumentStore is read in place instead of copying the texts.
+        :param scorer: Callable (query, texts) -> scores, higher is better; FuzzScorer() by default.
+        :param n: Number of first-stage candidates per query.
+        :param batch_size: Candidates rescored per scorer call.
+        :param time_budget: Seconds of reranking allowed per query, or None for no limit.
+        :param key: Identifier field of the documents.
+        :param field: Field holding the text the scorer reads.
+        """
+        self.retriever = retriever
+        self.scorer = scorer if scorer is not None else FuzzScorer()
+        self.n = n
+        self.batch_size = batch_size
+        self.time_budget = time_budget
+        self.key = key
+        self.field = field
+        self.store = documents if isinstance(documents, DocumentStore) else None
+        self.texts = {}
+        if self.store is None:
+            self._add_texts(documents)
+        self.latency = LatencyRecorder()
+        self.queries = 0
+        self.truncated = 0
+
+    def _add_texts(self, documents):
+        for document in documents:
+            self.texts[document[self.key]] = document.get(self.field, "")
+
+    def _text(self, key):
+        if self.store is None:
+            return self.texts.get(key, "")
+        row = self.store.row(key)
+        if row is None:
+            return ""
+        return self.store.text(row) if self.field == self.store.text_field else self.store[row].get(self.field, "")
+
+    def _rerank(self, query, hits):
+        deadline = None if self.time_budget is None else time.perf_counter() + self.time_budget
+        rescored = []
+        position = 0
+        while position < len(hits) and (deadline is None or time.perf_counter() < deadline):
+            batch = hits[position:position + self.batch_size]
+            scores = self.scorer(query, [self._text(hit[self.key]) for hit in batch])
+            rescored.extend({self.key: hit[self.key], "similarity": float(score)} for hit, score in zip(batch, scores))
+            position += len(batch)
+        if position < len(hits):
+            self.truncated += 1
+        rescored.sort(key=lambda hit: hit["similarity"], reverse=True)
+        return rescored + hits[position:]
+
+    def retrieve_batch(self, queries, k=10, batch_size=64, where=None):
+        """
+        Retrieves n candidates per query with the first stage and returns the top k after reranking.
+
+        :param where: Metadata filter of the first stage, see filters.MetadataIndex.
+        :return: One list of {key, "similarity"} hits per query, best first.
+        """
+        queries = list(queries)
+        start = time.perf_counter()
+        candidates = self.retriever.retrieve_batch(queries, k=max(k, self.n), batch_size=batch_size, where=where)
+        self.latency.record("retrieve", time.perf_counter() - start)
+        results = []
+        for query, hits in zip(queries, candidates):
+            start = time.perf_counter()
+            results.append(self._rerank(query, hits)[:k])
+            self.latency.record("rerank", time.perf_counter() - start)
+        self.queries += len(queries)
+        return results
+
+    def retrieve(self, query, k=10, where=None):
+        """Reranked top k for a query, or one list of hits per query for a list of queries."""
+        if isinstance(query, str):
+            return self.retrieve_batch([query], k=k, where=where)[0]
+        return self.retrieve_batch(query, k=k, where=where)
+
+    def add(self, documents):
+        documents = list(documents)
+        if self.store is None:
+            self._add_texts(documents)
+        else:
+            # A no-op for the documents a sparse first stage already put in the shared store
+            self.store.extend(documents)
+        self.retriever.add(documents)
+        return self
+
+    def delete(self, ids):
+        ids = list(ids)
+        self.retriever.delete(ids)
+        if self.store is not None:
+            self.store.delete(ids)
+        for key in ids:
+            self.texts.pop(key, None)
+        return self
+
+    def stats(self):
+        """
+        Latency per stage: "retrieve" per retrieve_batch call and "rerank" per query, with the
+        number of queries and how many hit the time budget.
+        """
+        return {"stages": self.latency.summary(), "queries": self.queries, "truncated": self.truncated}
+
+    def close(self):
+        for stage in (self.retriever, self.scorer):
+            if hasattr(stage, "close"):
+                stage.close()
@@ -1,35 +1,20 @@
 import json
 import os
-import subprocess
-import re
+import logging
+from upload import save_files_to_timestamped_folder
+from process import open_document_store, process_folder
 from retrievers.main import main  # Import the main function from main.py
-
-def run_command(command):
-    """Executes a shell command and returns the cleaned output."""
-    result = subprocess.run(command, capture_output=True, text=True)
-    if result.returncode != 0:
-        raise RuntimeError(f"Command '{' '.join(command)}' failed with return code {result.returncode}")
-    return result.stdout.strip()
-
-def extract_path_from_output(output):
-    """Extracts the path from the command output, removing any prefix."""
-    # Define a regular expression to capture the path after the prefix
-    match = re.search(r'(?:Files have been saved to\s)?(.+)', output)
-    if match:
-        return match.group(1)
-    raise ValueError("Unable to extract valid path from output.")
+from retrievers.metrics import configure_logging, log_event, metrics
 
 def upload_files(folder_path):
-    """Uploads files using the upload.py script and returns the destination folder path."""
-    command = ['python3', 'upload.py', folder_path]
-    output = run_command(command)
-    return extract_path_from_output(output)
+    """Uploads files in-process and returns the destination folder path."""
+    if not os.path.isdir(folder_path):
+        raise FileNotFoundError(f"The provided path '{folder_path}' is not a valid directory.")
+    return save_files_to_timestamped_folder(folder_path)
 
-def process_documents(destination_folder):
-    """Processes documents using the process.py script and returns the path to the JSON output."""
-    command = ['python3', 'process.py', destination_folder]
-    output = run_command(command)
-    return extract_path_from_output(output)
+def process_documents(destination_folder, **kwargs):
+    """Processes documents in-process and returns the path to the extracted data file."""
+    return process_folder(destination_folder, **kwargs)
 
 def load_documents(json_output_path):
     """Loads documents from the specified JSON file and ensures proper format."""
@@ -39,7 +24,6 @@ def load_documents(json_output_path):
     try:
         with open(json_output_path, 'r') as file:
             data = json.load(file)
-            print(f"Loaded data: {data}")  # Debugging line to inspect loaded data
             if isinstance(data, dict) and 'error' in data:
                 raise RuntimeError(f"Error from process.py: {data['error']}")
             if not isinstance(data, list):
@@ -57,21 +41,26 @@ def execute_retrieval(documents, query, method, k):
     """Calls the main function from main.py with the provided parameters."""
     return main(documents, query, method, k)
 
-def run_upload_script(folder_path):
-    """Handles the upload and processing of documents, and executes retrieval."""
+def run_upload_script(folder_path, metrics_path=None):
+    """
+    Handles the upload and processing of documents, and executes retrieval.
+
+    Progress and results are logged as structured events (see metrics.configure_logging).
+
+    :param metrics_path: If set, the stage timings and counters are written there in the
+                         Prometheus text format once the run ends.
+    """
     try:
         # Upload files and get destination folder
         destination_folder = upload_files(folder_path)
-        print(f"Destination Folder: {destination_folder}")
+        log_event("uploaded", destination_folder=destination_folder)
 
         # Process documents and get JSON output path
         json_output_path = process_documents(destination_folder)
-        print(f"JSON data has been saved to: {json_output_path}")
+        log_event("extracted", documents_path=json_output_path)
 
-        # Load documents from the JSON file
-        documents = load_documents(json_output_path)
-        print("Extracted Documents:")
-        print(json.dumps(documents, indent=2))
+        # Columnar, memory-mapped store of the extracted documents, shared by the retrievers
+        documents = open_document_store(json_output_path)
 
         # Define parameters for the retriever call
         query = "Musculoskeletal injury cure"  # Adjust as needed
@@ -80,22 +69,28 @@ def run_upload_script(folder_path):
 
         # Execute the main function with the retrieved documents
         similar_documents = execute_retrieval(documents, query, method, k)
-        for each in similar_documents[0]:
-            print(each)
-            print(documents[each['id']])
+
+        # Only the hits are materialized, looked up by id (ids start at 1, they are not list positions)
+        hits = similar_documents[0]
+        for each in hits:
+            log_event("hit", hit=each, document=documents.get(each['id']))
 
     except RuntimeError as e:
-        print(f"Error executing command: {e}")
+        log_event("error", level=logging.ERROR, message=f"Error executing command: {e}")
     except FileNotFoundError as e:
-        print(f"Error: {e}")
+        log_event("error", level=logging.ERROR, message=f"Error: {e}")
     except ValueError as e:
-        print(f"Error processing JSON data: {e}")
+        log_event("error", level=logging.ERROR, message=f"Error processing JSON data: {e}")
     except json.JSONDecodeError as e:
-        print(f"Error parsing JSON output: {e}")
+        log_event("error", level=logging.ERROR, message=f"Error parsing JSON output: {e}")
     except Exception as e:
-        print(f"An unexpected error occurred: {e}")
+        log_event("error", level=logging.ERROR, message=f"An unexpected error occurred: {e}")
+    finally:
+        if metrics_path:
+            metrics.write_prometheus(metrics_path)
 
 if __name__ == "__main__":
+    configure_logging()
     # Path to the folder with files to upload
     folder_path = '/home/alok/Downloads/sample'
     run_upload_script(folder_path)
@@ -0,0 +1,350 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from upload import save_files_to_timestamped_folder
+from process import iter_documents, open_document_store, process_folder
+from retrievers.main import build_retriever
+from retrievers.metrics import configure_logging, log_event, metrics
+from retrievers.utils import LatencyRecorder, percentile
+
+# Methods whose retrievers consume documents as a stream; the others share a DocumentStore
+STREAMING_METHODS = {"embedding", "encoder", "dpr"}
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error"}
+
+
+def _json_default(value):
+    # NumPy scalars (faiss/sparse similarities) expose .item()
+    if hasattr(value, "item"):
+        return value.item()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+class QueryBatcher:
+    def __init__(self, get_retriever, executor, max_batch_size=64, window=0.002):
+        """
+        Coalesces single queries that arrive within a short window into one retrieve_batch call.
+
+        :param get_retriever: Callable returning the current retriever, so re-indexing swaps it transparently.
+        :param executor: Thread pool running the CPU-bound retrieval.
+        :param max_batch_size: Flush as soon as this many queries are waiting.
+        :param window: Seconds to wait for more queries after the first one arrives.
+        """
+        self.get_retriever = get_retriever
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.window = window
+        self._pending = []
+        self._timer = None
+
+    async def submit(self, query, k):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((query, k, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        pending, self._pending = self._pending, []
+        if pending:
+            asyncio.get_running_loop().create_task(self._run(pending))
+
+    async def _run(self, pending):
+        loop = asyncio.get_running_loop()
+        k = max(k for _, k, _ in pending)
+        try:
+            retriever = self.get_retriever()
+            results = await loop.run_in_executor(
+                self.executor, retriever.retrieve_batch, [query for query, _, _ in pending], k, len(pending)
+            )
+        except Exception as e:
+            for _, _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, query_k, future), hits in zip(pending, results):
+            if not future.done():
+                future.set_result(hits[:query_k])
+
+
+class RetrievalService:
+    def __init__(self, methods, workers=4, max_batch_size=64, batch_window_ms=2.0):
+        """
+        Long-lived retrieval service: models and indexes are loaded once and shared by all requests.
+
+        :param methods: Retrieval methods to index, as accepted by main.build_retriever.
+        :param workers: Threads running encoding and search off the event loop.
+        :param max_batch_size: Largest number of concurrent queries merged into one batch.
+        :param batch_window_ms: How long a query waits for others to batch with.
+        """
+        self.methods = list(methods)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.retrievers = {}
+        self.documents_path = None
+        self.latency = LatencyRecorder()
+        self.batchers = {
+            method: QueryBatcher(lambda method=method: self.retrievers[method], self.executor, max_batch_size, batch_window_ms / 1000)
+            for method in self.methods
+        }
+        self._ingest_lock = None
+
+    def _build(self, documents_path):
+        retrievers = {}
+        shared = None
+        for method in self.methods:
+            if method in STREAMING_METHODS:
+                documents = iter_documents(documents_path)
+            else:
+                if shared is None:
+                    shared = open_document_store(documents_path)
+                documents = shared
+            retrievers[method] = build_retriever(documents, method)
+        return retrievers
+
+    def _ingest(self, folder_path, upload, incremental, workers, timeout):
+        stages = {}
+        start = time.perf_counter()
+        destination_folder = save_files_to_timestamped_folder(folder_path) if upload else folder_path
+        stages["upload"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        documents_path = process_folder(destination_folder, incremental=incremental, workers=workers, timeout=timeout)
+        stages["extract"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        retrievers = self._build(documents_path)
+        stages["index"] = time.perf_counter() - start
+        return destination_folder, documents_path, retrievers, stages
+
+    async def ingest(self, folder_path, upload=True, incremental=False, workers=1, timeout=None):
+        """Runs upload, extraction and indexing in-process, then swaps the new indexes in."""
+        if not os.path.isdir(folder_path):
+            raise ValueError(f"The provided path '{folder_path}' is not a valid directory.")
+        if self._ingest_lock is None:
+            self._ingest_lock = asyncio.Lock()
+        loop = asyncio.get_running_loop()
+        async with self._ingest_lock:
+            # Indexing runs on its own thread so queries keep being served from the old indexes
+            destination_folder, documents_path, retrievers, stages = await loop.run_in_executor(
+                None, self._ingest, folder_path, upload, incremental, workers, timeout
+            )
+            self.retrievers = retrievers
+            self.documents_path = documents_path
+        return {"destination_folder": destination_folder, "documents_path": documents_path, "stages": stages}
+
+    async def load(self, documents_path):
+        """Indexes an already extracted data file."""
+        loop = asyncio.get_running_loop()
+        self.retrievers = await loop.run_in_executor(None, self._build, documents_path)
+        self.documents_path = documents_path
+
+    async def query(self, body):
+        method = body.get("method", self.methods[0])
+        k = int(body.get("k", 10))
+        if method not in self.retrievers:
+            raise LookupError(f"Method '{method}' is not indexed")
+        where = body.get("where")
+        if "queries" in body or where is not None:
+            # Filtered queries are not coalesced: a batch shares one filter
+            loop = asyncio.get_running_loop()
+            retriever = self.retrievers[method]
+            queries = body["queries"] if "queries" in body else [body.get("query")]
+            if any(not isinstance(query, str) for query in queries):
+                raise ValueError("Expected 'query' or 'queries' in the request body")
+            results = await loop.run_in_executor(self.executor, retriever.retrieve_batch, queries, k, 64, where)
+            return {"results": results if "queries" in body else results[0]}
+        if "query" not in body:
+            raise ValueError("Expected 'query' or 'queries' in the request body")
+        return {"results": await self.batchers[method].submit(body["query"], k)}
+
+    async def dispatch(self, verb, path, body):
+        if path == "/health" and verb == "GET":
+            return 200, {"status": "ok", "methods": sorted(self.retrievers), "documents_path": self.documents_path}
+        if path == "/stats" and verb == "GET":
+            caches = {
+                method: retriever.cache_stats()
+                for method, retriever in self.retrievers.items()
+                if hasattr(retriever, "cache_stats")
+            }
+            return 200, {"latency": self.latency.summary(), "caches": caches, "pipeline": metrics.snapshot()}
+        if path == "/metrics" and verb == "GET":
+            # Prometheus text exposition format rather than JSON
+            return 200, metrics.prometheus()
+        if path == "/query" and verb == "POST":
+            return 200, await self.query(json.loads(body or b"{}"))
+        if path == "/ingest" and verb == "POST":
+            request = json.loads(body or b"{}")
+            if "folder_path" not in request:
+                raise ValueError("Expected 'folder_path' in the request body")
+            return 200, await self.ingest(
+                request["folder_path"],
+                upload=request.get("upload", True),
+                incremental=request.get("incremental", False),
+                workers=request.get("workers", 1),
+                timeout=request.get("timeout"),
+            )
+        if path in ("/health", "/stats", "/metrics", "/query", "/ingest"):
+            return 405, {"error": f"{verb} not allowed on {path}"}
+        return 404, {"error": f"Unknown path {path}"}
+
+    async def handle_connection(self, reader, writer):
+        """Minimal HTTP/1.1 handler with keep-alive and JSON bodies."""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                verb, target, version = request_line.decode("latin-1").split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                path = target.split("?", 1)[0]
+                start = time.perf_counter()
+                try:
+                    status, payload = await self.dispatch(verb, path, body)
+                except (ValueError, TypeError) as e:
+                    status, payload = 400, {"error": str(e)}
+                except LookupError as e:
+                    status, payload = 404, {"error": str(e)}
+                except Exception as e:
+                    status, payload = 500, {"error": str(e)}
+                self.latency.record(path, time.perf_counter() - start)
+
+                if isinstance(payload, str):
+                    data, content_type = payload.encode("utf-8"), "text/plain; version=0.0.4"
+                else:
+                    data, content_type = json.dumps(payload, default=_json_default).encode("utf-8"), "application/json"
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                writer.write(
+                    f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+                    f"Content-Type: {content_type}\r\n"
+                    f"Content-Length: {len(data)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1") + data
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=8080):
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        log_event("serving", methods=list(self.methods), url=f"http://{host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+
+async def _request(reader, writer, verb, path, payload=None):
+    body = json.dumps(payload).encode("utf-8") if payload is not None else b""
+    writer.write(
+        f"{verb} {path} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\n\r\n".encode("latin-1") + body
+    )
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        if name.strip().lower() == "content-length":
+            length = int(value)
+    return status, json.loads(await reader.readexactly(length))
+
+
+async def run_load(host, port, queries, method, k=10, requests=1000, concurrency=16):
+    """
+    Local load generator: concurrency keep-alive connections send single-query requests.
+
+    :return: Dict with the number of requests, errors, throughput and client-side p50/p99 latency.
+    """
+    latencies = []
+    errors = 0
+    counter = iter(range(requests))
+
+    async def client():
+        nonlocal errors
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            for i in counter:
+                start = time.perf_counter()
+                status, _ = await _request(reader, writer, "POST", "/query", {"query": queries[i % len(queries)], "method": method, "k": k})
+                latencies.append((time.perf_counter() - start) * 1000)
+                errors += status != 200
+        finally:
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    seconds = time.perf_counter() - start
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "seconds": seconds,
+        "qps": len(latencies) / seconds if seconds else None,
+        "p50_ms": percentile(latencies, 50),
+        "p99_ms": percentile(latencies, 99),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Long-lived retrieval server and local load generator.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve = subparsers.add_parser("serve", help="Load models and indexes once and answer queries over HTTP")
+    serve.add_argument('--host', type=str, default="127.0.0.1")
+    serve.add_argument('--port', type=int, default=8080)
+    serve.add_argument('--methods', type=str, default="bm25", help="Comma separated retrieval methods to index")
+    serve.add_argument('--documents', type=str, help="Extracted data file to index at startup")
+    serve.add_argument('--folder', type=str, help="Folder to upload, extract and index at startup")
+    serve.add_argument('--threads', type=int, default=4, help="Threads used for encoding and search")
+    serve.add_argument('--log-level', type=str, default="INFO", help="Level of the JSON logs written to stderr (DEBUG logs every stage)")
+
+    load = subparsers.add_parser("loadgen", help="Send concurrent queries to a running server and report latency")
+    load.add_argument('--host', type=str, default="127.0.0.1")
+    load.add_argument('--port', type=int, default=8080)
+    load.add_argument('--method', type=str, default="bm25")
+    load.add_argument('--query', type=str, action='append', help="Query to send (repeatable)")
+    load.add_argument('--k', type=int, default=10)
+    load.add_argument('--requests', type=int, default=1000)
+    load.add_argument('--concurrency', type=int, default=16)
+    args = parser.parse_args()
+
+    if args.command == "loadgen":
+        queries = args.query or ["Musculoskeletal injury cure"]
+        print(json.dumps(asyncio.run(run_load(args.host, args.port, queries, args.method, args.k, args.requests, args.concurrency))))
+        return
+
+    configure_logging(args.log_level.upper())
+
+    async def start():
+        service = RetrievalService(args.methods.split(","), workers=args.threads)
+        if args.folder:
+            await service.ingest(args.folder)
+        elif args.documents:
+            await service.load(args.documents)
+        await service.serve(args.host, args.port)
+
+    asyncio.run(start())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,296 @@
+import heapq
+import json
+import multiprocessing
+import numbers
+import os
+import threading
+import traceback
+import zlib
+from multiprocessing.connection import Client, Listener
+
+from .docstore import DocumentStore
+from .main import build_retriever, retriever_class
+
+# Start method of the shard processes: a fresh interpreter per shard, never a fork of a parent holding threads and models
+START_METHOD = "spawn"
+
+
+def shard_of(key, shards):
+    """Shard owning the document key: integer keys round-robin, other keys by a stable hash of their text."""
+    if isinstance(key, numbers.Integral):
+        return int(key) % shards
+    return zlib.crc32(str(key).encode("utf-8")) % shards
+
+
+def partition(documents, shards, key="id"):
+    """Splits documents into one list per shard, see shard_of."""
+    parts = [[] for _ in range(shards)]
+    for document in documents:
+        parts[shard_of(document[key], shards)].append(document)
+    return parts
+
+
+def merge(rankings, k):
+    """
+    Merges the top k hits of every shard into the overall top k with a heap.
+
+    Shards hold disjoint documents, so the hits are simply ranked by similarity; equal
+    similarities keep shard order.
+    """
+    return heapq.nlargest(k, (hit for ranking in rankings for hit in ranking), key=lambda hit: hit.get("similarity", 0.0))
+
+
+def _build_shard(documents, method, shard, shards, key, kwargs):
+    if isinstance(documents, DocumentStore):
+        # A mapped store reaches every shard as its path, and each keeps only its own documents
+        documents = [document for document in documents if shard_of(document[key], shards) == shard]
+    return build_retriever(documents, method, **kwargs)
+
+
+def _load_shard(method, path, kwargs):
+    return retriever_class(method).load(path, **kwargs)
+
+
+def _serve(connection, build, args, initializer=None, initargs=()):
+    """
+    Runs initializer(*initargs) if given and builds a shard's retriever with build(*args), then answers the commands of a
+    ShardedRetriever on connection until it closes: ("retrieve_batch", queries, k, batch_size, where),
+    ("add", documents), ("delete", ids), ("save", path) and ("close",). Every command gets an
+    ("ok", value) or ("error", traceback) reply; the first one answers the build.
+    """
+    try:
+        if initializer is not None:
+            initializer(*initargs)
+        retriever = build(*args)
+        connection.send(("ok", None))
+    except Exception:
+        connection.send(("error", traceback.format_exc()))
+        return
+    while True:
+        try:
+            command, *arguments = connection.recv()
+        except EOFError:
+            break
+        if command == "close":
+            break
+        try:
+            if command == "retrieve_batch":
+                value = retriever.retrieve_batch(*arguments)
+            elif command in ("add", "delete"):
+                getattr(retriever, command)(*arguments)
+                value = None
+            elif command == "save":
+                value = retriever.save(*arguments)
+            else:
+                raise ValueError(f"Unknown shard command '{command}'")
+            connection.send(("ok", value))
+        except Exception:
+            connection.send(("error", traceback.format_exc()))
+    if hasattr(retriever, "close"):
+        retriever.close()
+
+
+def _run_shard(connection, build, args, initializer, initargs):
+    try:
+        _serve(connection, build, args, initializer, initargs)
+    finally:
+        connection.close()
+
+
+def serve_shard(address, documents, method, shard=0, shards=1, key="id", authkey=None, initializer=None, initargs=(), **kwargs):
+    """
+    Serves one shard on a TCP address, for a ShardedRetriever.connect on another node; returns
+    once that retriever closes.
+
+    :param address: (host, port) to listen on.
+    :param documents: The corpus, or just this shard's part of it: documents of other shards are skipped.
+    :param shard: Position of this shard among shards, see shard_of.
+    :param authkey: Bytes shared with the connecting retriever, required on untrusted networks.
+    :param initializer: Called with initargs before the retriever is built, see ShardedRetriever.
+    :param kwargs: Passed to main.build_retriever.
+    """
+    documents = [document for document in documents if shard_of(document[key], shards) == shard]
+    with Listener(address, authkey=authkey) as listener:
+        with listener.accept() as connection:
+            _serve(connection, _build_shard, (documents, method, shard, shards, key, kwargs), initializer, initargs)
+
+
+class ShardedRetriever:
+    def __init__(self, documents, method, shards=2, key="id", initializer=None, initargs=(), **kwargs):
+        """
+        Partitions the corpus across shard processes, each owning the index of its part, and
+        answers queries by scatter-gather: every query batch goes to all shards at once and
+        their top k hits are merged with a heap.
+
+        Shards search in parallel outside this process's GIL, so a corpus too large for one
+        retriever's index or one core's query rate is split across cores. Sparse scores use
+        each shard's own statistics (bm25/tfidf IDF, lunr), which match the global ones on
+        shards of a few thousand documents or more; embedding similarities are unaffected.
+
+        :param documents: List of documents, or a DocumentStore; a store saved to disk reaches
+                          the shards as its path rather than being copied to each of them.
+        :param method: Any method of main.build_retriever.
+        :param shards: Number of shard processes.
+        :param key: Identifier field of the documents, which decides their shard (see shard_of).
+        :param initializer: Called with initargs in every shard process before its retriever is
+                            built, e.g. to register models (see models.registry); must be
+                            importable by name, like a multiprocessing.Pool initializer.
+        :param kwargs: Passed to main.build_retriever in every shard.
+        """
+        if shards < 1:
+            raise ValueError(f"shards must be at least 1, got {shards}")
+        self.method = method
+        self.key = key
+        if isinstance(documents, DocumentStore):
+            # Pending changes are folded in first; a read-only store then lives in memory only
+            documents.compact()
+        if isinstance(documents, DocumentStore) and documents.path is not None:
+            parts = [documents] * shards
+        else:
+            parts = partition(documents, shards, key)
+        self._start([(_build_shard, (part, method, shard, shards, key, kwargs)) for shard, part in enumerate(parts)], initializer, initargs)
+
+    def _start(self, builds, initializer=None, initargs=()):
+        context = multiprocessing.get_context(START_METHOD)
+        self.connections = []
+        self.processes = []
+        for build, args in builds:
+            connection, child = context.Pipe()
+            process = context.Process(target=_run_shard, args=(child, build, args, initializer, initargs), daemon=True)
+            process.start()
+            child.close()
+            self.connections.append(connection)
+            self.processes.append(process)
+        self._lock = threading.Lock()
+        # Shards build in parallel; wait for all of them
+        try:
+            self._gather()
+        except RuntimeError:
+            self.close()
+            raise
+
+    @classmethod
+    def connect(cls, addresses, method, key="id", authkey=None):
+        """
+        Scatter-gather over shards served by serve_shard, e.g. on other nodes, in the order of
+        their shard positions.
+
+        :param addresses: (host, port) of every shard.
+        """
+        retriever = cls.__new__(cls)
+        retriever.method = method
+        retriever.key = key
+        retriever.connections = [Client(address, authkey=authkey) for address in addresses]
+        retriever.processes = []
+        retriever._lock = threading.Lock()
+        retriever._gather()
+        return retriever
+
+    def __len__(self):
+        return len(self.connections)
+
+    def _gather(self, shards=None):
+        # Replies of the given shards (all by default), in order
+        values = []
+        errors = []
+        for shard in range(len(self.connections)) if shards is None else shards:
+            try:
+                status, value = self.connections[shard].recv()
+            except EOFError:
+                status, value = "error", "shard process died"
+            if status == "error":
+                errors.append(f"shard {shard}: {value}")
+            values.append(value)
+        if errors:
+            raise RuntimeError("Shard failed\n" + "\n".join(errors))
+        return values
+
+    def _broadcast(self, *message):
+        with self._lock:
+            for connection in self.connections:
+                connection.send(message)
+            return self._gather()
+
+    def retrieve_batch(self, queries, k=10, batch_size=64, where=None):
+        """
+        Retrieves the top k documents of each query from every shard in parallel and merges them.
+
+        :param where: Metadata filter applied by every shard, see filters.MetadataIndex.
+        :return: One list of {key, "similarity"} hits per query, best first.
+        """
+        queries = list(queries)
+        if not queries:
+            return []
+        rankings = self._broadcast("retrieve_batch", queries, k, batch_size, where)
+        return [merge([shard[position] for shard in rankings], k) for position in range(len(queries))]
+
+    def retrieve(self, query, k=10, where=None):
+        """Retrieves the top k documents of a query, or one list of hits per query for a list of queries."""
+        if isinstance(query, str):
+            return self.retrieve_batch([query], k=k, where=where)[0]
+        return self.retrieve_batch(query, k=k, where=where)
+
+    def _route(self, command, items, key):
+        parts = [[] for _ in self.connections]
+        for item in items:
+            parts[shard_of(key(item), len(parts))].append(item)
+        targets = [shard for shard, part in enumerate(parts) if part]
+        with self._lock:
+            for shard in targets:
+                self.connections[shard].send((command, parts[shard]))
+            self._gather(targets)
+
+    def add(self, documents):
+        """Indexes documents in their shards, replacing those whose key is already indexed."""
+        self._route("add", documents, lambda document: document[self.key])
+        return self
+
+    def update(self, documents):
+        return self.add(documents)
+
+    def delete(self, ids):
+        """Removes the documents with the given keys from their shards; unknown keys are ignored."""
+        self._route("delete", ids, lambda key: key)
+        return self
+
+    def save(self, path):
+        """Saves every shard's retriever to path/shard_<n>, in parallel; only for methods whose retrievers have save."""
+        os.makedirs(path, exist_ok=True)
+        with self._lock:
+            for shard, connection in enumerate(self.connections):
+                connection.send(("save", os.path.join(path, f"shard_{shard}")))
+            self._gather()
+        with open(os.path.join(path, "sharded.json"), "w") as f:
+            json.dump({"method": self.method, "key": self.key, "shards": len(self.connections)}, f)
+
+    @classmethod
+    def load(cls, path, initializer=None, initargs=(), **kwargs):
+        """
+        Starts one process per shard saved by save, each loading its retriever.
+
+        :param initializer: Called with initargs in every shard process first, see __init__.
+        :param kwargs: Passed to the load method of the shards' retriever class (mmap, device...).
+        """
+        with open(os.path.join(path, "sharded.json"), "r") as f:
+            settings = json.load(f)
+        retriever = cls.__new__(cls)
+        retriever.method = settings["method"]
+        retriever.key = settings["key"]
+        retriever._start([
+            (_load_shard, (settings["method"], os.path.join(path, f"shard_{shard}"), kwargs))
+            for shard in range(settings["shards"])
+        ], initializer, initargs)
+        return retriever
+
+    def close(self):
+        """Stops the shards, or disconnects from them for connect."""
+        for connection in self.connections:
+            try:
+                connection.send(("close",))
+                connection.close()
+            except OSError:
+                pass
+        for process in self.processes:
+            process.join(timeout=10)
+        self.connections = []
+        self.processes = []
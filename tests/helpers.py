@@ -0,0 +1,10 @@
+def assert_same_ranking(got, expected, k=10):
+    # Similarities must match; documents tied with the k-th one may be cut at either side of it
+    assert len(got) == len(expected)
+    for hits, reference in zip(got, expected):
+        similarities = [round(float(hit["similarity"]), 4) for hit in hits]
+        assert similarities == [round(float(hit["similarity"]), 4) for hit in reference]
+        cut = similarities[-1] if len(hits) == k else None
+        assert {hit["id"] for hit, similarity in zip(hits, similarities) if similarity != cut} == {
+            hit["id"] for hit, similarity in zip(reference, similarities) if similarity != cut
+        }
@@ -0,0 +1,76 @@
+import os
+
+import numpy as np
+import pytest
+
+from ..bench import DEFAULT_MODEL, install_stub, synthetic_corpus
+from ..cache import EmbeddingCache, content_key
+from ..main import build_retriever
+
+
+class CountingEncoder:
+    # Deterministic embeddings of the texts, counting the texts encoded
+    def __init__(self, dim=8):
+        self.dim = dim
+        self.encoded = 0
+
+    def __call__(self, texts):
+        self.encoded += len(texts)
+        return np.array([np.random.default_rng(sum(map(ord, text))).standard_normal(self.dim) for text in texts], dtype=np.float32)
+
+
+def test_texts_are_encoded_once_per_model_and_normalized_content(tmp_path):
+    encoder = CountingEncoder()
+    cache = EmbeddingCache(str(tmp_path), "model")
+    first = cache.encode(["a cat", "a  dog", "a cat"], encoder)
+    assert encoder.encoded == 2
+    # Whitespace differences share the content key, and a new instance reads the stored rows
+    again = EmbeddingCache(str(tmp_path), "model").encode(["a dog ", "a cat"], encoder)
+    assert encoder.encoded == 2
+    np.testing.assert_array_equal(again, first[[1, 0]])
+    assert content_key("model", "a cat") != content_key("other", "a cat")
+    EmbeddingCache(str(tmp_path), "other").encode(["a cat"], encoder)
+    assert encoder.encoded == 3
+
+
+def test_reload_after_a_torn_append_keeps_the_complete_rows(tmp_path):
+    encoder = CountingEncoder()
+    cache = EmbeddingCache(str(tmp_path), "model")
+    stored = cache.encode(["one", "two", "three"], encoder)
+    # A crash after writing one and a half vectors of the next append, and none of its keys
+    with open(cache.vectors_path, "ab") as f:
+        f.write(encoder(["four", "five"]).tobytes()[: 6 * cache.dim])
+
+    reloaded = EmbeddingCache(str(tmp_path), "model")
+    assert reloaded.stats()["size"] == 3
+    assert os.path.getsize(reloaded.vectors_path) == 3 * 4 * cache.dim
+    assert os.path.getsize(reloaded.keys_path) == 3 * 20
+    appended = reloaded.encode(["four", "five"], encoder)
+
+    # The appended rows line up with their keys, before and after another reload
+    texts = ["one", "two", "three", "four", "five"]
+    expected = np.concatenate([stored, appended])
+    np.testing.assert_array_equal(reloaded.encode(texts, encoder), expected)
+    np.testing.assert_array_equal(EmbeddingCache(str(tmp_path), "model").encode(texts, encoder), expected)
+    np.testing.assert_array_equal(expected, encoder(texts))
+
+
+@pytest.mark.parametrize("method", ["bm25", "embedding"])
+def test_cached_results_are_not_served_after_a_change(method):
+    install_stub(DEFAULT_MODEL)
+    documents = list(synthetic_corpus(200))
+    retriever = build_retriever(documents, method, cache_dir=None)
+    query = " ".join(documents[0]["text"].split()[:3])
+    first = retriever.retrieve_batch([query], k=5)
+    assert retriever.retrieve_batch([query], k=5) == first
+    single = retriever.retrieve(query, k=5)
+    assert retriever.retrieve(query, k=5) == single
+    assert retriever.cache_stats()["results"]["hits"] == 2
+
+    # A document made of the query ranks first once added, and is gone once deleted
+    retriever.add([{"id": 1000, "text": " ".join([query] * 5), "title": "", "article": ""}])
+    assert retriever.retrieve_batch([query], k=5)[0][0]["id"] == 1000
+    assert retriever.retrieve(query, k=5) != single
+    retriever.delete([1000])
+    assert retriever.retrieve_batch([query], k=5) == first
+    assert retriever.retrieve(query, k=5) == single
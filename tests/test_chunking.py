@@ -0,0 +1,53 @@
+import pytest
+
+from ..chunking import Chunker, clean_text, regex_token_count
+
+
+def _sentences(count, words=9, prefix="s"):
+    # Sentences of words + 1 tokens (the full stop counts), numbered so their order can be checked
+    return [" ".join([f"{prefix}{index}"] * words) + "." for index in range(count)]
+
+
+def test_passages_fit_the_budget_and_keep_every_sentence_in_order():
+    sentences = _sentences(40)
+    blocks = [{"text": " ".join(sentences[start:start + 5]), "page": start // 10 + 1} for start in range(0, 40, 5)]
+    passages = list(Chunker(max_tokens=50, overlap=0, min_tokens=10).chunk(blocks, source="a.pdf"))
+    assert len(passages) == 8
+    assert all(regex_token_count([passage["text"]])[0] <= 50 for passage in passages)
+    assert " ".join(passage["text"] for passage in passages) == " ".join(sentences)
+    # A passage carries the page its first sentence is on
+    assert [passage["page"] for passage in passages] == [1, 1, 2, 2, 3, 3, 4, 4]
+    assert {passage["source"] for passage in passages} == {"a.pdf"}
+
+
+def test_overlap_repeats_trailing_sentences_within_the_budget():
+    sentences = _sentences(20)
+    passages = list(Chunker(max_tokens=50, overlap=20, min_tokens=10).chunk([{"text": " ".join(sentences)}]))
+    for previous, passage in zip(passages, passages[1:]):
+        assert regex_token_count([passage["text"]])[0] <= 50
+        # Two sentences of 10 tokens fit the overlap
+        assert passage["text"].startswith(". ".join(previous["text"].split(". ")[-2:]))
+    assert passages[-1]["text"].endswith(sentences[-1])
+
+
+def test_headings_start_passages_and_long_sentences_are_cut_at_words():
+    blocks = [
+        {"text": "Introduction", "heading": True},
+        {"text": " ".join(_sentences(3))},
+        {"text": "Details", "heading": True},
+        {"text": " ".join(["word"] * 120)},
+    ]
+    passages = list(Chunker(max_tokens=50, overlap=10, min_tokens=10).chunk(blocks))
+    assert passages[0]["text"].startswith("Introduction")
+    assert passages[1]["text"].startswith("Details")
+    assert all(regex_token_count([passage["text"]])[0] <= 50 for passage in passages)
+    assert sum(passage["text"].split().count("word") for passage in passages[1:]) == 120
+
+
+def test_overlap_must_be_below_the_budget():
+    with pytest.raises(ValueError):
+        Chunker(max_tokens=32, overlap=32)
+
+
+def test_clean_text_joins_wrapped_lines():
+    assert clean_text("a hyphen-\nated  word\nwrapped") == "a hyphenated word wrapped"
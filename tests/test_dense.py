@@ -0,0 +1,32 @@
+import numpy as np
+
+from ..dense import FaissIndex, make_index
+
+
+def _brute_force_cosine(documents, queries, k):
+    # Exact cosine ranking in float64, best first
+    documents = documents / np.linalg.norm(documents, axis=1, keepdims=True)
+    queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    similarities = queries.astype(np.float64) @ documents.astype(np.float64).T
+    order = np.argsort(-similarities, axis=1, kind="stable")[:, :k]
+    return order, np.take_along_axis(similarities, order, axis=1)
+
+
+def test_cosine_ranking_matches_brute_force():
+    rng = np.random.default_rng(0)
+    dim, size, k = 32, 500, 10
+    # Norms spread over two orders of magnitude, so an unnormalized inner product would rank differently
+    documents = rng.standard_normal((size, dim)).astype(np.float32) * rng.uniform(0.1, 10, (size, 1)).astype(np.float32)
+    queries = rng.standard_normal((20, dim)).astype(np.float32) * 5
+    expected_ids, expected_scores = _brute_force_cosine(documents, queries, k)
+
+    index = FaissIndex(key="id", index=make_index(dim, "flat", metric="cosine"), metric="cosine")
+    # The index normalizes in place, so it gets copies
+    index.add([{"id": position} for position in range(size)], documents.copy())
+    ranked = index(queries.copy(), k=k)
+
+    for hits, ids, scores in zip(ranked, expected_ids, expected_scores):
+        assert [hit["id"] for hit in hits] == ids.tolist()
+        # Plain floats, so hits serialize like those of the other retrievers
+        assert all(type(hit["similarity"]) is float for hit in hits)
+        np.testing.assert_allclose([hit["similarity"] for hit in hits], scores, rtol=0, atol=1e-5)
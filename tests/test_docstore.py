@@ -0,0 +1,72 @@
+import os
+import pickle
+
+import pytest
+
+from ..docstore import DocumentStore
+from ..golden import DocumentRetriever
+
+DOCUMENTS = [
+    {"id": 1, "text": "Paris is the capital of France", "source": "a.pdf", "page": 1},
+    {"id": 2, "text": "Île-de-France surrounds Paris ✓", "source": "a.pdf", "page": 2},
+    {"id": 3, "source": "b.docx"},
+    {"id": 5, "text": "", "folder": "20240101_000000"},
+]
+
+
+def _files(path):
+    return {name: os.path.getmtime(os.path.join(path, name)) for name in os.listdir(path)}
+
+
+@pytest.mark.parametrize("on_disk", [False, True])
+def test_store_round_trips_documents(on_disk, tmp_path):
+    store = DocumentStore.build(iter(DOCUMENTS), path=str(tmp_path / "store") if on_disk else None)
+    assert list(store) == DOCUMENTS
+    assert len(store) == 4 and 5 in store and 4 not in store
+    assert store.get(2) == DOCUMENTS[1] and store.get(4, "missing") == "missing"
+    assert store.materialize([[{"id": 3, "similarity": 0.5}]]) == [[{"id": 3, "source": "b.docx", "similarity": 0.5}]]
+    strings = DocumentStore.build([{"id": "x", "text": "one"}, {"id": "y", "text": "two"}])
+    assert strings.get("y") == {"id": "y", "text": "two"}
+
+
+def test_changes_are_visible_at_once_and_compacted_on_disk(tmp_path):
+    path = str(tmp_path / "store")
+    store = DocumentStore.build(DOCUMENTS, path=path)
+    store.extend([{"id": 2, "text": "replaced"}, {"id": 7, "text": "added"}]).delete([1, 42])
+    expected = [DOCUMENTS[2], DOCUMENTS[3], {"id": 2, "text": "replaced"}, {"id": 7, "text": "added"}]
+    assert list(store) == expected and len(store) == 4 and store.rows == 6
+    store.compact()
+    assert list(store) == expected and store.rows == 4
+    assert list(DocumentStore.load(path)) == expected
+    assert list(pickle.loads(pickle.dumps(store))) == expected
+
+
+def test_read_only_store_is_copied_on_write(tmp_path):
+    path = str(tmp_path / "store")
+    DocumentStore.build(DOCUMENTS, path=path)
+    files = _files(path)
+    shared = DocumentStore.load(path, read_only=True)
+    copy = shared.copy()
+    copy.extend([{"id": 9, "text": "new"}]).delete([1])
+    assert list(shared) == DOCUMENTS
+    copy.compact()
+    assert copy.path is None and [document["id"] for document in copy] == [2, 3, 5, 9]
+    # Saving changes over the shared files is refused
+    with pytest.raises(ValueError):
+        shared.delete([3]).save(path)
+    assert _files(path) == files and list(DocumentStore.load(path)) == DOCUMENTS
+
+
+def test_retrievers_sharing_a_read_only_store_keep_their_changes_apart(tmp_path):
+    path = str(tmp_path / "store")
+    DocumentStore.build([{"id": key, "text": f"document number {key} about topic {key % 3}"} for key in range(1, 31)], path=path)
+    shared = DocumentStore.load(path, read_only=True)
+    first = DocumentRetriever("bm25", shared, on=["text"])
+    second = DocumentRetriever("tfidf", shared, on=["text"])
+    first.add([{"id": 100, "text": "a brand new document"}])
+    first.delete([1])
+    first.compact(refit=True)
+    assert 100 in first.documents and 1 not in first.documents
+    assert second.documents is shared and 100 not in shared and 1 in shared
+    assert [hit["id"] for hit in second.retrieve_batch(["brand new document"], k=30)[0]].count(100) == 0
+    assert len(DocumentStore.load(path)) == 30
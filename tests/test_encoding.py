@@ -0,0 +1,43 @@
+import numpy as np
+
+from ..bench import HashingEncoder, synthetic_corpus
+from ..chunking import regex_token_count
+from ..encoding import encode_texts, iter_encoded, length_sorted_batches, model_token_counter
+
+
+class RecordingEncoder:
+    # HashingEncoder embeddings, recording the texts of every call
+    def __init__(self):
+        self.model = HashingEncoder()
+        self.calls = []
+
+    def __call__(self, texts, batch_size=32):
+        self.calls.append(list(texts))
+        return self.model.encode(texts)
+
+
+def test_encode_texts_returns_embeddings_in_input_order():
+    texts = [document["text"] for document in synthetic_corpus(150)]
+    encoder = RecordingEncoder()
+    embeddings = encode_texts(texts, encoder, batch_size=16, window=64)
+    np.testing.assert_array_equal(embeddings, HashingEncoder().encode(texts))
+    # Each call holds texts of similar length, longest first within a window
+    assert all(len(call) <= 16 for call in encoder.calls)
+    first = regex_token_count(encoder.calls[0])
+    assert first == sorted(first, reverse=True)
+    assert encode_texts([], encoder).shape == (0, 0)
+
+
+def test_iter_encoded_keeps_documents_with_their_embeddings():
+    documents = list(synthetic_corpus(100))
+    encoded = list(iter_encoded(documents, RecordingEncoder(), lambda document: document["text"], batch_size=8, window=40))
+    assert sorted(document["id"] for batch, _ in encoded for document in batch) == [document["id"] for document in documents]
+    for batch, embeddings in encoded:
+        np.testing.assert_array_equal(embeddings, HashingEncoder().encode([document["text"] for document in batch]))
+
+
+def test_batches_are_sorted_by_token_count():
+    # Punctuation-heavy text is short in characters but long in tokens
+    texts = ["a-b-c-d-e-f-g", "abcdefghijklmnopqrstuvwxyz", "x y"]
+    assert [batch.tolist() for batch in length_sorted_batches(texts, batch_size=2)] == [[0, 2], [1]]
+    assert model_token_counter(HashingEncoder()) is regex_token_count
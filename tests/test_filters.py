@@ -0,0 +1,80 @@
+import pytest
+
+from ..bench import DEFAULT_MODEL, install_stub, synthetic_corpus, synthetic_queries
+from ..filters import matches
+from ..main import build_retriever
+from ..sharded import ShardedRetriever
+from .helpers import assert_same_ranking
+
+WHERES = [
+    {"file_type": "docx"},
+    {"source": ["f1.pdf", "f2.pdf"], "page": {"$gte": 5}},
+    # Matches no document
+    {"page": 999},
+]
+
+
+def _with_metadata(document):
+    key = document["id"]
+    return dict(document, source=f"f{key % 7}.pdf", page=key % 13 + 1, file_type="pdf" if key % 3 else "docx")
+
+
+def _brute_force(unfiltered, where, documents, k):
+    # Filters complete rankings after the search
+    return [[hit for hit in hits if matches(documents[hit["id"]], where)][:k] for hits in unfiltered]
+
+
+@pytest.fixture(scope="module")
+def corpus():
+    install_stub(DEFAULT_MODEL)
+    documents = [_with_metadata(document) for document in synthetic_corpus(400)]
+    return documents, {document["id"]: document for document in documents}, synthetic_queries(12)
+
+
+@pytest.mark.parametrize("method", ["bm25", "tfidf", "lunr", "flash", "fuzz", "embedding", "encoder", "dpr"])
+def test_filtered_results_match_brute_force(method, corpus):
+    documents, by_id, queries = corpus
+    retriever = build_retriever(documents, method, cache_dir=None)
+    unfiltered = retriever.retrieve_batch(queries, k=len(documents))
+    for where in WHERES:
+        expected = _brute_force(unfiltered, where, by_id, 10)
+        assert_same_ranking(retriever.retrieve_batch(queries, k=10, where=where), expected)
+    assert retriever.retrieve_batch(queries, k=10, where={"page": 999}) == [[] for _ in queries]
+
+
+@pytest.mark.parametrize("method", ["bm25", "embedding"])
+def test_filtered_and_unfiltered_queries_share_a_batch(method, corpus):
+    # Cached hits of one filter must not answer the same queries under another
+    documents, by_id, queries = corpus
+    reference = build_retriever(documents, method, cache_dir=None, query_cache_size=0)
+    retriever = build_retriever(documents, method, cache_dir=None)
+    where = WHERES[0]
+    retriever.retrieve_batch(queries[::2], k=10)
+    assert_same_ranking(retriever.retrieve_batch(queries, k=10, where=where), reference.retrieve_batch(queries, k=10, where=where))
+    retriever.retrieve_batch(queries[1::2], k=10, where={"page": 999})
+    assert_same_ranking(retriever.retrieve_batch(queries, k=10), reference.retrieve_batch(queries, k=10))
+
+
+def test_hybrid_fuses_the_filtered_rankings(corpus):
+    documents, by_id, queries = corpus
+    hybrid = build_retriever(documents, "hybrid", cache_dir=None)
+    candidates = max(10, hybrid.candidates)
+    sparse = hybrid.sparse.retrieve_batch(queries, k=len(documents))
+    dense = hybrid.dense.retrieve_batch(queries, k=len(documents))
+    for where in WHERES:
+        expected = [
+            hybrid._fuse(sparse_hits, dense_hits, 10)
+            for sparse_hits, dense_hits in zip(_brute_force(sparse, where, by_id, candidates), _brute_force(dense, where, by_id, candidates))
+        ]
+        assert_same_ranking(hybrid.retrieve_batch(queries, k=10, where=where), expected)
+
+
+def test_sharded_filtered_results_match_brute_force(corpus):
+    documents, by_id, queries = corpus
+    sharded = ShardedRetriever(documents, "embedding", shards=2, initializer=install_stub, initargs=(DEFAULT_MODEL,), cache_dir=None)
+    try:
+        unfiltered = sharded.retrieve_batch(queries, k=len(documents))
+        for where in WHERES:
+            assert_same_ranking(sharded.retrieve_batch(queries, k=10, where=where), _brute_force(unfiltered, where, by_id, 10))
+    finally:
+        sharded.close()
@@ -0,0 +1,42 @@
+import random
+
+from ..bench import synthetic_corpus
+from ..fuzzy import FuzzyIndex
+from .helpers import assert_same_ranking
+
+PHRASES = ["zebracorn quixotic lanterns", "marmalade hypotenuse", "obsidian lighthouse keeper"]
+
+
+def _corpus(size=1500, planted=6):
+    # Synthetic paragraphs, a few of which hold each phrase
+    documents = list(synthetic_corpus(size))
+    rng = random.Random(0)
+    for phrase in PHRASES:
+        for document in rng.sample(documents, planted):
+            words = document["text"].split()
+            position = rng.randrange(len(words))
+            document["text"] = " ".join(words[:position] + [phrase] + words[position:])
+    return documents
+
+
+def test_pruned_top_k_matches_exhaustive_scoring():
+    documents = _corpus()
+    pruned = FuzzyIndex("id", ["text"], candidates=50).add(documents)
+    exhaustive = FuzzyIndex("id", ["text"], candidates=None).add(documents)
+    # Exact phrases, typos and partial phrases
+    queries = PHRASES + ["zebrakorn quixotik", "marmelade hypotenuse", "lighthouse keeper"]
+    for k in (1, 5):
+        assert_same_ranking(pruned(queries, k=k), exhaustive(queries, k=k), k=k)
+
+
+def test_filtered_pruned_search_only_returns_matching_documents():
+    documents = _corpus()
+    for document in documents:
+        document["source"] = "even.pdf" if document["id"] % 2 == 0 else "odd.pdf"
+    pruned = FuzzyIndex("id", ["text"], candidates=50).add(documents)
+    exhaustive = FuzzyIndex("id", ["text"], candidates=None).add(documents)
+    where = {"source": "even.pdf"}
+    hits = pruned(PHRASES, k=3, where=where)
+    assert all(hit["id"] % 2 == 0 for query_hits in hits for hit in query_hits)
+    # Documents sharing no word with the query are never candidates, so only the best hit is compared
+    assert_same_ranking([query_hits[:1] for query_hits in hits], exhaustive(PHRASES, k=1, where=where), k=1)
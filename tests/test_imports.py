@@ -0,0 +1,34 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from ..bench import imported_packages
+from ..main import METHODS
+
+# Heavy modules only the dense methods need
+HEAVY_MODULES = ("torch", "sentence_transformers", "faiss")
+
+
+def test_sparse_method_does_not_import_heavy_modules():
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    package = __package__.rsplit(".", 1)[0]
+    code = (
+        f"import sys, json, {package}.main; {package}.main.retriever_class('bm25'); "
+        f"print(json.dumps([name for name in {HEAVY_MODULES!r} if name in sys.modules]))"
+    )
+    # A fresh interpreter, so modules imported by other tests do not count
+    environment = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [os.path.dirname(package_dir), os.environ.get("PYTHONPATH")])))
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, env=environment, cwd=os.path.dirname(package_dir))
+    assert result.returncode == 0, result.stderr
+    assert json.loads(result.stdout.strip().splitlines()[-1]) == []
+
+
+@pytest.mark.parametrize("method", METHODS)
+def test_method_lookup_imports_only_numpy_and_the_standard_library(method):
+    # cherche, faiss, scipy and the other heavy dependencies are imported when a retriever is built
+    package = __package__.rsplit(".", 1)[0]
+    allowed = set(sys.stdlib_module_names) | {"numpy", package}
+    assert [name for name in imported_packages(method) if name not in allowed] == []
@@ -0,0 +1,67 @@
+import random
+
+import pytest
+
+from ..bench import DEFAULT_MODEL, install_stub, synthetic_corpus, synthetic_queries
+from ..golden import DocumentRetriever
+from .helpers import assert_same_ranking
+
+LIVE_METHODS = ["bm25", "tfidf", "flash", "lunr", "fuzz", "embedding"]
+
+
+def _build(method, documents):
+    # compact_threshold=1 leaves compacting to the test
+    return DocumentRetriever(method, documents, on=["text"], cache_dir=None, query_cache_size=0, compact_threshold=1.0)
+
+
+def _edit(retriever, documents, seed=0):
+    # Adds, updates and deletes documents on retriever and returns the resulting corpus by id
+    rng = random.Random(seed)
+    current = {document["id"]: document for document in documents[:250]}
+    retriever.add(documents[250:])
+    current.update({document["id"]: document for document in documents[250:]})
+    updated = [dict(current[key], text=documents[(key * 7) % len(documents)]["text"]) for key in rng.sample(sorted(current), 20)]
+    retriever.update(updated)
+    current.update({document["id"]: document for document in updated})
+    deleted = rng.sample(sorted(current), 30)
+    retriever.delete(deleted)
+    for key in deleted:
+        del current[key]
+    return current
+
+
+@pytest.fixture(scope="module")
+def corpus():
+    install_stub(DEFAULT_MODEL)
+    return list(synthetic_corpus(300)), synthetic_queries(20)
+
+
+@pytest.mark.parametrize("method", LIVE_METHODS)
+def test_live_changes_match_a_rebuilt_retriever(method, corpus, tmp_path):
+    documents, queries = corpus
+    live = _build(method, documents[:250])
+    current = _edit(live, documents)
+
+    results = live.retrieve_batch(queries, k=10)
+    assert all(hit["id"] in current for hits in results for hit in hits)
+    rebuilt = _build(method, list(current.values()))
+    if method in ["embedding", "fuzz"]:
+        # Their similarities do not depend on the rest of the corpus, so edits are exact at once
+        assert_same_ranking(results, rebuilt.retrieve_batch(queries, k=10))
+
+    # The sparse methods are rebuilt from the documents in the order the live retriever now holds
+    # them, so ties break alike; embedding similarities do not depend on the order
+    live.compact(refit=True)
+    if method != "embedding":
+        assert sorted(document["id"] for document in live.documents) == sorted(current)
+        rebuilt = _build(method, list(live.documents))
+    expected = rebuilt.retrieve_batch(queries, k=10)
+    assert_same_ranking(live.retrieve_batch(queries, k=10), expected)
+    assert_same_ranking(live.retrieve(queries, k=10), rebuilt.retrieve(queries, k=10))
+
+    live.save(str(tmp_path))
+    loaded = DocumentRetriever.load(str(tmp_path))
+    assert_same_ranking(loaded.retrieve_batch(queries, k=10), expected)
+    # A loaded retriever stays live
+    loaded.delete([hits[0]["id"] for hits in expected if hits])
+    assert not any(hits[0]["id"] in {hit["id"] for hit in got} for hits, got in zip(expected, loaded.retrieve_batch(queries, k=10)) if hits)
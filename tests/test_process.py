@@ -0,0 +1,88 @@
+import logging
+import os
+
+import pytest
+
+from ..metrics import metrics
+
+# process.py runs next to the retrievers package (see README) and imports it by name
+process = pytest.importorskip("process")
+docx = pytest.importorskip("docx")
+
+
+def _write_docx(path, paragraphs):
+    document = docx.Document()
+    for paragraph in paragraphs:
+        document.add_paragraph(paragraph)
+    document.save(path)
+
+
+def _texts(documents):
+    return {document["id"]: document["text"] for document in documents}
+
+
+def test_incremental_update_only_renumbers_changed_files(tmp_path):
+    folder = str(tmp_path)
+    _write_docx(os.path.join(folder, "a.docx"), ["alpha one", "alpha two"])
+    _write_docx(os.path.join(folder, "b.docx"), ["beta one", "beta two", "beta three"])
+    _write_docx(os.path.join(folder, "c.docx"), ["gamma one"])
+    manifest = {"next_id": 1, "files": {}}
+    documents = list(process.update_text_from_folder(folder, [], manifest))
+    before = _texts(documents)
+    assert sorted(before.values()) == sorted(["alpha one", "alpha two", "beta one", "beta two", "beta three", "gamma one"])
+
+    os.remove(os.path.join(folder, "a.docx"))
+    _write_docx(os.path.join(folder, "c.docx"), ["gamma changed", "gamma added"])
+    _write_docx(os.path.join(folder, "d.docx"), ["delta one"])
+    # Touched without changes: re-hashed, not re-parsed
+    os.utime(os.path.join(folder, "b.docx"))
+    summary = {}
+    after = _texts(process.update_text_from_folder(folder, documents, manifest, summary=summary))
+
+    assert summary == {"unchanged": 1, "added": 1, "modified": 1, "deleted": 1, "failed": 0}
+    # b keeps its ids; the changed and new paragraphs get ids never used before
+    assert {key: text for key, text in before.items() if text.startswith("beta")} == {key: text for key, text in after.items() if text.startswith("beta")}
+    fresh = {key for key, text in after.items() if not text.startswith("beta")}
+    assert min(fresh) > max(before)
+    assert sorted(after.values()) == sorted(["beta one", "beta two", "beta three", "gamma changed", "gamma added", "delta one"])
+    assert manifest["files"]["a.docx"]["deleted"]
+    assert manifest["next_id"] == max(after) + 1
+
+
+def test_parallel_extraction_numbers_paragraphs_like_a_serial_run(tmp_path):
+    folder = str(tmp_path)
+    for index in range(6):
+        os.makedirs(os.path.join(folder, f"part{index % 2}"), exist_ok=True)
+        _write_docx(os.path.join(folder, f"part{index % 2}", f"file{index}.docx"), [f"file {index} paragraph {line}" for line in range(index + 1)])
+    serial = process.extract_text_from_folder(folder, workers=1)
+    assert len(serial) == 21
+    assert process.extract_text_from_folder(folder, workers=3) == serial
+    assert process.extract_text_from_folder(folder, workers=2, timeout=60) == serial
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_unreadable_and_unsupported_files_are_logged_not_printed(workers, tmp_path, capsys, caplog):
+    # runner.py reads the output path from the stdout of process.py, so problems go to the log
+    folder = str(tmp_path)
+    _write_docx(os.path.join(folder, "good.docx"), ["readable"])
+    with open(os.path.join(folder, "broken.docx"), "wb") as f:
+        f.write(b"not a zip archive")
+    with open(os.path.join(folder, "notes.txt"), "w") as f:
+        f.write("unsupported")
+    before = dict(metrics.counters)
+    with caplog.at_level(logging.WARNING, logger="retrievers"):
+        documents = process.extract_text_from_folder(folder, workers=workers)
+
+    assert [document["text"] for document in documents] == ["readable"]
+    assert capsys.readouterr().out == ""
+    events = {(record.getMessage(), os.path.basename(record.fields["path"])) for record in caplog.records}
+    assert ("skipped_file", "notes.txt") in events
+    if workers == 1:
+        # Extraction errors are logged by the worker process when there is one, and counted in both cases
+        assert ("extract_error", "broken.docx") in events
+
+    def added(name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        return metrics.counters.get(key, 0) - before.get(key, 0)
+    assert added("skipped_files") == 1
+    assert added("extraction_errors", format=".docx") == 1
@@ -0,0 +1,24 @@
+from ..bench import DEFAULT_MODEL, install_stub, synthetic_corpus, synthetic_queries
+from ..main import build_retriever
+from ..sharded import ShardedRetriever
+
+
+def test_sharded_top_k_matches_single_process():
+    # Exact cosine similarities do not depend on the other documents, so merging the shards'
+    # top k must give the top k of one retriever over the whole corpus
+    install_stub(DEFAULT_MODEL)
+    documents = list(synthetic_corpus(300))
+    queries = synthetic_queries(8)
+    single = build_retriever(documents, "embedding", cache_dir=None, query_cache_size=0)
+    expected = single.retrieve_batch(queries, k=10)
+
+    sharded = ShardedRetriever(documents, "embedding", shards=2, initializer=install_stub, initargs=(DEFAULT_MODEL,), cache_dir=None, query_cache_size=0)
+    try:
+        merged = sharded.retrieve_batch(queries, k=10)
+    finally:
+        sharded.close()
+
+    for got, want in zip(merged, expected):
+        assert [hit["id"] for hit in got] == [hit["id"] for hit in want]
+        for hit, reference in zip(got, want):
+            assert abs(hit["similarity"] - reference["similarity"]) < 1e-5
@@ -0,0 +1,36 @@
+import os
+import time
+
+import pytest
+
+# upload.py runs next to the retrievers package (see README) and imports it by name
+upload = pytest.importorskip("upload")
+
+
+def _objects(main_folder):
+    objects_dir = os.path.join(main_folder, upload.OBJECTS_SUBDIR)
+    return sorted(os.path.join(root, name) for root, _, names in os.walk(objects_dir) for name in names)
+
+
+def test_identical_content_is_stored_once(tmp_path):
+    source = tmp_path / "source"
+    (source / "nested").mkdir(parents=True)
+    (source / "a.txt").write_bytes(b"same content")
+    (source / "nested" / "copy.txt").write_bytes(b"same content")
+    (source / "b.txt").write_bytes(b"other content")
+    main_folder = str(tmp_path / "all_files")
+
+    first = upload.save_files_to_timestamped_folder(str(source), main_folder)
+    assert len(_objects(main_folder)) == 2
+    # Timestamped folders are named to the second
+    time.sleep(1.1)
+    second = upload.save_files_to_timestamped_folder(str(source), main_folder)
+    assert first != second
+    assert len(_objects(main_folder)) == 2
+
+    for folder in (first, second):
+        for relative_path, content in (("a.txt", b"same content"), (os.path.join("nested", "copy.txt"), b"same content"), ("b.txt", b"other content")):
+            with open(os.path.join(folder, relative_path), "rb") as f:
+                assert f.read() == content
+    # Both uploads link the one stored copy
+    assert os.path.samefile(os.path.join(first, "a.txt"), os.path.join(second, "nested", "copy.txt"))
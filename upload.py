@@ -1,13 +1,118 @@
 import os
+import json
+import errno
+import shutil
+import hashlib
 import argparse
 from datetime import datetime
+from retrievers.metrics import metrics
+
+# Content-addressed store of every uploaded file, named by its sha256; timestamped folders link into it
+OBJECTS_SUBDIR = os.path.join('sys', 'objects')
+
+# Source path -> (size, mtime, inode, hash) of files already stored, so unchanged files are not re-read
+SOURCE_INDEX_NAME = os.path.join('sys', 'upload_index.json')
+
+def hash_file(file_path, chunk_size=1 << 20):
+    """Returns the sha256 hex digest of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def copy_file(src, dst):
+    """
+    Copies src to dst without moving the data through Python: copy_file_range (which
+    filesystems such as btrfs and XFS turn into a reflink), else shutil.copyfile, which
+    uses sendfile on Linux.
+    """
+    if hasattr(os, 'copy_file_range'):
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            try:
+                remaining = os.fstat(fsrc.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+                return
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EPERM):
+                    raise
+    shutil.copyfile(src, dst)
+
+def link_file(src, dst):
+    """Hard links dst to src, falling back to a copy where hard links are not supported."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        copy_file(src, dst)
+
+def load_source_index(path):
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        # A damaged index only costs re-hashing
+        return {}
+
+def write_source_index(path, index):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, path)
+
+def store_file(file_path, objects_dir, source_index):
+    """
+    Adds a file to the content-addressed store unless its content is already there.
+
+    :param source_index: Source index loaded with load_source_index; updated in place.
+    :return: (path of the stored object, True if the content was new).
+    """
+    stat = os.stat(file_path)
+    source_key = os.path.realpath(file_path)
+    signature = [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+    entry = source_index.get(source_key)
+    if entry and entry[:3] == signature:
+        content_hash = entry[3]
+    else:
+        content_hash = hash_file(file_path)
+        source_index[source_key] = signature + [content_hash]
+
+    object_path = os.path.join(objects_dir, content_hash[:2], content_hash)
+    if os.path.exists(object_path):
+        return object_path, False
+
+    os.makedirs(os.path.dirname(object_path), exist_ok=True)
+    tmp_path = f"{object_path}.{os.getpid()}.tmp"
+    copy_file(file_path, tmp_path)
+    # Uploaded files are hard links to the object: keep them from being edited in place
+    os.chmod(tmp_path, 0o444)
+    os.replace(tmp_path, object_path)
+    return object_path, True
 
 # Function to save uploaded files to a timestamped folder inside "all_files"
-def save_files_to_timestamped_folder(folder_path):
+def save_files_to_timestamped_folder(folder_path, main_folder="all_files"):
+    """
+    Uploads the files below folder_path into a new timestamped folder inside main_folder.
+
+    Each distinct content is stored once in main_folder/sys/objects and the timestamped
+    folder holds hard links to it, so re-uploading the same documents copies nothing.
+    Files whose size, mtime and inode are unchanged since an earlier upload are not even
+    re-read.
+    """
+    with metrics.stage("upload"):
+        return _save_files(folder_path, main_folder)
+
+def _save_files(folder_path, main_folder):
     # Create the main "all_files" folder if it doesn't exist
-    main_folder = "all_files"
-    if not os.path.exists(main_folder):
-        os.makedirs(main_folder)
+    objects_dir = os.path.join(main_folder, OBJECTS_SUBDIR)
+    os.makedirs(objects_dir, exist_ok=True)
+    source_index_path = os.path.join(main_folder, SOURCE_INDEX_NAME)
+    source_index = load_source_index(source_index_path)
 
     # Create a timestamped subfolder
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -24,10 +129,18 @@ def save_files_to_timestamped_folder(folder_path):
             # Create necessary subfolders in the destination path
             os.makedirs(os.path.dirname(destination_path), exist_ok=True)
 
-            # Copy file to the destination path
-            with open(file_path, 'rb') as fsrc, open(destination_path, 'wb') as fdst:
-                fdst.write(fsrc.read())
+            # Store the content once and link it into the destination path
+            object_path, is_new = store_file(file_path, objects_dir, source_index)
+            link_file(object_path, destination_path)
+            size = os.path.getsize(object_path)
+            metrics.count("uploaded_files")
+            if is_new:
+                metrics.count("uploaded_bytes", size)
+            else:
+                metrics.count("deduplicated_files")
+                metrics.count("deduplicated_bytes", size)
 
+    write_source_index(source_index_path, source_index)
     return destination_folder
 
 def main():
@@ -0,0 +1,37 @@
+import itertools
+import math
+from collections import deque
+
+
+def batched(iterable, batch_size):
+    """Yields successive lists of up to batch_size items from any iterable, without materializing it."""
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of a list of numbers."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+class LatencyRecorder:
+    def __init__(self, size=10000):
+        """Keeps the last size latencies (in ms) per name, e.g. per server route or pipeline stage."""
+        self.size = size
+        self.samples = {}
+
+    def record(self, name, seconds):
+        self.samples.setdefault(name, deque(maxlen=self.size)).append(seconds * 1000)
+
+    def summary(self):
+        return {
+            name: {"count": len(samples), "p50_ms": percentile(samples, 50), "p99_ms": percentile(samples, 99)}
+            for name, samples in self.samples.items()
+        }